@@ -14,6 +14,8 @@ Module description
         OrderedSet 有序集合
         StrSet, IntSet, StrList, IntList, 用于将 字符串/整数 集合/数组 转化为字符串。
             以用于数据库的IO
+        pack, unpack, unpack_numpy, 将 字符串/整数 集合/数组 转化为紧凑的bytes, 以及从bytes
+            直接恢复为array或numpy.ndarray
 
 Keyword
 -------
@@ -38,6 +40,8 @@ Import Command
 
 from __future__ import print_function
 import collections
+import array
+import sys
 
 class OrderedSet(collections.MutableSet):
     """Set that remembers original insertion order.
@@ -118,6 +122,55 @@ class OrderedSet(collections.MutableSet):
             res = ods & res
         return res
     
+# StrSet, IntSet, StrList, IntList 除了用"&&"连接的字符串之外, 还可以用紧凑的bytes储存:
+#     整数: PACKED_MAGIC + b"q" + little endian的64位整数数组
+#     字符串: PACKED_MAGIC + b"z" + 用"\x00"连接的utf-8编码字符串
+# PACKED_MAGIC不可能是utf-8字符串的第一个字节, 所以converter可以自动识别两种格式。
+# 解码时使用 array.frombytes 和 str.split, 无需对每个元素调用python函数。
+
+PACKED_MAGIC = b"\xfb"
+
+def pack(iterable):
+    """把由整数或字符串组成的集合/数组转化为紧凑的bytes
+    """
+    items = list(iterable)
+    if all(isinstance(i, str) for i in items) and len(items):
+        text = "\x00".join(items)
+        if text.count("\x00") != len(items) - 1:
+            raise ValueError("packed string can not contain '\\x00'")
+        return PACKED_MAGIC + b"z" + text.encode("utf-8")
+    else:
+        arr = array.array("q", items)
+        if sys.byteorder == "big":
+            arr.byteswap()
+        return PACKED_MAGIC + b"q" + arr.tobytes()
+
+def is_packed(bytestr):
+    """判断bytes是否是pack()的结果
+    """
+    return bytestr[:1] == PACKED_MAGIC
+
+def unpack(bytestr):
+    """把pack()的结果恢复为 array.array("q") 或 list of str
+    """
+    if bytestr[1:2] == b"z":
+        return bytestr[2:].decode("utf-8").split("\x00")
+    else:
+        arr = array.array("q")
+        arr.frombytes(bytestr[2:])
+        if sys.byteorder == "big":
+            arr.byteswap()
+        return arr
+
+def unpack_numpy(bytestr):
+    """把pack()的结果恢复为numpy.ndarray, 整数数组不复制内存
+    """
+    import numpy as np
+    if bytestr[1:2] == b"z":
+        return np.array(unpack(bytestr), dtype=object)
+    else:
+        return np.frombuffer(bytestr, dtype="<i8", offset=2)
+
 class StrSet(set):
     """set that all elements are string"""
     @staticmethod
@@ -128,6 +181,8 @@ class StrSet(set):
     @staticmethod
     def sqlite3_converter(_STRING):
         """类 -> 字符串 转换"""
+        if is_packed(_STRING):
+            return StrSet(unpack(_STRING))
         try:
             return StrSet(_STRING.decode().split("&&"))
         except:
@@ -143,6 +198,8 @@ class IntSet(set):
     @staticmethod
     def sqlite3_converter(_STRING):
         """类 -> 字符串 转换"""
+        if is_packed(_STRING):
+            return IntSet(unpack(_STRING))
         try:
             return IntSet([int(s) for s in _STRING.decode().split("&&")])
         except:
@@ -158,6 +215,8 @@ class StrList(list):
     @staticmethod
     def sqlite3_converter(_STRING):
         """类 -> 字符串 转换"""
+        if is_packed(_STRING):
+            return StrList(unpack(_STRING))
         try:
             return StrList(_STRING.decode().split("&&"))
         except:
@@ -173,6 +232,8 @@ class IntList(list):
     @staticmethod
     def sqlite3_converter(_STRING):
         """类 -> 字符串 转换"""
+        if is_packed(_STRING):
+            return IntList(unpack(_STRING))
         try:
             return IntList([int(s) for s in _STRING.decode().split("&&")])
         except:
@@ -223,5 +284,15 @@ if __name__ == "__main__":
             intlist = IntList([1, 1, 2, 2])
             self.assertIn(IntList.sqlite3_adaptor(intlist), ["1&&1&&2&&2"])
             self.assertListEqual(IntList.sqlite3_converter("1&&2"), IntList([1, 2]))           
+        
+        def test_packed(self):
+            for obj in [StrSet(["是", "否"]), IntSet([1, -2**40]), 
+                        StrList(["是", "", "否"]), IntList([1, 1, 2]), IntList()]:
+                bytestr = pack(obj)
+                self.assertTrue(is_packed(bytestr))
+                self.assertEqual(obj.sqlite3_converter(bytestr), obj)
+                self.assertEqual(type(obj.sqlite3_converter(bytestr)), type(obj))
+            self.assertEqual(list(unpack(pack([1, 2, 3]))), [1, 2, 3])
+            self.assertRaises(ValueError, pack, ["a\x00b"])
             
     unittest.main()
\ No newline at end of file
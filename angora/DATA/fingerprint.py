@@ -112,6 +112,27 @@ class FingerPrint():
                 m.update(data)
         return m.hexdigest()
     
+    def of_file_and_prefix(self, abspath, nbytes, chunk_size=2**20):
+        """return (hash value of the first #nbytes bytes, hash value of the whole file), reading
+        the file only once. Useful to check whether a file only has new content appended.
+        """
+        m = self.default_hash_method()
+        with open(abspath, "rb") as f:
+            remain = nbytes
+            while remain > 0:
+                data = f.read(min(chunk_size, remain))
+                if not data:
+                    break
+                m.update(data)
+                remain -= len(data)
+            prefix_digest = m.hexdigest()
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                m.update(data)
+        return prefix_digest, m.hexdigest()
+    
 fingerprint = FingerPrint()
     
 if __name__ == "__main__":
@@ -203,6 +203,44 @@ class TimeWrapper(object):
                 pass
         raise NoMatchingTemplateError(datetimestr)
     
+    def _detect_template(self, strings, templates, default_template):
+        """从templates中找出能够解析strings中全部字符串的模板, 优先尝试default_template。
+        如果没有任何一个模板能解析全部样本, 返回None。
+        """
+        strings = [s for s in strings if isinstance(s, str) and s]
+        if not strings:
+            return None
+        for template in [default_template,] + templates:
+            try:
+                for s in strings:
+                    dt.strptime(s, template)
+                return template
+            except:
+                pass
+        return None
+
+    def detect_date_template(self, datestr_list):
+        """find the first date template that can parse all date strings in the list. The matching
+        template is saved as default template. Returns None if no template matching.
+
+        用于批量解析: 用少量样本确定模板后, 即可对整列数据用同一个模板进行向量化解析。
+        """
+        template = self._detect_template(datestr_list,
+                                         self.date_templates, self.default_date_template)
+        if template:
+            self.default_date_template = template
+        return template
+
+    def detect_datetime_template(self, datetimestr_list):
+        """find the first datetime template that can parse all datetime strings in the list. The
+        matching template is saved as default template. Returns None if no template matching.
+        """
+        template = self._detect_template(datetimestr_list,
+                                         self.datetime_templates, self.default_datetime_templates)
+        if template:
+            self.default_datetime_templates = template
+        return template
+
     def isodatestr(self, datestr):
         return str(self.str2date(datestr))
 
@@ -481,7 +519,17 @@ if __name__ == "__main__":
             self.assertEqual(timewrapper.isodatetimestr("2014-07-03 8:12:34"), "2014-07-03 08:12:34")
             self.assertEqual(timewrapper.isodatetimestr("2014-07-03 8:12:34 PM"), "2014-07-03 20:12:34")
             self.assertRaises(NoMatchingTemplateError, timewrapper.isodatetimestr, "[2014][07][03]")
-        
+
+        def test_detect_template(self):
+            tw = TimeWrapper()
+            self.assertEqual(tw.detect_date_template(["09/20/2014", "12/31/2014", None]),
+                             "%m/%d/%Y")
+            self.assertEqual(tw.default_date_template, "%m/%d/%Y")
+            self.assertEqual(tw.detect_datetime_template(["2014-01-15T17:58:31"]),
+                             "%Y-%m-%dT%H:%M:%S")
+            self.assertEqual(tw.detect_date_template(["2014-09-20", "[2014][05][01]"]), None)
+            self.assertEqual(tw.detect_date_template([]), None)
+
         def test_dtime_range(self):
             # test start + end
             self.assertListEqual([dt(2014,1,1,3,0,0), dt(2014,1,1,3,5,0), dt(2014,1,1,3,10,0)],
@@ -15,14 +15,16 @@ read_header = True
 """
 
 from angora.DATA.timewrapper import timewrapper
+from angora.PandasSQL.datetimeseries import parse_date_series, parse_datetime_series
+from angora.PandasSQL.typeinference import SchemaInference
 import numpy as np, pandas as pd
 
 class CSVFile():
-    dtype_mapping = {"TEXT": np.str, "INTEGER": np.int64, "REAL": np.float64,
-                     "DATE": np.str, "DATETIME": np.str}
+    dtype_mapping = {"TEXT": str, "INTEGER": np.int64, "REAL": np.float64,
+                     "DATE": str, "DATETIME": str}
     
     def __init__(self, abspath, sep = ",", header = True, 
-                 usecols = None, dtype = None, converter = None):
+                 usecols = None, dtype = None, converter = None, infer_dtype = False):
         """
         [args]
         ------
@@ -44,6 +46,10 @@ class CSVFile():
                     TEXT, INTEGER, REAL, DATE, DATETIME
                 example1: {"column_name1": "TEXT", "column_name2": "INTEGER"}
                 example2: {column_index_number1: "TEXT", column_index_number2: "INTEGER"}
+                
+            infer_dtype:
+                if True, infer the data type of the columns which are not defined in dtype from
+                a sample of the file, see angora.PandasSQL.typeinference.SchemaInference
         """
         self.abspath = abspath
         self.sep = sep
@@ -53,6 +59,14 @@ class CSVFile():
             self.header = None
         self.usecols = usecols
         
+        inferred_integer = set() # 推断为INTEGER的列, 由pandas决定使用int64还是float64
+        if infer_dtype: # 用户定义的dtype优先
+            inferred = SchemaInference(abspath, sep=sep, header=header, usecols=usecols).dtype
+            inferred_integer = set([k for k, v in inferred.items() 
+                                    if v == "INTEGER" and k not in (dtype or dict())])
+            inferred.update(dtype or dict())
+            dtype = inferred
+        
         # 检查header, 如果没有, 则自动将header设置为 prefix+column_number
         # 并且将dtype中的column序号也转变成prefix+column_number
         if header: 
@@ -67,13 +81,15 @@ class CSVFile():
         
         if dtype: # 将用户定义的dtype转化成pandas.read_csv可用的数据类型
             try: # 检查dtype中数据类型是否定义正确
-                self.pd_dtype = {k: self.dtype_mapping[v] for k, v in dtype.items()}
+                self.pd_dtype = {k: self.dtype_mapping[v] for k, v in dtype.items() 
+                                 if k not in inferred_integer}
             except:
                 raise Exception("data type has to be one of ['TEXT', 'INTEGER', 'REAL', 'DATE', 'DATETIME']")
         else:
             self.pd_dtype = None
         
         self.converter = self.do_nothing
+        self.vectorized = False
         
 #         try: # 读取第一条数据作为样本储存起来
         self.read_sample()
@@ -85,92 +101,191 @@ class CSVFile():
         """
         return d
     
-    def plugin_converter(self, converter):
+    def plugin_converter(self, converter, vectorized=False):
         """将self.converter方法绑定到converter函数上, 对传入的dict进行一定的修改
         此方法可插拔
+        
+        vectorized=True时, converter接受一个pandas.DataFrame并返回一个pandas.DataFrame,
+        对每一块数据一次性转换, 而不是对每一行的dict调用一次。
         """
         self.converter = converter
+        self.vectorized = vectorized
+    
+    def _add_prefix(self, df):
+        """没有header时, 把列名从列序号改为 prefix+column_number。新版本的pandas.read_csv
+        没有prefix参数。
+        """
+        if self.prefix:
+            df.columns = [self.prefix + str(column) for column in df.columns]
+        return df
     
     def read_sample(self):
         """读取第一条数据作为样本储存起来
         """
         df = pd.read_csv(self.abspath, sep=self.sep, header=self.header, 
-                         nrows=1, dtype=self.pd_dtype, usecols=self.usecols,
-                         prefix=self.prefix)
-        row = df.iloc[0,:].to_dict()
+                         nrows=1, dtype=self.pd_dtype, usecols=self.usecols)
+        df = self._convert_datetime(self._add_prefix(df))
+        if self.vectorized:
+            self.sample = self.converter(df).iloc[0,:].to_dict()
+        else:
+            self.sample = self.converter(df.iloc[0,:].to_dict())
+    
+    def _convert_datetime(self, df):
+        """将DATE和DATETIME列中的字符串转换为date和datetime对象, 无法解析的值为None
+        """
         for column, datatype in self.dtype.items():
             if datatype == "DATE":
-                row[column] = timewrapper.str2date(row[column])
+                df[column] = parse_date_series(df[column], timewrapper)
             if datatype == "DATETIME":
-                row[column] = timewrapper.str2datetime(row[column])
-        self.sample = self.converter(row)
-        
+                df[column] = parse_datetime_series(df[column], timewrapper)
+        return df
+    
+    def _read_chunks(self, chunksize):
+        """从csv文件中按块读取DataFrame, 并完成日期转换和vectorized converter
+        """
+        chunks = pd.read_csv(self.abspath, 
+                             sep=self.sep, 
+                             header=self.header,
+                             dtype=self.pd_dtype,
+                             usecols=self.usecols, 
+                             iterator=True, 
+                             chunksize=chunksize)
+        with chunks:
+            for df in chunks:
+                df = self._convert_datetime(self._add_prefix(df))
+                if self.vectorized:
+                    df = self.converter(df)
+                yield df
+    
     def generate_rows(self, chunksize=1024):
         """从csv文件中生成row数据
+        
+        使用itertuples而不是iterrows, 并对每一块只计算一次列名, 避免为每一行构造
+        pandas.Series。
         """
-        for df in pd.read_csv(self.abspath, 
-                              sep=self.sep, 
-                              header=self.header,
-                              dtype=self.pd_dtype,
-                              usecols=self.usecols, 
-                              prefix=self.prefix,
-                              iterator=True, 
-                              chunksize=chunksize):
-            for column, datatype in self.dtype.items():
-                if datatype == "DATE":
-                    series = list()
-                    for i in df[column]:
-                        try:
-                            series.append(timewrapper.str2date(i))
-                        except:
-                            series.append(None)
-                    df[column] = series
-                if datatype == "DATETIME":
-                    series = list()
-                    for i in df[column]:
-                        try:
-                            series.append(timewrapper.str2datetime(i))
-                        except:
-                            series.append(None)
-                    df[column] = series
-                    
-            for _, series in df.iterrows():
-                yield self.converter( series.to_dict() )
+        for df in self._read_chunks(chunksize):
+            columns = list(df.columns)
+            if self.vectorized:
+                for values in df.itertuples(index=False, name=None):
+                    yield dict(zip(columns, values))
+            else:
+                converter = self.converter
+                for values in df.itertuples(index=False, name=None):
+                    yield converter(dict(zip(columns, values)))
+    
+    def generate_chunks(self, chunksize=1024*1024, columns=None, mode="dataframe"):
+        """chunk mode, 每次生成一整块数据, 适合交给Sqlite3Engine.insert_many_records等批量
+        写入的接口。
+        
+        [args]
+        ------
+            columns: 
+                按照这个列名的顺序输出, 例如数据库表中列的顺序。默认为csv中的顺序
+                
+            mode:
+                "dataframe": 生成pandas.DataFrame
+                "records": 生成list of tuple
+        
+        非vectorized的converter会对每一行的dict调用一次, 再重新组成DataFrame。
+        """
+        for df in self._read_chunks(chunksize):
+            if (not self.vectorized) and (self.converter is not self.do_nothing):
+                df_columns = list(df.columns)
+                df = pd.DataFrame([self.converter(dict(zip(df_columns, values))) 
+                                   for values in df.itertuples(index=False, name=None)])
+            if columns:
+                df = df[columns]
+            if mode == "records":
+                yield list(df.itertuples(index=False, name=None))
+            else:
+                yield df
         
 if __name__ == "__main__":
-    from angora.STRING.formatmaster import fmter
-    from sheet import Sheet
+    import unittest
+    import tempfile
+    import os
     from datetime import datetime, date
     
-    def create_testdata():
-        df = [["eid001", 100, 1.23, date.today(), datetime.now()]]
-        df = pd.DataFrame(df, columns=["TEXT", "INTEGER", "REAL", "DATE", "DATETIME"])
-        df.to_csv(r"testdata\with_header.txt", index=False)
-        df.to_csv(r"testdata\without_header.txt", header=False, index=False)
-    
-#     create_testdata()
-
-    # 定义你目标数据格式
-    sheet = Sheet({"_id": "TEXT", "age": "INTEGER", "height": "REAL", 
-                   "create_date": "DATE", "datetime": "DATETIME"})
-
-    csvfile_with_header = CSVFile(r"testdata\with_header.txt",
-                      sep=",",
-                      header=True,
-                      usecols=[0,1,2,3,4],
-                      dtype={"DATE": "DATE", "DATETIME": "DATETIME"})
-    sheet.match(csvfile_with_header.sample)
-    for row in csvfile_with_header.generate_rows():
-        print( sheet.convert(row) )
+    class CSVFileUnittest(unittest.TestCase):
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.with_header = os.path.join(self.dir, "with_header.txt")
+            self.without_header = os.path.join(self.dir, "without_header.txt")
+            with open(self.with_header, "w") as f:
+                f.write("_id,age,height,create_date,create_time\n")
+                for i in range(2500):
+                    f.write("eid%04d,%s,%s.5,1/%s/2014,2014-01-%02d 08:30:00\n" % (
+                        i, i % 90, i, i % 28 + 1, i % 28 + 1))
+            with open(self.with_header) as f_in, open(self.without_header, "w") as f_out:
+                f_out.writelines(f_in.readlines()[1:])
+            
+            self.dtype = {"_id": "TEXT", "age": "INTEGER", "height": "REAL", 
+                          "create_date": "DATE", "create_time": "DATETIME"}
+            self.first = {"_id": "eid0000", "age": 0, "height": 0.5, 
+                          "create_date": date(2014, 1, 1), 
+                          "create_time": datetime(2014, 1, 1, 8, 30)}
         
+        def tearDown(self):
+            for path in [self.with_header, self.without_header]:
+                os.remove(path)
+            os.rmdir(self.dir)
         
-    csvfile_without_header = CSVFile(r"testdata\without_header.txt",
-                      sep=",",
-                      header=False,
-                      usecols=[0,1,2,3,4],
-                      dtype={3: "DATE", 4: "DATETIME"})
-    sheet.match(csvfile_without_header.sample)
-    for row in csvfile_without_header.generate_rows():
-        print( sheet.convert(row) )
-
-    print("Complete")
\ No newline at end of file
+        def test_generate_rows(self):
+            csvfile = CSVFile(self.with_header, dtype=self.dtype)
+            self.assertDictEqual(csvfile.sample, self.first)
+            rows = list(csvfile.generate_rows(chunksize=1000))
+            self.assertEqual(len(rows), 2500)
+            self.assertDictEqual(rows[0], self.first)
+            self.assertEqual(rows[2499]["_id"], "eid2499")
+            self.assertEqual(rows[2499]["create_date"], date(2014, 1, 8))
+            
+            csvfile = CSVFile(self.without_header, header=False, usecols=[0, 3],
+                              dtype={0: "TEXT", 3: "DATE"})
+            self.assertDictEqual(next(csvfile.generate_rows()), 
+                                 {"column0": "eid0000", "column3": date(2014, 1, 1)})
+        
+        def test_generate_chunks(self):
+            csvfile = CSVFile(self.with_header, dtype=self.dtype)
+            chunks = list(csvfile.generate_chunks(chunksize=1000, columns=["age", "_id"], 
+                                                  mode="records"))
+            self.assertListEqual([len(chunk) for chunk in chunks], [1000, 1000, 500])
+            self.assertEqual(chunks[0][0], (0, "eid0000"))
+            self.assertEqual(chunks[2][-1], (2499 % 90, "eid2499"))
+            
+            chunks = list(csvfile.generate_chunks(chunksize=1000))
+            self.assertIsInstance(chunks[0], pd.DataFrame)
+            self.assertListEqual(list(chunks[0].columns), list(self.first))
+            self.assertEqual(sum([len(df) for df in chunks]), 2500)
+        
+        def test_converter(self):
+            """vectorized的converter和逐行的converter结果相同
+            """
+            def row_converter(row):
+                row["age"] = row["age"] * 2
+                row["tag"] = row["_id"].upper()
+                return row
+            
+            def df_converter(df):
+                df["age"] = df["age"] * 2
+                df["tag"] = df["_id"].str.upper()
+                return df
+            
+            results = list()
+            for converter, vectorized in [(row_converter, False), (df_converter, True)]:
+                csvfile = CSVFile(self.with_header, dtype=self.dtype)
+                csvfile.plugin_converter(converter, vectorized=vectorized)
+                rows = list(csvfile.generate_rows(chunksize=1000))
+                records = list()
+                for chunk in csvfile.generate_chunks(chunksize=1000, 
+                                                     columns=["_id", "age", "tag"], 
+                                                     mode="records"):
+                    records.extend(chunk)
+                results.append((rows, records))
+            
+            self.assertEqual(results[0], results[1])
+            rows, records = results[0]
+            self.assertEqual(rows[5]["age"], 10)
+            self.assertEqual(rows[5]["tag"], "EID0005")
+            self.assertEqual(records[5], ("eid0005", 10, "EID0005"))
+    
+    unittest.main()
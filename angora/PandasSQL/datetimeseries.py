@@ -0,0 +1,124 @@
+##encoding=UTF8
+
+"""
+author: Sanhe Hu
+
+compatibility: python3 ONLY
+
+prerequisites: pandas
+
+向量化的 日期/日期时间 字符串解析。
+
+TimeWrapper.str2date 对每个值调用 strptime, 最多尝试全部模板, 对于大文件来说是CPU瓶颈。
+这里先从样本中确定模板 (TimeWrapper.detect_date_template), 然后用
+pandas.to_datetime(format=template) 一次性转换整列; 只有转换失败的少数值, 才逐个回退到
+TimeWrapper的模板搜索。
+
+import:
+    from angora.PandasSQL.datetimeseries import (parse_date_series, parse_datetime_series,
+        isodatestr_series, isodatetimestr_series)
+"""
+
+from __future__ import print_function
+import pandas as pd
+
+def _parse_series(series, detect, sample_size):
+    """用detect从样本中确定模板, 向量化解析整列。返回 (parsed, failed_index)。
+    parsed是datetime64的Series, failed_index是非空但向量化解析失败的值的index。
+    如果没有模板能解析全部样本, 则使用能解析第一个样本的模板。
+    """
+    notnull = series.notnull()
+    sample = series[notnull].head(sample_size).tolist()
+    template = detect(sample) or detect(sample[:1])
+    if template:
+        parsed = pd.to_datetime(series, format=template, errors="coerce")
+    else:
+        parsed = pd.Series(pd.NaT, index=series.index, dtype="datetime64[ns]")
+    failed_index = series.index[(parsed.isnull() & notnull).values]
+    return parsed, failed_index
+
+def _fill_fallback(result, series, failed_index, fallback, errors):
+    """对向量化解析失败的值逐个使用fallback解析。errors="raise"时解析失败抛出异常,
+    errors="coerce"时设为None。
+    """
+    for i in failed_index:
+        try:
+            result[i] = fallback(series[i])
+        except:
+            if errors == "raise":
+                raise
+            result[i] = None
+    return result
+
+def parse_date_series(series, timewrapper, sample_size=100, errors="coerce"):
+    """convert a series of date string to a object series of datetime.date. Missing value
+    becomes None.
+    """
+    parsed, failed_index = _parse_series(series, timewrapper.detect_date_template, sample_size)
+    result = pd.Series(parsed.dt.date.values, index=series.index, dtype=object)
+    result[parsed.isnull().values] = None
+    return _fill_fallback(result, series, failed_index, timewrapper.str2date, errors)
+
+def parse_datetime_series(series, timewrapper, sample_size=100, errors="coerce"):
+    """convert a series of datetime string to a object series of datetime.datetime. Missing
+    value becomes None.
+    """
+    parsed, failed_index = _parse_series(series, timewrapper.detect_datetime_template, sample_size)
+    result = pd.Series(parsed.dt.to_pydatetime(), index=series.index, dtype=object)
+    result[parsed.isnull().values] = None
+    return _fill_fallback(result, series, failed_index, timewrapper.str2datetime, errors)
+
+def isodatestr_series(series, timewrapper, sample_size=100, errors="raise"):
+    """convert a series of date string to ISO date string "%Y-%m-%d", the same as
+    series.apply(timewrapper.isodatestr).
+    """
+    parsed, failed_index = _parse_series(series, timewrapper.detect_date_template, sample_size)
+    result = parsed.dt.strftime("%Y-%m-%d").astype(object)
+    result[parsed.isnull().values] = None
+    return _fill_fallback(result, series, failed_index, timewrapper.isodatestr, errors)
+
+def isodatetimestr_series(series, timewrapper, sample_size=100, errors="raise"):
+    """convert a series of datetime string to ISO datetime string, the same as
+    series.apply(timewrapper.isodatetimestr). 和str(datetime)一致, 只有当微秒不为0时才
+    保留微秒部分。
+    """
+    parsed, failed_index = _parse_series(series, timewrapper.detect_datetime_template, sample_size)
+    result = parsed.dt.strftime("%Y-%m-%d %H:%M:%S").astype(object)
+    has_microsecond = (parsed.dt.microsecond != 0).values
+    if has_microsecond.any():
+        result[has_microsecond] = parsed[has_microsecond].dt.strftime("%Y-%m-%d %H:%M:%S.%f")
+    result[parsed.isnull().values] = None
+    return _fill_fallback(result, series, failed_index, timewrapper.isodatetimestr, errors)
+
+if __name__ == "__main__":
+    import unittest
+    from angora.DATA.timewrapper import TimeWrapper, NoMatchingTemplateError
+    from datetime import datetime, date
+
+    class DateTimeSeriesUnittest(unittest.TestCase):
+        def test_parse_date_series(self):
+            s = pd.Series(["09/20/2014", "12/31/2014", None, "Sep 20, 2014", "bad"])
+            self.assertListEqual(parse_date_series(s, TimeWrapper()).tolist(),
+                [date(2014,9,20), date(2014,12,31), None, date(2014,9,20), None])
+            self.assertRaises(NoMatchingTemplateError,
+                              parse_date_series, s, TimeWrapper(), errors="raise")
+
+        def test_parse_datetime_series(self):
+            s = pd.Series(["2014-01-15 17:58:31", None, "1/15/2014 5:58:31 PM"])
+            self.assertListEqual(parse_datetime_series(s, TimeWrapper()).tolist(),
+                [datetime(2014,1,15,17,58,31), None, datetime(2014,1,15,17,58,31)])
+
+        def test_isostr_series(self):
+            tw = TimeWrapper()
+            s = pd.Series(["09/20/2014", "Sep 21, 2014", "1500-01-01"])
+            self.assertListEqual(isodatestr_series(s, tw).tolist(),
+                                 [tw.isodatestr(i) for i in s])
+
+            s = pd.Series(["2014-01-15 17:58:31", "2014-01-15 17:58:31.25",
+                           "2014-07-03 8:12:34 PM"])
+            self.assertListEqual(isodatetimestr_series(s, tw).tolist(),
+                                 [tw.isodatetimestr(i) for i in s])
+            self.assertRaises(NoMatchingTemplateError,
+                              isodatestr_series, pd.Series(["[2014][05][01]"]), tw)
+
+    unittest.main()
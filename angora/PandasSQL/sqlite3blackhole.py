@@ -12,12 +12,27 @@ import:
 
 """
 from __future__ import print_function
-from angora.SQLITE.core import MetaData, Sqlite3Engine, Table, Column, DataType
+from angora.SQLITE.core import MetaData, Sqlite3Engine, Table, Column, DataType, Select
+from angora.DATA.fingerprint import FingerPrint
 from angora.DATA.timewrapper import TimeWrapper
+from angora.PandasSQL.datetimeseries import isodatestr_series, isodatetimestr_series
+from angora.PandasSQL.typeinference import SchemaInference
 from angora.GADGET.logger import Messenger, Log
 from collections import deque
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import queue as _queue
+import os
 import pandas as pd, numpy as np
 
+def _column_name(i):
+    """没有header时, 第i列在数据库中的列名为 "c" + str(i)
+    """
+    if isinstance(i, str):
+        return i
+    return "c" + str(i)
+
 class CSVFile():
     """a CSV datafile class
     [args]
@@ -40,6 +55,14 @@ class CSVFile():
     primary_key_columns:
         a index list tells which columns are primary keys. for example you use [1, 4, 5] for 
         usecols. and you use [2] for primary_key_columns. means the sixth columns is primary key.
+    infer_dtype:
+        if True, infer the data type of the columns which are not defined in dtype from a sample
+        of the file, see angora.PandasSQL.typeinference.SchemaInference. pandas decides int64 
+        or float64 for the columns inferred as INTEGER, in case there's missing value or 
+        decimal out of the sample
+    
+    if header = False, column i is named "c" + str(i), both i and "c" + str(i) can be used in 
+    dtype and primary_key_columns.
     """
     def __init__(self, path, 
                  table_name = None, 
@@ -47,7 +70,8 @@ class CSVFile():
                  header = None,
                  usecols = None,
                  dtype = dict(), 
-                 primary_key_columns = list()):
+                 primary_key_columns = list(),
+                 infer_dtype = False):
         self.path = path
         self.table_name = table_name
         self.sep = sep
@@ -56,17 +80,31 @@ class CSVFile():
         else:
             self.header = None
         self.usecols = usecols
-        self.dtype = dtype
         # 强行转化为字符串, 确定表列index = 数据表中的列名, 且为合法字符串
-        self.primary_key_columns = list()
-        for i in primary_key_columns:
-            if not isinstance(i, str):
-                self.primary_key_columns.append("c" + str(i))
-            else:
-                self.primary_key_columns.append(i)
+        self.dtype = dict([(_column_name(i), data_type) for i, data_type in dtype.items()])
+        self.inferred_integer = set() # 推断为INTEGER的列, 由pandas决定使用int64还是float64
+        if infer_dtype: # 用户定义的dtype优先
+            inferred = SchemaInference(path, sep=sep, header=header, usecols=usecols).dtype
+            for i, data_type in inferred.items():
+                column_name = _column_name(i)
+                if column_name not in self.dtype:
+                    self.dtype[column_name] = data_type
+                    if data_type == "INTEGER":
+                        self.inferred_integer.add(column_name)
+        self.primary_key_columns = [_column_name(i) for i in primary_key_columns]
 
         self._read_metadata()
         self.timewrapper = None
+    
+    def __getstate__(self):
+        """CSVFile is sent to subprocess for parsing in Sqlite3BlackHole.devour(processes=n). 
+        metadata is bound to a sqlite3 connection, which cannot be pickled, and not needed for 
+        parsing.
+        """
+        state = self.__dict__.copy()
+        state.pop("metadata", None)
+        state.pop("table", None)
+        return state
         
     def _read_metadata(self):
         """construct the metadata for creating the database table
@@ -75,50 +113,49 @@ class CSVFile():
         datatype = DataType()
         
         ### map the CSV.dtype definition to pandas.read_csv dtype and sqlite3 dtype
-        _pd_dtype_mapping = {"TEXT": np.str, "INTEGER": np.int64, 
+        _pd_dtype_mapping = {"TEXT": str, "INTEGER": np.int64, 
                              "REAL": np.float64,
-                             "DATE": np.str, "DATETIME": np.str}
+                             "DATE": str, "DATETIME": str}
         _db_dtype_mapping = {"TEXT": datatype.text, "INTEGER": datatype.integer, 
                              "REAL": datatype.real, 
                              "DATE": datatype.date, "DATETIME": datatype.datetime}
 
-        pd_dtype = dict() # {"column_name": dtype} for part of columns, other columns using default setting
-        db_dtype = dict() # {"column_name": dtype} for all columns
-        for column_name, data_type in self.dtype.items():
-            if data_type in _pd_dtype_mapping:
-                pd_dtype[column_name] = _pd_dtype_mapping[data_type]
-            if data_type in _db_dtype_mapping:
-                db_dtype[column_name] = _db_dtype_mapping[data_type]        
-        
         ### Read one row, and extract column information from csv
         if self.usecols:
             df = pd.read_csv(self.path, sep=self.sep, header=self.header, 
-                             nrows=1, dtype=pd_dtype, usecols=self.usecols)
+                             nrows=1, usecols=self.usecols)
         else:
             df = pd.read_csv(self.path, sep=self.sep, header=self.header,
-                             nrows=1, dtype=pd_dtype)
+                             nrows=1)
         
         # 强行转化为字符串, 却表列index = 数据表中的列名, 且为合法字符串
-        new_columns = list()
-        for i in df.columns:
-            if not isinstance(i, str):
-                new_columns.append("c" + str(i))
-            else:
-                new_columns.append(i)
-        df.columns = new_columns
+        # pandas.read_csv的dtype仍然使用原来的列名 (没有header时为列序号)
+        raw_columns = dict([(_column_name(i), i) for i in df.columns])
+        df.columns = [_column_name(i) for i in df.columns]
+        
+        pd_dtype = dict() # {"column_name": dtype} for part of columns, other columns using default setting
+        db_dtype = dict() # {"column_name": dtype} for all columns
+        for column_name, data_type in self.dtype.items():
+            if column_name not in raw_columns:
+                continue
+            if (data_type in _pd_dtype_mapping) and (column_name not in self.inferred_integer):
+                pd_dtype[raw_columns[column_name]] = _pd_dtype_mapping[data_type]
+            if data_type in _db_dtype_mapping:
+                db_dtype[column_name] = _db_dtype_mapping[data_type]        
         
         ### Define the right data type in database for each column
         for column_name, data_type in zip(df.columns, df.dtypes):
             if column_name not in db_dtype:
-                if data_type in [np.object,]:
-                    db_dtype.setdefault(column_name, datatype.text)
-                elif data_type in [np.int64, np.int32, np.int16, np.int8, np.int0, np.int]:
+                if pd.api.types.is_integer_dtype(data_type):
                     db_dtype.setdefault(column_name, datatype.integer)
-                elif data_type in [np.float64, np.float32, np.float16, np.float]:
+                elif pd.api.types.is_float_dtype(data_type):
                     db_dtype.setdefault(column_name, datatype.real)
+                else: # object, 或者新版本pandas中的字符串类型
+                    db_dtype.setdefault(column_name, datatype.text)
         
         self.pd_dtype = pd_dtype
         self.db_dtype = db_dtype
+        self.column_names = list(df.columns)
         
         ### Construct Database.Table Metadata
         columns = list()
@@ -132,41 +169,181 @@ class CSVFile():
         Table(self.table_name, self.metadata, *columns)
         self.table = self.metadata.tables[self.table_name]
 
-    def generate_records(self, chunksize=1000*1000):
-        """generator for sqlite3 database friendly record from a data file
+    def generate_chunks(self, chunksize=1000*1000, skiprows=0, offset=0):
+        """generator for list of sqlite3 database friendly records, each list is one chunk of 
+        the data file. the first #skiprows data rows (header not included) are skipped, used for 
+        resuming from a checkpoint.
+        
+        if offset > 0, seek to byte #offset and only parse the content after it, used for loading
+        the new lines appended to a file. the content before offset has to end with a newline.
         """
+        if offset: # offset之后没有header, 使用文件原来的列名
+            names = list(pd.read_csv(self.path, sep=self.sep, header=self.header, 
+                                     nrows=1).columns)
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                chunks = pd.read_csv(f, 
+                                     sep=self.sep, 
+                                     header=None,
+                                     names=names,
+                                     dtype=self.pd_dtype,
+                                     usecols=self.usecols, 
+                                     iterator=True, 
+                                     chunksize=chunksize)
+                with chunks:
+                    for records in self._convert_chunks(chunks):
+                        yield records
+            return
+        
+        if skiprows:
+            if self.header is None:
+                skiprows = range(skiprows)
+            else: # 保留header行
+                skiprows = range(1, skiprows + 1)
+        else:
+            skiprows = None
         if self.usecols:
-            for df in pd.read_csv(self.path, 
-                                  sep=self.sep, 
-                                  header=self.header,
-                                  dtype=self.pd_dtype,
-                                  usecols=self.usecols, 
-                                  iterator=True, 
-                                  chunksize=chunksize):
-                for column_name, dtype in self.db_dtype.items(): # 修改Date和DateTime列的dtype
-                    if dtype.name == "DATE": # 转换为 datestr
-                        df[column_name] = df[column_name].apply(self.timewrapper.isodatestr)
-                    if dtype.name == "DATETIME": # 转换为 datetimestr
-                        df[column_name] = df[column_name].apply(self.timewrapper.isodatetimestr)
-                        
-                for record in df.values:
-                    yield record
+            chunks = pd.read_csv(self.path, 
+                                 sep=self.sep, 
+                                 header=self.header,
+                                 dtype=self.pd_dtype,
+                                 usecols=self.usecols, 
+                                 skiprows=skiprows,
+                                 iterator=True, 
+                                 chunksize=chunksize)
         else:
-            for df in pd.read_csv(self.path, 
-                                  sep=self.sep,
-                                  header=self.header,
-                                  dtype=self.pd_dtype,
-                                  iterator=True, 
-                                  chunksize=chunksize):
-                for column_name, dtype in self.db_dtype.items(): # 修改Date和DateTime列的dtype
-                    if dtype.name == "DATE": # 转换为 datestr
-                        df[column_name] = df[column_name].apply(self.timewrapper.isodatestr)
-                    if dtype.name == "DATETIME": # 转换为 datetimestr
-                        df[column_name] = df[column_name].apply(self.timewrapper.isodatetimestr)
-                
-                for record in df.values:
-                    yield record
-                    
+            chunks = pd.read_csv(self.path, 
+                                 sep=self.sep,
+                                 header=self.header,
+                                 dtype=self.pd_dtype,
+                                 skiprows=skiprows,
+                                 iterator=True, 
+                                 chunksize=chunksize)
+        with chunks: # 没有读完就被放弃时, 关闭文件
+            for records in self._convert_chunks(chunks):
+                yield records
+    
+    def _convert_chunks(self, chunks):
+        """convert DataFrame chunks to list of records, DATE and DATETIME columns are normalized
+        to iso format string
+        """
+        for df in chunks:
+            df.columns = self.column_names
+            for column_name, dtype in self.db_dtype.items(): # 修改Date和DateTime列的dtype
+                if dtype.name == "DATE": # 转换为 datestr
+                    df[column_name] = isodatestr_series(df[column_name], self.timewrapper)
+                if dtype.name == "DATETIME": # 转换为 datetimestr
+                    df[column_name] = isodatetimestr_series(df[column_name], self.timewrapper)
+            yield df.values.tolist()
+    
+    def generate_records(self, chunksize=1000*1000):
+        """generator for sqlite3 database friendly record from a data file
+        """
+        for records in self.generate_chunks(chunksize):
+            for record in records:
+                yield record
+
+class Checkpoint():
+    """a table in the target database which records the loading progress of each file, 
+    so Sqlite3BlackHole can resume an interrupted load.
+    
+    [CN]每个文件一行: 文件内容的指纹, 已经commit的数据行数, 是否已经全部导入, 最后一次的错误信息,
+    以及导入时文件的大小和修改时间。每写完一块数据, 就在同一个事务中更新该文件的行数并commit, 
+    所以数据和进度总是一致的。因此checkpoint模式下, bulk_load不会定期commit, 每块数据在一个
+    SAVEPOINT中写入, 写入出错时整块回滚之后才记录错误。文件以绝对路径记录, 所以用相对路径和绝对路径添加的同一个文件
+    对应同一行。
+    """
+    def __init__(self, engine, table_name="blackhole_checkpoint"):
+        self.engine = engine
+        datatype = DataType()
+        metadata = MetaData()
+        self.table = Table(table_name, metadata, 
+            Column("path", datatype.text, primary_key=True),
+            Column("fingerprint", datatype.text),
+            Column("nrows", datatype.integer),
+            Column("finished", datatype.integer),
+            Column("error", datatype.text),
+            Column("size", datatype.integer),
+            Column("mtime", datatype.real),
+            Column("update_time", datatype.datetime),
+            )
+        metadata.create_all(engine)
+        self.ins = self.table.insert()
+        self.fingerprint = FingerPrint()
+    
+    def get(self, path):
+        """return (fingerprint, nrows, finished, size, mtime) of the file, or None if never loaded
+        """
+        sel = Select([self.table.fingerprint, self.table.nrows, self.table.finished, 
+                      self.table.size, self.table.mtime]).where(
+                          self.table.path == os.path.abspath(path))
+        for fingerprint, nrows, finished, size, mtime in self.engine.select(sel):
+            return fingerprint, nrows, bool(finished), size, mtime
+    
+    def save(self, datafile, finished=False, error=None):
+        """record the progress of a file. not committed until the chunk is committed
+        """
+        self.engine.upsert_many_records(self.ins, 
+            [(os.path.abspath(datafile.path), datafile.fingerprint, datafile.nrows, int(finished), error, 
+              datafile.size, datafile.mtime, datetime.now())])
+    
+    def start(self, datafile, incremental=False):
+        """计算文件的指纹, 返回需要跳过的行数。文件已经全部导入且内容没有变化时, 返回None。
+        文件内容变化时, 从头开始导入。
+        
+        incremental = True时, 用于只会在末尾追加数据的文件:
+            1. 大小和修改时间都没有变化的已完成文件, 不计算指纹直接跳过。
+            2. 文件变大, 且前size个字节的指纹和上次导入时的指纹一致, 则只导入新增的行。如果上次
+            导入的内容以换行符结尾, 设置datafile.offset, 直接seek到新增内容处开始解析。否则上次
+            导入的最后一行可能只写了一半, 返回nrows - 1并设置datafile.reload_last_row, 重新导入
+            该行并用upsert覆盖之前的值 (表需要有primary key)。
+        """
+        stat = os.stat(datafile.path)
+        datafile.size, datafile.mtime, datafile.offset = stat.st_size, stat.st_mtime, 0
+        datafile.reload_last_row = False
+        progress = self.get(datafile.path)
+        
+        if incremental and (progress is not None) and progress[2]:
+            fingerprint, nrows, finished, size, mtime = progress
+            if (size, mtime) == (datafile.size, datafile.mtime):
+                datafile.fingerprint = fingerprint
+                return None
+            if (size is not None) and (datafile.size > size):
+                prefix_fingerprint, datafile.fingerprint = \
+                    self.fingerprint.of_file_and_prefix(datafile.path, size)
+                if prefix_fingerprint != fingerprint: # 不是追加, 从头开始导入
+                    return 0
+                with open(datafile.path, "rb") as f:
+                    f.seek(size - 1)
+                    if f.read(1) == b"\n":
+                        datafile.offset = size
+                        return nrows
+                if nrows == 0:
+                    return 0
+                datafile.reload_last_row = True
+                return nrows - 1
+        
+        datafile.fingerprint = self.fingerprint.of_file(datafile.path, chunk_size=2**20)
+        if (progress is None) or (progress[0] != datafile.fingerprint):
+            return 0
+        fingerprint, nrows, finished, size, mtime = progress
+        if finished:
+            return None
+        return nrows
+    
+
+def _parse_datafile(key, datafile, queue, chunksize, skiprows=0, offset=0):
+    """在子进程中解析datafile, 每解析完一块就把 (key, records) 放入queue。
+    全部解析完时放入 (key, None), 出错时放入 (key, exception)。
+    """
+    try:
+        for records in datafile.generate_chunks(chunksize, skiprows, offset):
+            queue.put((key, records))
+        queue.put((key, None))
+    except Exception as e:
+        queue.put((key, e))
+    
+
 class Sqlite3BlackHole():
     """a CSV data to Sqlite3 database engine. Can take data into database in two mode:
     1. devour: map CSV file to a table, if meet sqlite3.IntegrityError, skip it
@@ -185,7 +362,31 @@ class Sqlite3BlackHole():
         sqlite3blackhole.add(csvfile)
         ... add more file
         sqlite3blackhold.devour()
-        
+    
+    devour and update can use many processes to parse csv files in parallel:
+    
+        sqlite3blackhold.devour(processes=4)
+    
+    [CN]此时每个子进程负责解析一个文件, 把解析好的数据块放入该文件的有界队列; 主线程是唯一的写入者, 
+    按照文件添加的顺序, 依次从各个文件的队列中取出数据块并用executemany批量写入数据库。这样既遵守了
+    sqlite3单写的限制, 又能用所有的CPU核心解析数据, 而且多个文件中有相同主键时, 结果和单进程模式
+    一样。队列的长度由queue_size控制, 同时最多有processes个文件在解析, 以限制内存的使用。
+
+    for large daily data drops, use checkpoint to make the load resumable:
+
+        sqlite3blackhold.devour(checkpoint=True)
+
+    [CN]每个文件的指纹和已经导入的行数被记录在数据库的blackhole_checkpoint表中。中断后重新运行时,
+    内容没有变化且已经导入完成的文件会被整个跳过, 未完成的文件从最后一次commit的数据块之后继续导入。
+
+    for directories which are scanned again and again, and files only grow by appending lines:
+
+        fcs = FileCollections.from_path(r"daily_drop")
+        sqlite3blackhole.add_files(fcs, table_name="employee", header=True)
+        sqlite3blackhold.devour(incremental=True)
+
+    [CN]大小和修改时间都没有变化的文件不需要读取就可以跳过; 变大的文件, 只要之前导入的部分没有
+    被修改, 就只导入新增的行。
     """
     def __init__(self, dbname):
         self.engine = Sqlite3Engine(dbname)
@@ -194,45 +395,559 @@ class Sqlite3BlackHole():
         self.timewrapper = TimeWrapper()
         self.messenger = Messenger()
         self.log = Log()
+        self.checkpoint = None
+        self.incremental = False
         
     def add(self, datafile):
         """add datafile object to data pipeline
         """
         datafile.timewrapper = self.timewrapper
         self.pipeline.append(datafile)
+    
+    def add_files(self, file_collections, **kwargs):
+        """add all files in a angora.LIBRARIAN.windowsexplorer.FileCollections to data pipeline,
+        kwargs are passed to CSVFile. for example:
         
-    def devour(self):
+            fcs = FileCollections.from_path_by_criterion(r"daily_drop", 
+                                                         lambda winfile: winfile.ext == ".csv")
+            sqlite3blackhole.add_files(fcs, table_name="employee", header=True)
+        """
+        for winfile in file_collections.iterfiles():
+            self.add(CSVFile(winfile.abspath, **kwargs))
+        
+    def devour(self, profile=None, commit_every=100000, 
+               processes=1, chunksize=100000, queue_size=8, checkpoint=False, 
+               incremental=False):
         """if sqlite3.IntegrityError been raised, skip the record.
+        
+        all files are loaded in Sqlite3Engine.bulk_load(profile, commit_every) mode, commit
+        every #commit_every records instead of every file. if profile is None, use "fast" only 
+        when all the target tables are new or empty, otherwise "safe", because "fast" may 
+        corrupt the existing data on a crash, see angora.SQLITE.core.PRAGMA_PROFILES
+        
+        if processes > 1, parse files in #processes processes in parallel, see Sqlite3BlackHole
+        
+        if checkpoint = True, the progress of each file is recorded in a Checkpoint table after 
+        every chunk. Loading the same files again skips unchanged files which are already 
+        finished, and resumes unfinished files from the last committed chunk. A checkpoint is 
+        only useful if committed chunks survive a crash, so profile is always "safe" in this mode.
+        commit_every is ignored, every chunk is committed together with its progress.
+        
+        if incremental = True, files are treated as append-only (implies checkpoint = True). 
+        files which have grown since the last load only have the new lines loaded, see 
+        Checkpoint.start
         """
-        while len(self.pipeline) >= 1:
-            self.messenger.show("%s files to process..." % len(self.pipeline))
-            datafile = self.pipeline.popleft()
-            self.messenger.show("now processing %s..." % datafile.path)
-            datafile.metadata.create_all(self.engine)
-            
-            try:
-                ins = datafile.table.insert()
-                # insert only, if failed, do nothing
-                self.engine.insert_many_records(ins, datafile.generate_records())
-                self.messenger.show("\tfinished!")
-            except:
-                self.log.write(datafile.path)
+        # insert only, if failed, do nothing
+        self._ingest(self.engine.insert_many_records, 
+                     profile, commit_every, processes, chunksize, queue_size, 
+                     checkpoint, incremental)
     
-    def update(self):
+    def update(self, profile=None, commit_every=100000, 
+               processes=1, chunksize=100000, queue_size=8, checkpoint=False, 
+               incremental=False):
         """unlike Sqlite3BlackHole.devour(), if sqlite3.IntegrityError been raised, 
         update the record.
         """
+        # insert and update, in one INSERT ... ON CONFLICT DO UPDATE pass
+        self._ingest(self.engine.upsert_many_records, 
+                     profile, commit_every, processes, chunksize, queue_size, 
+                     checkpoint, incremental)
+    
+    def _targets_are_empty(self):
+        """pipeline中所有文件的目标表都还不存在, 或者为空
+        """
+        for table_name in set([datafile.table_name for datafile in self.pipeline]):
+            if self.engine.cursor.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", 
+                    (table_name,)).fetchone() is None:
+                continue
+            if self.engine.cursor.execute(
+                    "SELECT 1 FROM %s LIMIT 1" % table_name).fetchone() is not None:
+                return False
+        return True
+    
+    def _start(self, datafile):
+        """返回datafile需要跳过的行数, None表示整个文件都可以跳过
+        """
+        datafile.nrows, datafile.offset, datafile.reload_last_row = 0, 0, False
+        if self.checkpoint is None:
+            return 0
+        skiprows = self.checkpoint.start(datafile, self.incremental)
+        if skiprows is None:
+            self.messenger.show("\t%s unchanged, skip!" % datafile.path)
+        elif datafile.reload_last_row:
+            datafile.nrows = skiprows
+            self.messenger.show("\t%s reload the last row and load appended lines..." % (
+                datafile.path))
+        elif datafile.offset:
+            datafile.nrows = skiprows
+            self.messenger.show("\t%s load appended lines from byte %s..." % (datafile.path, 
+                                                                            datafile.offset))
+        elif skiprows:
+            datafile.nrows = skiprows
+            self.messenger.show("\t%s resume from row %s..." % (datafile.path, skiprows))
+        return skiprows
+    
+    def _write(self, write, datafile, ins, records, chunksize):
+        """写入一块数据。checkpoint模式下, 整块数据在一个SAVEPOINT中写入, 出错时整块回滚, 
+        使已经写入的数据和记录的行数一致
+        """
+        if self.checkpoint is None:
+            self._write_records(write, datafile, ins, records, chunksize)
+        else:
+            with self.engine.savepoint("blackhole_chunk"):
+                self._write_records(write, datafile, ins, records, chunksize)
+    
+    def _write_records(self, write, datafile, ins, records, chunksize):
+        """上次导入的最后一行需要重新导入时, 该行用upsert写入
+        """
+        if datafile.reload_last_row:
+            datafile.reload_last_row = False
+            self.engine.upsert_many_records(ins, records[:1], chunksize)
+            records = records[1:]
+        write(ins, records, chunksize)
+    
+    def _progress(self, datafile, n, finished=False, error=None):
+        """数据块写入后, 在同一个事务中记录进度并commit
+        """
+        datafile.nrows += n
+        if self.checkpoint is not None:
+            self.checkpoint.save(datafile, finished, error)
+            self.engine.commit()
+        if error is not None:
+            self.log.write(datafile.path)
+    
+    def _ingest(self, write, profile, commit_every, processes, chunksize, queue_size, 
+                checkpoint, incremental):
+        """empty the pipeline, write all records into database by write method
+        """
+        self.incremental = incremental
+        checkpoint = checkpoint or incremental
+        if profile is None: # 只有从零开始构建的表才使用"fast"
+            profile = "fast" if self._targets_are_empty() else "safe"
+        if checkpoint: # "fast"模式下 (journal_mode=MEMORY, synchronous=OFF) 崩溃会损坏数据库
+            profile = "safe"
+        if checkpoint and (self.checkpoint is None):
+            self.checkpoint = Checkpoint(self.engine)
+        elif not checkpoint:
+            self.checkpoint = None
+        
+        if checkpoint: # 只在_progress中和进度一起commit
+            commit_every = None
+        with self.engine.bulk_load(profile, commit_every):
+            if processes > 1:
+                self._ingest_parallel(write, processes, chunksize, queue_size)
+                return
+            
+            while len(self.pipeline) >= 1:
+                self.messenger.show("%s files to process..." % len(self.pipeline))
+                datafile = self.pipeline.popleft()
+                self.messenger.show("now processing %s..." % datafile.path)
+                datafile.metadata.create_all(self.engine)
+                skiprows = self._start(datafile)
+                if skiprows is None:
+                    continue
+                
+                try:
+                    ins = datafile.table.insert()
+                    for records in datafile.generate_chunks(chunksize, skiprows, 
+                                                            datafile.offset):
+                        self._write(write, datafile, ins, records, chunksize)
+                        self._progress(datafile, len(records))
+                    self._progress(datafile, 0, finished=True)
+                    self.messenger.show("\tfinished!")
+                except Exception as e:
+                    self._progress(datafile, 0, error=repr(e))
+    
+    def _ingest_parallel(self, write, processes, chunksize, queue_size):
+        """子进程解析文件, 主线程作为唯一的写入者从有界队列中取出数据块写入数据库
+        """
+        datafiles, skiprows = dict(), dict()
         while len(self.pipeline) >= 1:
-            self.messenger.show("%s files to process..." % len(self.pipeline))
             datafile = self.pipeline.popleft()
-            self.messenger.show("now processing %s..." % datafile.path)
             datafile.metadata.create_all(self.engine)
+            skip = self._start(datafile)
+            if skip is not None:
+                skiprows[len(datafiles)] = skip
+                datafiles[len(datafiles)] = datafile
+        self.messenger.show("%s files to process with %s processes..." % (len(datafiles), 
+                                                                          processes))
+        
+        manager = multiprocessing.Manager()
+        executor = ProcessPoolExecutor(processes)
+        try:
+            # 每个文件一个有界队列。进程池按提交的顺序执行, 所以正在写入的文件总是已经在解析
+            queues, futures = dict(), dict()
+            for key, datafile in datafiles.items():
+                queues[key] = manager.Queue(queue_size)
+                futures[key] = executor.submit(_parse_datafile, key, datafile, queues[key], 
+                                               chunksize, skiprows[key], datafile.offset)
             
-            try:
+            # 按照pipeline的顺序写入, 相同主键的结果和单进程模式一致
+            for key, datafile in datafiles.items():
                 ins = datafile.table.insert()
-                # insert and update
-                self.engine.insert_and_update_many_records(ins, datafile.generate_records())
-                self.messenger.show("\tfinished!")
-            except:
-                self.log.write(datafile.path)
+                failed = False
+                while 1:
+                    try:
+                        _, records = queues[key].get(timeout=1)
+                    except _queue.Empty: # 检查文件是否没能被送到子进程中解析
+                        if futures[key].done() and futures[key].exception() is not None:
+                            self._progress(datafile, 0, error=repr(futures[key].exception()))
+                            break
+                        continue
+                    
+                    if records is None:
+                        if not failed:
+                            self._progress(datafile, 0, finished=True)
+                            self.messenger.show("\t%s finished!" % datafile.path)
+                        break
+                    elif isinstance(records, Exception):
+                        self._progress(datafile, 0, error=repr(records))
+                        break
+                    elif not failed: # 写入失败后, 和单进程模式一样, 放弃该文件剩余的数据
+                        try:
+                            self._write(write, datafile, ins, records, chunksize)
+                            self._progress(datafile, len(records))
+                        except Exception as e:
+                            failed = True
+                            self._progress(datafile, 0, error=repr(e))
+                    # 写入失败后仍然取完该文件的队列, 使子进程结束, 释放进程池
+        finally:
+            # 先关闭队列, 使得仍在等待put的子进程出错退出, 再关闭进程池
+            manager.shutdown()
+            executor.shutdown()
 
+if __name__ == "__main__":
+    import unittest
+    import tempfile
+    import shutil
+    from datetime import date
+    
+    def write_csv(path, n, bad_row=None, name="name", start=0):
+        """写一个有header的测试文件: id, name, age, start_date"""
+        with open(path, "w") as f:
+            f.write("id,name,age,start_date\n")
+            for i in range(start, start + n):
+                age = "abc" if i == bad_row else str(i % 90)
+                f.write("e%05d,%s%s,%s,%s/%s/2014\n" % (i, name, i, age, i % 12 + 1, i % 28 + 1))
+    
+    def new_csvfile(path, table_name="employee"):
+        return CSVFile(path, table_name=table_name, header=True, 
+                       dtype={"id": "TEXT", "age": "INTEGER", "start_date": "DATE"},
+                       primary_key_columns=["id"])
+    
+    class BlackHoleTestCase(unittest.TestCase):
+        def setUp(self):
+            self.cwd = os.getcwd()
+            self.dir = tempfile.mkdtemp()
+            os.chdir(self.dir) # Log会在当前目录下创建log目录
+        
+        def tearDown(self):
+            os.chdir(self.cwd)
+            shutil.rmtree(self.dir)
+        
+        def path(self, filename):
+            return os.path.join(self.dir, filename)
+        
+        def blackhole(self, dbname=":memory:"):
+            bh = Sqlite3BlackHole(dbname)
+            bh.messenger.off()
+            return bh
+        
+        def load_profile(self, bh, method="devour", **kwargs):
+            """调用bh.devour或者bh.update, 返回所使用的bulk_load profile"""
+            profiles = list()
+            bulk_load = bh.engine.bulk_load
+            def record_profile(profile, commit_every):
+                profiles.append(profile)
+                return bulk_load(profile, commit_every)
+            bh.engine.bulk_load = record_profile
+            getattr(bh, method)(**kwargs)
+            del bh.engine.bulk_load
+            self.assertEqual(len(profiles), 1)
+            return profiles[0]
+        
+        def rows(self, bh, table_name="employee"):
+            return sorted(bh.engine.cursor.execute("SELECT * FROM %s" % table_name).fetchall())
+        
+        def progress(self, bh):
+            """{filename: (nrows, finished, has_error)}"""
+            return dict([(os.path.basename(path), (nrows, finished, error is not None)) \
+                         for path, nrows, finished, error in bh.engine.cursor.execute(
+                             "SELECT path, nrows, finished, error FROM blackhole_checkpoint")])
+    
+    class ParallelUnittest(BlackHoleTestCase):
+        def load(self, processes, filenames, checkpoint=True):
+            bh = self.blackhole()
+            for filename in filenames:
+                bh.add(new_csvfile(self.path(filename)))
+            bh.devour(processes=processes, chunksize=300, checkpoint=checkpoint)
+            return bh
+        
+        def test_same_result(self):
+            """多进程和单进程导入的结果完全相同
+            """
+            for i, n in enumerate([2000, 1500, 10]):
+                write_csv(self.path("%s.csv" % i), n)
+            filenames = ["0.csv", "1.csv", "2.csv"]
+            bh1, bh4 = self.load(1, filenames), self.load(4, filenames)
+            self.assertEqual(len(self.rows(bh1)), 2000) # id有重复, 只保留第一次出现的
+            self.assertListEqual(self.rows(bh1), self.rows(bh4))
+            self.assertEqual(self.rows(bh1)[0], ("e00000", "name0", 0, date(2014, 1, 1)))
+            self.assertEqual(self.progress(bh4), {"0.csv": (2000, 1, False), 
+                "1.csv": (1500, 1, False), "2.csv": (10, 1, False)})
+        
+        def test_file_order(self):
+            """多个文件中有相同主键, 但内容不同时, 多进程也按照文件添加的顺序写入
+            """
+            write_csv(self.path("big.csv"), 3000, name="big")
+            write_csv(self.path("small.csv"), 100, name="small", start=2900) # 解析得快, 但后写入
+            for method, winner in [("devour", "big"), ("update", "small")]:
+                results = list()
+                for processes in [1, 4]:
+                    bh = self.blackhole()
+                    bh.add(new_csvfile(self.path("big.csv")))
+                    bh.add(new_csvfile(self.path("small.csv")))
+                    getattr(bh, method)(processes=processes, chunksize=300, checkpoint=True)
+                    results.append(self.rows(bh))
+                    self.assertEqual(self.progress(bh), {"big.csv": (3000, 1, False), 
+                                                         "small.csv": (100, 1, False)})
+                self.assertListEqual(results[0], results[1])
+                self.assertEqual(len(results[0]), 3000)
+                self.assertEqual(results[0][2950][1], winner + "2950")
+                self.assertEqual(results[0][2850][1], "big2850")
+        
+        def test_parse_error(self):
+            """子进程解析出错时, 已经写入的数据块保留, 错误被记录, 其他文件不受影响
+            """
+            write_csv(self.path("good.csv"), 1000)
+            write_csv(self.path("bad.csv"), 1000, bad_row=700)
+            filenames = ["bad.csv", "good.csv"]
+            bh1, bh4 = self.load(1, filenames), self.load(4, filenames)
+            self.assertListEqual(self.rows(bh1), self.rows(bh4))
+            for bh in [bh1, bh4]:
+                self.assertEqual(self.progress(bh), {"good.csv": (1000, 1, False),
+                                                     "bad.csv": (600, 0, True)})
+        
+        def test_write_error(self):
+            """写入出错时 (数据库中已经存在的同名表缺少列), 放弃该文件剩余的数据
+            """
+            write_csv(self.path("good.csv"), 1000)
+            write_csv(self.path("bad.csv"), 1000)
+            for processes in [1, 4]:
+                bh = self.blackhole()
+                bh.engine.cursor.execute("CREATE TABLE broken (id TEXT PRIMARY KEY)")
+                bh.add(new_csvfile(self.path("bad.csv"), table_name="broken"))
+                bh.add(new_csvfile(self.path("good.csv")))
+                bh.devour(processes=processes, chunksize=300, checkpoint=True)
+                self.assertEqual(len(self.rows(bh)), 1000)
+                self.assertEqual(self.rows(bh, "broken"), [])
+                self.assertEqual(self.progress(bh), {"good.csv": (1000, 1, False),
+                                                     "bad.csv": (0, 0, True)})
+    
+    class CheckpointUnittest(BlackHoleTestCase):
+        def test_safe_profile(self):
+            """checkpoint和incremental模式总是使用"safe" profile
+            """
+            write_csv(self.path("0.csv"), 100)
+            for kwargs, expected in [(dict(), "fast"), (dict(checkpoint=True), "safe"),
+                                     (dict(incremental=True), "safe")]:
+                bh = self.blackhole()
+                bh.add(new_csvfile(self.path("0.csv")))
+                self.assertEqual(self.load_profile(bh, **kwargs), expected)
+                self.assertEqual(len(self.rows(bh)), 100)
+        
+        def test_default_profile(self):
+            """默认只有目标表不存在或者为空时才使用"fast"
+            """
+            write_csv(self.path("0.csv"), 100)
+            bh = self.blackhole()
+            bh.engine.cursor.execute("CREATE TABLE other (id TEXT)")
+            bh.engine.cursor.execute("INSERT INTO other VALUES ('a')")
+            bh.add(new_csvfile(self.path("0.csv"))) # 新表
+            self.assertEqual(self.load_profile(bh), "fast")
+            bh.engine.cursor.execute("DELETE FROM employee")
+            bh.engine.commit()
+            bh.add(new_csvfile(self.path("0.csv"))) # 空表
+            self.assertEqual(self.load_profile(bh, "update"), "fast")
+            for method in ["devour", "update"]: # 已经有数据的表
+                bh.add(new_csvfile(self.path("0.csv")))
+                self.assertEqual(self.load_profile(bh, method), "safe")
+            bh.add(new_csvfile(self.path("0.csv")))
+            self.assertEqual(self.load_profile(bh, "update", profile="fast"), "fast")
+            self.assertEqual(len(self.rows(bh)), 100)
+        
+        def test_crash_between_write_and_progress(self):
+            """写入一块数据之后, 记录进度之前崩溃, 已经commit的数据和记录的行数一致
+            """
+            write_csv(self.path("0.csv"), 100)
+            dbname = self.path("test.db")
+            bh = self.blackhole(dbname)
+            progress, calls = bh._progress, list()
+            def crash(datafile, n, finished=False, error=None):
+                calls.append(n)
+                if len(calls) == 3:
+                    raise KeyboardInterrupt
+                progress(datafile, n, finished, error)
+            bh._progress = crash
+            bh.add(new_csvfile(self.path("0.csv")))
+            self.assertRaises(KeyboardInterrupt, bh.devour, 
+                              chunksize=30, commit_every=30, checkpoint=True)
+            bh.engine.connect.close()
+            
+            bh = self.blackhole(dbname)
+            self.assertEqual(len(self.rows(bh)), 60)
+            self.assertEqual(self.progress(bh), {"0.csv": (60, 0, False)})
+            bh.add(new_csvfile(self.path("0.csv")))
+            bh.devour(chunksize=30, checkpoint=True) # 从第60行继续
+            self.assertEqual(len(self.rows(bh)), 100)
+            self.assertEqual(self.progress(bh), {"0.csv": (100, 1, False)})
+            bh.engine.connect.close()
+        
+        def test_write_error_rollback(self):
+            """一块数据只写入了一部分就出错时, 整块回滚, 已经写入的数据和记录的行数一致
+            """
+            write_csv(self.path("0.csv"), 100)
+            for processes in [1, 4]:
+                bh = self.blackhole()
+                insert_many_records = bh.engine.insert_many_records
+                def half_write(ins, records, chunksize):
+                    if records[0][0] == "e00060":
+                        insert_many_records(ins, records[:10], chunksize)
+                        raise RuntimeError("disk full")
+                    return insert_many_records(ins, records, chunksize)
+                bh.engine.insert_many_records = half_write
+                bh.add(new_csvfile(self.path("0.csv")))
+                bh.devour(processes=processes, chunksize=30, checkpoint=True)
+                self.assertEqual(len(self.rows(bh)), 60)
+                self.assertEqual(self.progress(bh), {"0.csv": (60, 0, True)})
+        
+        def test_abspath(self):
+            """相对路径和绝对路径添加的同一个文件共用一条checkpoint记录
+            """
+            write_csv(self.path("0.csv"), 100)
+            bh = self.blackhole(self.path("test.db"))
+            bh.add(new_csvfile("0.csv"))
+            bh.devour(checkpoint=True)
+            bh.engine.cursor.execute("DELETE FROM employee")
+            bh.engine.commit()
+            bh.add(new_csvfile(self.path("0.csv")))
+            bh.devour(checkpoint=True) # 已经完成, 整个文件被跳过
+            self.assertEqual(self.rows(bh), [])
+            self.assertEqual(bh.engine.cursor.execute(
+                "SELECT path FROM blackhole_checkpoint").fetchall(), 
+                [(os.path.abspath("0.csv"),)])
+            bh.engine.connect.close()
+    
+    class IncrementalUnittest(BlackHoleTestCase):
+        def setUp(self):
+            BlackHoleTestCase.setUp(self)
+            self.bh = self.blackhole(self.path("test.db"))
+            
+        def tearDown(self):
+            self.bh.engine.connect.close()
+            BlackHoleTestCase.tearDown(self)
+        
+        def load(self, filename="0.csv", processes=1, clear=True):
+            """导入文件, 返回本次导入的数据。clear = True时, 先清空表中的数据
+            """
+            if clear:
+                self.bh.engine.cursor.execute("DELETE FROM employee")
+                self.bh.engine.commit()
+            self.bh.add(new_csvfile(self.path(filename)))
+            self.bh.devour(processes=processes, chunksize=30, incremental=True)
+            return self.rows(self.bh)
+        
+        def append(self, content, filename="0.csv"):
+            with open(self.path(filename), "a") as f:
+                f.write(content)
+        
+        def test_unchanged(self):
+            write_csv(self.path("0.csv"), 100)
+            self.assertEqual(len(self.load(clear=False)), 100)
+            self.assertEqual(self.load(), []) # 没有变化, 整个文件被跳过
+            self.assertEqual(self.progress(self.bh), {"0.csv": (100, 1, False)})
+        
+        def test_grown(self):
+            write_csv(self.path("0.csv"), 100)
+            self.load(clear=False)
+            self.append("e00100,name100,10,1/1/2015\ne00101,name101,11,1/2/2015\n")
+            self.assertEqual(self.load(), [("e00100", "name100", 10, date(2015, 1, 1)), 
+                                           ("e00101", "name101", 11, date(2015, 1, 2))])
+            self.assertEqual(self.progress(self.bh), {"0.csv": (102, 1, False)})
+        
+        def test_grown_without_trailing_newline(self):
+            """上次导入时最后一行只写了一半, 重新导入该行并覆盖之前的值
+            """
+            for processes in [1, 4]:
+                filename = "%s.csv" % processes
+                self.bh.engine.connect.close()
+                self.bh = self.blackhole(self.path("%s.db" % processes))
+                with open(self.path(filename), "w") as f:
+                    f.write("id,age,start_date,name\n"
+                            "e00000,0,1/1/2014,name0\ne00001,1,1/2/2014,na")
+                self.assertEqual(self.load(filename, processes, clear=False)[-1], 
+                                 ("e00001", 1, date(2014, 1, 2), "na"))
+                self.append("me1\ne00002,2,1/3/2014,name2\n", filename)
+                self.assertEqual(self.load(filename, processes, clear=False), [
+                    ("e00000", 0, date(2014, 1, 1), "name0"),
+                    ("e00001", 1, date(2014, 1, 2), "name1"),
+                    ("e00002", 2, date(2014, 1, 3), "name2")])
+                self.assertEqual(self.progress(self.bh)[filename], (3, 1, False))
+        
+        def test_rewritten(self):
+            """之前导入的部分被修改, 从头开始导入
+            """
+            write_csv(self.path("0.csv"), 100)
+            self.load(clear=False)
+            write_csv(self.path("0.csv"), 120, bad_row=0)
+            with open(self.path("0.csv")) as f:
+                content = f.read().replace("e00000,name0,abc", "e00000,name0,1")
+            with open(self.path("0.csv"), "w") as f:
+                f.write(content)
+            rows = self.load()
+            self.assertEqual(len(rows), 120)
+            self.assertEqual(rows[0], ("e00000", "name0", 1, date(2014, 1, 1)))
+            self.assertEqual(self.progress(self.bh), {"0.csv": (120, 1, False)})
+        
+        def test_resume(self):
+            """incremental模式下, 未完成的文件从最后一次commit的数据块之后继续导入
+            """
+            write_csv(self.path("0.csv"), 100)
+            self.load(clear=False)
+            self.bh.engine.cursor.execute(
+                "UPDATE blackhole_checkpoint SET nrows = 60, finished = 0")
+            self.bh.engine.commit()
+            rows = self.load()
+            self.assertEqual(len(rows), 40)
+            self.assertEqual(rows[0][0], "e00060")
+            self.assertEqual(self.progress(self.bh), {"0.csv": (100, 1, False)})
+    
+    class InferDtypeUnittest(BlackHoleTestCase):
+        def test_without_header(self):
+            """没有header时, 推断的数据类型对应 "c" + str(i) 列。样本之外的空值和小数不会使
+            推断为INTEGER的列导入失败
+            """
+            with open(self.path("0.csv"), "w") as f:
+                for i in range(5000):
+                    age = {1000: "", 1001: "2.5"}.get(i, str(i % 90))
+                    f.write("e%05d,name%s,%s,%s/%s/2014\n" % (i, i, age, i % 12 + 1, i % 28 + 1))
+            csvfile = CSVFile(self.path("0.csv"), table_name="employee", header=False, 
+                              dtype={1: "TEXT"}, primary_key_columns=[0], infer_dtype=True)
+            self.assertEqual(csvfile.dtype, {"c0": "TEXT", "c1": "TEXT", "c2": "INTEGER", 
+                                             "c3": "DATE"})
+            bh = self.blackhole()
+            bh.add(csvfile)
+            bh.devour(chunksize=300)
+            self.assertListEqual(
+                [(name, column_type, pk) for _, name, column_type, _, _, pk in 
+                 bh.engine.cursor.execute("PRAGMA table_info(employee)")],
+                [("c0", "TEXT", 1), ("c1", "TEXT", 0), ("c2", "INTEGER", 0), ("c3", "DATE", 0)])
+            rows = self.rows(bh)
+            self.assertEqual(len(rows), 5000)
+            self.assertEqual(rows[0], ("e00000", "name0", 0, date(2014, 1, 1)))
+            self.assertEqual(rows[999][2], 999 % 90)
+            self.assertIsNone(rows[1000][2])
+            self.assertEqual(rows[1001][2], 2.5)
+    
+    unittest.main()
@@ -0,0 +1,222 @@
+##encoding=UTF8
+
+"""
+author: Sanhe Hu
+
+compatibility: python3 ONLY
+
+prerequisites: pandas, angora.SQLITE
+
+根据抽样自动推断CSV文件每一列的数据类型。
+
+只读取一行来猜测数据类型很容易出错, 例如第一行恰好为空值, 或者某一列直到文件末尾才出现小数。
+SchemaInference从文件的 开头, 中间, 结尾 分别seek过去读取若干行作为样本, 然后对每一列依次尝试:
+
+    INTEGER -> REAL -> DATE -> DATETIME -> TEXT
+
+日期和日期时间使用TimeWrapper中的模板来判断。推断的结果可以直接作为CSVFile的dtype参数,
+也可以生成pandas.read_csv的dtype和Table的定义。
+
+import:
+    from angora.PandasSQL.typeinference import SchemaInference
+"""
+
+from __future__ import print_function
+from angora.SQLITE.core import Table, Column, DataType
+from angora.DATA.timewrapper import TimeWrapper
+from collections import OrderedDict
+import io
+import os
+import re
+import pandas as pd, numpy as np
+
+_integer_pattern = re.compile(r"^[+-]?\d+$")
+_real_pattern = re.compile(r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$") # float()会接受"1_0"
+_leading_zero_pattern = re.compile(r"^[+-]?0\d") # 以0开头的数字, 例如编号, 不视为数值
+
+class SchemaInference():
+    """a sampling-based schema inference engine for csv file.
+
+    [args]
+    ------
+    path:
+        csv file absolute path
+    sep:
+        csv seperator, default ','
+    header:
+        has header?
+    usecols:
+        a index list tells which columns you want to use
+    sample_size:
+        how many rows in total to sample
+    nblocks:
+        sample rows from #nblocks evenly spaced position of the file, the first block is the
+        head, the last block is the tail
+
+    [attributes]
+    ------------
+    sample:
+        the sampled rows, pandas.DataFrame, all values are str
+    dtype:
+        {column_name: "TEXT"/"INTEGER"/"REAL"/"DATE"/"DATETIME"}, the same format as CSVFile
+        dtype argument
+    pd_dtype:
+        {column_name: dtype} for pandas.read_csv. INTEGER columns are not included, the sample
+        can't prove that there's no missing value or decimal in the rest of the file, let 
+        pandas decide int64 or float64
+    """
+    def __init__(self, path, sep=",", header=True, usecols=None,
+                 sample_size=1000, nblocks=3, timewrapper=None):
+        self.path = path
+        self.sep = sep
+        if header:
+            self.header = 0
+        else:
+            self.header = None
+        self.usecols = usecols
+        self.sample_size = sample_size
+        self.nblocks = max(nblocks, 1)
+        if timewrapper is None:
+            timewrapper = TimeWrapper()
+        self.timewrapper = timewrapper
+
+        self.sample = self._read_sample()
+        self.dtype = OrderedDict()
+        for column in self.sample.columns:
+            self.dtype[column] = self.infer_column(self.sample[column])
+
+        _pd_dtype_mapping = {"TEXT": str, "REAL": np.float64,
+                             "DATE": str, "DATETIME": str}
+        self.pd_dtype = OrderedDict([(column, _pd_dtype_mapping[data_type])
+                                     for column, data_type in self.dtype.items() 
+                                     if data_type in _pd_dtype_mapping])
+
+    def _read_lines(self):
+        """返回 (header行, 样本行的列表)。每一块样本都从seek的位置之后的第一个完整行开始。
+        """
+        size = os.path.getsize(self.path)
+        nrows = max(self.sample_size // self.nblocks, 1)
+        blocks = list()
+        with open(self.path, "rb") as f:
+            header_line = f.readline() if self.header is not None else b""
+            start = f.tell()
+
+            # 开头
+            lines = [f.readline() for _ in range(nrows)]
+            blocks.append([line for line in lines if line])
+            head_end = f.tell()
+            if head_end >= size: # 文件很小, 已经读完了
+                return header_line, blocks[0]
+
+            # 中间, 均匀分布
+            avg_line_length = max((head_end - start) // max(len(blocks[0]), 1), 1)
+            tail_start = max(size - avg_line_length * nrows * 2, head_end)
+            for i in range(1, self.nblocks - 1):
+                offset = head_end + (tail_start - head_end) * i // (self.nblocks - 1)
+                f.seek(offset)
+                f.readline() # 丢弃不完整的行
+                lines = [f.readline() for _ in range(nrows)]
+                blocks.append([line for line in lines if line])
+
+            # 结尾
+            if self.nblocks > 1:
+                f.seek(tail_start)
+                if tail_start > head_end:
+                    f.readline()
+                blocks.append(f.readlines()[-nrows:])
+
+        lines = list()
+        for block in blocks:
+            lines.extend(block)
+        return header_line, lines
+
+    def _read_sample(self):
+        """将样本行解析为所有值都是str的DataFrame
+        """
+        header_line, lines = self._read_lines()
+        lines = [line if line.endswith(b"\n") else line + b"\n" for line in lines]
+        text = (header_line + b"".join(lines)).decode("utf-8", "replace")
+        return pd.read_csv(io.StringIO(text), sep=self.sep, header=self.header,
+                           usecols=self.usecols, dtype=str)
+
+    def infer_column(self, series):
+        """infer the data type of a column of str from the sample
+        """
+        values = [value for value in series.tolist() if isinstance(value, str)]
+        if not values:
+            return "TEXT"
+        has_missing = len(values) < len(series)
+
+        if any(_leading_zero_pattern.match(value) for value in values):
+            numeric = False
+        else:
+            numeric = True
+        
+        if numeric and all(_integer_pattern.match(value) for value in values):
+            if has_missing: # pandas.read_csv中的int64列不能有空值
+                return "REAL"
+            return "INTEGER"
+        if numeric and all(_real_pattern.match(value) for value in values):
+            return "REAL"
+        if self.timewrapper.detect_date_template(values):
+            return "DATE"
+        if self.timewrapper.detect_datetime_template(values):
+            return "DATETIME"
+        return "TEXT"
+
+    def table(self, table_name, metadata, primary_key_columns=list()):
+        """construct the Table definition in metadata from the inferred dtype. non-str column
+        name i is converted to "c" + str(i)
+        """
+        datatype = DataType()
+        _db_dtype_mapping = {"TEXT": datatype.text, "INTEGER": datatype.integer,
+                             "REAL": datatype.real,
+                             "DATE": datatype.date, "DATETIME": datatype.datetime}
+        primary_key_columns = [i if isinstance(i, str) else "c" + str(i)
+                               for i in primary_key_columns]
+        columns = list()
+        for column_name, data_type in self.dtype.items():
+            if not isinstance(column_name, str):
+                column_name = "c" + str(column_name)
+            columns.append(Column(column_name, _db_dtype_mapping[data_type],
+                                  primary_key=column_name in primary_key_columns))
+        return Table(table_name, metadata, *columns)
+
+if __name__ == "__main__":
+    import unittest
+    import tempfile
+
+    class SchemaInferenceUnittest(unittest.TestCase):
+        def setUp(self):
+            self.path = os.path.join(tempfile.gettempdir(), "schema_inference_test.csv")
+            with open(self.path, "w") as f:
+                f.write("eid,code,age,height,weight,create_date,create_time\n")
+                for i in range(10000):
+                    f.write("e%s,%05d,%s,%s.5,%s,2014-01-%02d,01/%02d/2014 5:58:31 PM\n" % (
+                        i, i, i % 90, i, "" if i == 3 else i, i % 28 + 1, i % 28 + 1))
+                f.write("1_0,10000,1,1.25,1,2014-01-01,01/01/2014 5:58:31 PM\n")
+
+        def tearDown(self):
+            os.remove(self.path)
+
+        def test_infer(self):
+            schema = SchemaInference(self.path, sample_size=300, nblocks=3)
+            self.assertEqual(len(schema.sample), 300)
+            self.assertListEqual(list(schema.dtype.items()),
+                [("eid", "TEXT"), ("code", "TEXT"), ("age", "INTEGER"), ("height", "REAL"),
+                 ("weight", "REAL"), ("create_date", "DATE"), ("create_time", "DATETIME")])
+            self.assertNotIn("age", schema.pd_dtype)
+            self.assertEqual(schema.pd_dtype["height"], np.float64)
+            # 最后一行一定在样本中
+            self.assertEqual(schema.sample["eid"].tolist()[-1], "1_0")
+
+        def test_table(self):
+            from angora.SQLITE.core import MetaData
+            metadata = MetaData()
+            schema = SchemaInference(self.path, header=False, usecols=[0, 2], sample_size=30)
+            table = schema.table("employee", metadata, primary_key_columns=[0])
+            self.assertListEqual([column.column_name for column in table.columns.values()],
+                                 ["c0", "c2"])
+            self.assertListEqual(table.primary_key_columns, ["c0"])
+
+    unittest.main()
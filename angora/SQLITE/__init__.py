@@ -1,5 +1,5 @@
 ##encoding=utf-8
 
-from .core import (MetaData, Sqlite3Engine, Table, Column, DataType, Row, 
-    and_, or_, desc, Select)
-from .wrapper import iterC
+from .core import (MetaData, Sqlite3Engine, Sqlite3PoolEngine, Table, Column, Index, DataType, 
+    Codec, Row, and_, or_, desc, Select)
+from .wrapper import iterC, iterbatch
@@ -38,14 +38,24 @@ Prerequisites
 
 Import Command
 --------------
-    from .core import (MetaData, Sqlite3Engine, Table, Column, DataType, Row, 
-        and_, or_, desc, Select)
+    from .core import (MetaData, Sqlite3Engine, Sqlite3PoolEngine, Table, Column, Index, DataType, 
+        Codec, Row, and_, or_, desc, Select)
 """
 
-from angora.DATA.dtype import StrSet, IntSet, StrList, IntList
-from collections import OrderedDict
+from angora.DATA.dtype import StrSet, IntSet, StrList, IntList, pack, unpack, is_packed
+from angora.SQLITE.wrapper import iterbatch
+from collections import OrderedDict, Counter
+import contextlib
+import functools
+import itertools
+import threading
 import sqlite3
 import pickle
+import struct
+import array
+import queue
+import sys
+import re
 
 def obj2bytestr(obj):
     """convert arbitrary object to database friendly bytestr"""
@@ -77,22 +87,48 @@ def hexstring2bytestr(hexstring):
             temp = list()
     return b"".join(res) # 合并成一个bytestr
 
+def _chunked(iterable, size):
+    """divide iterable (list or generator) into lists with at most #size items. unlike 
+    angora.DATA.iterable.grouper_list, None items are kept and the iterable is consumed lazily.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
 ##################################################
 #                                                #
 #                   Row class                    #
 #                                                #
 ##################################################
 
+@functools.lru_cache(maxsize=1024)
+def _column_index(columns):
+    """return a {column_name: position} dictionary for a tuple of column names. The result is 
+    cached, so all Row objects with the same columns share one index dictionary.
+    """
+    return {column_name: i for i, column_name in enumerate(columns)}
+
 class Row():
     """
     [CN]数据表中的行数据类。 可以使用索引Row[column_name]或是属性Row.column_name的方式对数据进行访问。
     [EN]An abstract class for row object in database table. Values can be visit by it's column name
     in two way: Row[column_name], Row.column_name
+    
+    [CN]为了节约内存, Row使用__slots__, 仅仅储存columns, values以及一个 {column_name: 位置} 的索引字典。
+    拥有相同columns的所有Row共享同一个索引字典 (例如Sqlite3Engine.select_row返回的所有Row), 所以
+    每一个Row对象不需要再单独创建一个字典。只有在调用to_dict(), print(Row)的时候才会生成字典。
     """
-    def __init__(self, columns, values):
+    __slots__ = ("columns", "values", "_index")
+    
+    def __init__(self, columns, values, _index=None):
         self.columns = columns
         self.values = values
-        self.dictionary_view = None
+        if _index is None:
+            _index = _column_index(tuple(columns))
+        self._index = _index
     
     @staticmethod
     def from_dict(dictionary):
@@ -103,54 +139,37 @@ class Row():
         return Row(tuple(dictionary.keys()), tuple(dictionary.values()))
     
     def to_dict(self):
-        self._smart_create_dict_view()
-        return self.dictionary_view
-    
-    def _create_dict_view(self):
-        """
-        [CN]为了节约内存, 在初始化Row对象时仅仅是以两个列表的形式储存 column : value 信息。但是在
-        Row[column_name], Row.column_name, Row[column_name]=value, print(Row)的时候会自动从
-        columns, values中生成一个字典。这样在仅仅用于Insert的时候, 不需要创建字典, 可以直接传入
-        行tuple, 从而节约了计算量。
-        """
-        self.dictionary_view = OrderedDict()
-        for column_name, value in zip(self.columns, self.values):
-            self.dictionary_view[column_name] = value
+        return OrderedDict(zip(self.columns, self.values))
     
-    def _smart_create_dict_view(self):
-        """在_create_dict_view之前进行判断是否需要重新创建dictionary_view
-        """
-        if not self.dictionary_view:
-            self._create_dict_view()
-            
     def __str__(self):
-        self._smart_create_dict_view()
-        return str(self.dictionary_view)
+        return str(self.to_dict())
     
     def __repr__(self):
         return "Row(columns=%s, values=%s)" % (self.columns, self.values)
     
     def __getitem__(self, key):
-        self._smart_create_dict_view()
-        return self.dictionary_view[key]
+        return self.values[self._index[key]]
     
     def __setitem__(self, key, value):
-        self._smart_create_dict_view()
-        if key in self.dictionary_view:
-            self.dictionary_view[key] = value
-            self.columns = tuple(self.dictionary_view.keys())
-            self.values = tuple(self.dictionary_view.values())
+        if key in self._index:
+            values = list(self.values)
+            values[self._index[key]] = value
+            self.values = tuple(values)
         else:
             raise KeyError
         
     def __getattr__(self, attr):
-        self._smart_create_dict_view()
-        return self.dictionary_view[attr]
+        if attr in Row.__slots__: # slot还没有被赋值, 例如在unpickle的时候
+            raise AttributeError(attr)
+        try:
+            return self.values[self._index[attr]]
+        except KeyError:
+            raise AttributeError(attr)
     
     def __eq__(self, other):
-        self._smart_create_dict_view()
-        other._smart_create_dict_view()
-        return dict(self.dictionary_view) == dict(other.dictionary_view)
+        if self._index is other._index:
+            return tuple(self.values) == tuple(other.values)
+        return dict(zip(self.columns, self.values)) == dict(zip(other.columns, other.values))
     
     
 ##################################################
@@ -159,14 +178,65 @@ class Row():
 #                                                #
 ##################################################
 
+class _CompiledInsert():
+    """_CompiledInsert is a internal class, a INSERT statement prepared for one subset of 
+    columns. It's created by Insert.compile() and cached in Table, so the SQL command and the
+    converter are only built once for each distinct column subset.
+    
+    converter把按column_names排列的值转化为sqlite3可以接受的tuple。其中需要codec编码的列
+    预先记录在encoders中, 其他的列原样通过; 如果没有需要编码的列, 则直接原样返回。
+    """
+    def __init__(self, insert_obj, column_names):
+        self.column_names = column_names
+        
+        cmd_INSERT_INTO = "INSERT INTO %s" % insert_obj.table.table_name
+        cmd_COLUMNS = "(%s)" % ", ".join(column_names)
+        cmd_KEYWORD_VALUES = "VALUES"
+        cmd_QUESTION_MARK = "(%s)" % ", ".join(["?"] * len(column_names) )
+        template = "%s\n\t%s\n%s\n\t%s;"
+        self.insert_sqlcmd = template % (cmd_INSERT_INTO,
+                                         cmd_COLUMNS,
+                                         cmd_KEYWORD_VALUES,
+                                         cmd_QUESTION_MARK,)
+        self.upsert_sqlcmd = "\n".join([i for i in [self.insert_sqlcmd[:-1],
+                                                    insert_obj._on_conflict_clause(column_names)] if i]) + ";"
+        
+        self.encoders = [(i, insert_obj.table.columns[column_name].codec.encode) \
+                         for i, column_name in enumerate(column_names) \
+                         if insert_obj.table.columns[column_name].is_pickletype]
+        if len(self.encoders) == 0:
+            self.record_converter = self.nonpicklize_record
+            self.row_converter = self.nonpicklize_row
+        else:
+            self.record_converter = self.picklize_record
+            self.row_converter = self.picklize_row
+    
+    def nonpicklize_record(self, record):
+        return record
+    
+    def picklize_record(self, record):
+        values = list(record)
+        for i, encode in self.encoders:
+            if values[i]: # 如果 item 不为 None, 则需要处理成bytestr
+                values[i] = encode(values[i])
+        return tuple(values)
+    
+    def nonpicklize_row(self, row):
+        return row.values
+    
+    def picklize_row(self, row):
+        return self.picklize_record(row.values)
+
 class Insert():
     """
     [CN]Insert对象可以通过Table.insert()命令生成。当我们执行:
-        Sqlite3Engine.insert_record时, 会执行Insert.sqlcmd_from_record以生成INSERT SQL命令
-        最后再执行cursor.execute(Insert.sqlcmd, Insert.default_record_converter(record))完成插入
+        Sqlite3Engine.insert_record时, 会执行Insert.compile()获得INSERT SQL命令和converter
+        最后再执行cursor.execute(compiled.insert_sqlcmd, compiled.record_converter(record))完成插入
 
-        Sqlite3Engine.insert_row时, 会执行Insert.sqlcmd_from_row(Row)以生成INSERT SQL命令
-        最后再执行cursor.execute(Insert.sqlcmd, Insert.default_row_converter(Row))完成插入
+        Sqlite3Engine.insert_row时, 会执行Insert.compile(Row.columns)获得INSERT SQL命令和converter
+        最后再执行cursor.execute(compiled.insert_sqlcmd, compiled.row_converter(Row))完成插入
+    
+    对于同一个Table, 每一种column组合只会compile一次。
     """
     def __init__(self, table):
         self.table = table
@@ -176,35 +246,73 @@ class Insert():
         else:
             self.default_record_converter = self.picklize_record
             self.default_row_converter = self.picklize_row
+    
+    def compile(self, column_names=None):
+        """return the _CompiledInsert for column_names (default all columns), which is cached
+        in Table
+        """
+        if column_names is None:
+            column_names = self.table.column_names
+        else:
+            column_names = tuple(column_names)
+        try:
+            return self.table._compiled_inserts[column_names]
+        except KeyError:
+            compiled = _CompiledInsert(self, column_names)
+            self.table._compiled_inserts[column_names] = compiled
+            return compiled
             
     def sqlcmd_from_record(self):
         """generate the 'INSERT INTO table...' SQL command suit for record, for example:
         INSERT INTO table_name VALUES (?,?,...,?);
         """
-        cmd_INSERT_INTO = "INSERT INTO %s" % self.table.table_name
-        cmd_COLUMNS = "(%s)" % ", ".join(self.table.columns)
-        cmd_KEYWORD_VALUES = "VALUES"
-        cmd_QUESTION_MARK = "(%s)" % ", ".join(["?"] * len(self.table.columns) )
-        template = "%s\n\t%s\n%s\n\t%s;"
-        self.insert_sqlcmd = template % (cmd_INSERT_INTO,
-                                         cmd_COLUMNS,
-                                         cmd_KEYWORD_VALUES,
-                                         cmd_QUESTION_MARK,)
+        self.insert_sqlcmd = self.compile().insert_sqlcmd
         
     def sqlcmd_from_row(self, row):
         """generate the 'INSERT INTO table...' SQL command suit for row, for example:
         INSERT INTO table_name (column1, column2, ..., columnN) VALUES (?,?,...,?);
         """
-        cmd_INSERT_INTO = "INSERT INTO %s" % self.table.table_name
-        cmd_COLUMNS = "(%s)" % ", ".join(row.columns)
-        cmd_KEYWORD_VALUES = "VALUES"
-        cmd_QUESTION_MARK = "(%s)" % ", ".join(["?"] * len(row.columns) )
-        template = "%s\n\t%s\n%s\n\t%s;"
-        self.insert_sqlcmd = template % (cmd_INSERT_INTO,
-                                         cmd_COLUMNS,
-                                         cmd_KEYWORD_VALUES,
-                                         cmd_QUESTION_MARK,)
+        self.insert_sqlcmd = self.compile(row.columns).insert_sqlcmd
+    
+    def _on_conflict_clause(self, column_names):
+        """generate the 'ON CONFLICT (primary_key) DO UPDATE SET...' part of upsert SQL command.
+        Columns except primary key columns are updated by the value we tried to insert, which
+        can be accessed by excluded.column_name. Returns None if the table has no primary key.
+        """
+        if len(self.table.primary_key_columns) == 0:
+            return None
+        
+        cmd_ON_CONFLICT = "ON CONFLICT (%s)" % ", ".join(self.table.primary_key_columns)
+        update_columns = [column_name for column_name in column_names \
+                          if column_name not in self.table.primary_key_columns]
+        if len(update_columns) == 0:
+            return "%s DO NOTHING" % cmd_ON_CONFLICT
+        else:
+            return "%s DO UPDATE SET\n\t%s" % (cmd_ON_CONFLICT, ",\n\t".join(
+                ["%s = excluded.%s" % (column_name, column_name) for column_name in update_columns]))
     
+    def upsert_sqlcmd_from_record(self):
+        """generate the 'INSERT INTO table... ON CONFLICT...' SQL command suit for record, for 
+        example:
+        INSERT INTO table_name (column1, column2, ..., columnN) VALUES (?,?,...,?)
+        ON CONFLICT (column1) DO UPDATE SET column2 = excluded.column2, ...;
+        
+        [CN]需要sqlite3 3.24.0以上的版本
+        """
+        compiled = self.compile()
+        self.insert_sqlcmd = compiled.insert_sqlcmd
+        self.upsert_sqlcmd = compiled.upsert_sqlcmd
+        
+    def upsert_sqlcmd_from_row(self, row):
+        """generate the 'INSERT INTO table... ON CONFLICT...' SQL command suit for row, only
+        columns appeared in row will be updated.
+        
+        [CN]需要sqlite3 3.24.0以上的版本
+        """
+        compiled = self.compile(row.columns)
+        self.insert_sqlcmd = compiled.insert_sqlcmd
+        self.upsert_sqlcmd = compiled.upsert_sqlcmd
+        
     ### record/row converter to change the record/row to sqlite3 friendly tuple
     def nonpicklize_record(self, record):
         """把一个不含PICKLETYPE的record原样返回
@@ -218,7 +326,7 @@ class Insert():
         for column, item in zip(self.table.columns.values(), record):
             if column.is_pickletype:
                 if item: # 如果 item 不为 None, 则需要处理成bytestr
-                    new_record.append(obj2bytestr(item))
+                    new_record.append(column.codec.encode(item))
                 else: # 如果 item 为 None, 则不处理
                     new_record.append(item)
             else:
@@ -237,7 +345,7 @@ class Insert():
         for column, item in zip(row.columns, row.values):
             if self.table.columns[column].is_pickletype:
                 if item: # 如果 item 不为 None, 则需要处理成bytestr
-                    new_record.append(obj2bytestr(item))
+                    new_record.append(self.table.columns[column].codec.encode(item))
                 else: # 如果 item 为 None, 则不处理
                     new_record.append(item)
             else:
@@ -259,58 +367,67 @@ class _Update_config():
     对象。这样在 Update.values(**kwarg) 方法中我们就可以将 Column + 数值 作文sql字符串进行输入了
     
     目前只支持 column 和 数值进行运算, 并且只能有两项。
+    
+    param_sqlcmd中的值以 ? 占位, 真实的值储存在params中; sqlcmd则是把值直接写入SQL的版本。
     """
-    def __init__(self, sqlcmd):
-        self.sqlcmd = sqlcmd
+    def __init__(self, param_sqlcmd, params=()):
+        self.param_sqlcmd = param_sqlcmd
+        self.params = params
+    
+    @property
+    def sqlcmd(self):
+        return _render_sqlcmd(self.param_sqlcmd, self.params)
 
 class Update():
     """
     [CN]Update对象可以通过Table.update()命令生成。当我们执行:
-        Sqlite3Engine.update(update_obj)时, 会执行Update.sqlcmd()方法以更新Update.update_sqlcmd,
-        然后执行cursor.execute(Update.update_sqlcmd)以完成更新
+        Sqlite3Engine.update(update_obj)时, 会执行Update.sqlcmd()方法以更新Update.update_sqlcmd
+        和Update.update_params, 然后执行cursor.execute(Update.update_sqlcmd, Update.update_params)
+        以完成更新
     """
     def __init__(self, table):
         self.table = table
         self.update_clause = "UPDATE %s" % self.table.table_name
+        self.set_clause = None
+        self.set_params = ()
         self.where_clause = None
+        self.where_params = ()
         
     def values(self, **kwarg):
         """
         SET
-            movie.length = movie.length + 9999, # 相对更新
-            movie.title ="ABCD", # 绝对更新
-            movie.genres = 'gANjYnVpbHRpbnMKc2V0CnEAXXEBWAkAAABBZHZlbnR1cmVxAmGFcQNScQQu', # 绝对更新
-            movie.release_date = '1500-01-01' # 绝对更新
+            movie.length = movie.length + ?, # 相对更新
+            movie.title = ?, # 绝对更新
+            movie.genres = ?, # 绝对更新
+            movie.release_date = ? # 绝对更新
         """
         res = list()
+        params = list()
         for column_name, value in kwarg.items():
             if value == None: # 有时候我们要把值更新为Null, 这样我们在values中设定=None即可
                 res.append("%s = %s" % (column_name, "NULL"))
             else:
                 column = self.table.columns[column_name]
-                try: # value是_Update_config对象, 处理相对更新
-                    res.append("%s = %s" % (column.column_name, 
-                                            value.sqlcmd ) ) # 直接使用
-                except: # value是一个值, 处理绝对更新
-                    if isinstance(value, str):
-                        res.append("%s = '%s'" % (column.column_name, 
-                                                value.replace("'", "''").replace('"', '\"') ) ) # 将 = value 中 value 的部分处理
-                        value = value.replace("'", "''").replace('"', '\"')
-                    else:
-                        res.append("%s = %s" % (column.column_name, 
-                                                column.__SQL__(value) ) ) # 将 = value 中 value 的部分处理
+                if isinstance(value, _Update_config): # value是_Update_config对象, 处理相对更新
+                    res.append("%s = %s" % (column.column_name, value.param_sqlcmd))
+                    params.extend(value.params)
+                else: # value是一个值, 处理绝对更新
+                    res.append("%s = ?" % column.column_name)
+                    params.append(column.__PARAM__(value))
             
         self.set_clause = "SET\n\t%s" % ",\n\t".join(res)
+        self.set_params = tuple(params)
         return self
     
     def where(self, *argv):
         """define WHERE clause in UPDATE SQL command
         """
-        self.where_clause = "WHERE\n\t%s" % " AND\n\t".join([_select_config.sqlcmd for _select_config in argv])
+        self.where_clause = "WHERE\n\t%s" % " AND\n\t".join([_select_config.param_sqlcmd for _select_config in argv])
+        self.where_params = _join_params(argv)
         return self
     
     def sqlcmd(self):
-        """generate "UPDATE table SET..." SQL command
+        """generate "UPDATE table SET..." SQL command and the bound parameters
         
         example output:
         
@@ -325,17 +442,25 @@ class Update():
         
             UPDATE movie
             SET
-                genres = 'gANjYnVpbHRpbnMKc2V0CnEAXXEBWAkAAABBZHZlbnR1cmVxAmGFcQNScQQu',
-                length = length + 9999,
-                release_date = '1500-01-01',
-                title = 'ABCDEFG'
+                genres = ?,
+                length = length + ?,
+                release_date = ?,
+                title = ?
             WHERE
-                release_date <= '2000-01-01' AND
-                length > 100
+                release_date <= ? AND
+                length > ?
+            
+            # update.update_params = (b'\x80\x03cbuiltins\nset...', 9999, '1500-01-01', 'ABCDEFG', 
+                                      '2000-01-01', 100)
         """
         self.update_sqlcmd = "\n".join([i for i in [self.update_clause, 
                                                    self.set_clause, 
                                                    self.where_clause] if i])
+        self.update_params = self.set_params + self.where_params
+        
+    def __str__(self):
+        self.sqlcmd()
+        return _render_sqlcmd(self.update_sqlcmd, self.update_params)
 
 
 ##################################################
@@ -344,15 +469,60 @@ class Update():
 #                                                #
 ##################################################
 
+def _sql_literal(value):
+    """把一个已经转化为sqlite3友好类型的值 (str, int, float, bytes, None) 写成SQL语句中的形式
+    """
+    if value is None:
+        return "NULL"
+    elif isinstance(value, bytes):
+        return "X'%s'" % bytestr2hexstring(value)
+    else:
+        return repr(value)
+
+def _render_sqlcmd(param_sqlcmd, params):
+    """把param_sqlcmd中的 ? 依次替换成params中的值, 生成人类可读的SQL语句。仅用于打印和调试,
+    执行的时候请使用param_sqlcmd和params。
+    """
+    if len(params) == 0:
+        return param_sqlcmd
+    pieces = param_sqlcmd.split("?")
+    res = [pieces[0]]
+    for value, piece in zip(params, pieces[1:]):
+        res.append(_sql_literal(value))
+        res.append(piece)
+    return "".join(res)
+
+def _join_predicates(select_configs):
+    """concatenate predicates of several _Select_config"""
+    return tuple(itertools.chain.from_iterable(i.predicates for i in select_configs))
+
+def _join_params(configs):
+    """把多个_Select_config的params依次连接成一个tuple
+    """
+    return tuple(itertools.chain.from_iterable([config.params for config in configs]))
+
+@functools.lru_cache(maxsize=1024)
+def _compile_select(select_from_clause, where_clause, orderby_clause, limit_clause, offset_clause):
+    """把SELECT语句的各个部分拼接成完整的SQL。由于所有的值都以 ? 占位, 同一种形状的查询 (选择的列, 
+    WHERE中的比较方式, 排序等相同, 只有值不同) 生成的SQL完全相同, 所以可以缓存。同时相同的SQL字符串
+    也能命中sqlite3自己的prepared statement cache, 省去了重新解析SQL的时间。
+    """
+    return "\n\t".join([i for i in [select_from_clause,
+                                    where_clause,
+                                    orderby_clause,
+                                    limit_clause,
+                                    offset_clause] if i ])
+
 def and_(*argv):
     """AND join list of where clause criterions
     """
-    return _Select_config("(%s)" % " AND ".join([i.sqlcmd for i in argv]))
+    return _Select_config("(%s)" % " AND ".join([i.param_sqlcmd for i in argv]), _join_params(argv),
+                          _join_predicates(argv))
 
 def or_(*argv):
     """OR join list of where clause criterions
     """
-    return _Select_config("(%s)" % " OR ".join([i.sqlcmd for i in argv]))
+    return _Select_config("(%s)" % " OR ".join([i.param_sqlcmd for i in argv]), _join_params(argv))
 
 def asc(column_name):
     """sort results by column_name in ascending order
@@ -371,14 +541,27 @@ class _Select_config():
         Column >= 100
         Column.between(100, 200)
         Column.like("pattern")
+    
+    values are not written into param_sqlcmd, they are replaced by ? and stored in params. 
+    For example (Column >= 100).param_sqlcmd = "column_name >= ?", .params = (100,), and
+    the human readable .sqlcmd = "column_name >= 100"
+    
+    predicates records which column is compared and how, it's used by IndexAdvisor. For 
+    example (Column >= 100).predicates = (("column_name", "range"),)
     """
-    def __init__(self, sqlcmd):
-        self.sqlcmd = sqlcmd
+    def __init__(self, param_sqlcmd, params=(), predicates=()):
+        self.param_sqlcmd = param_sqlcmd
+        self.params = params
+        self.predicates = predicates
+    
+    @property
+    def sqlcmd(self):
+        return _render_sqlcmd(self.param_sqlcmd, self.params)
 
 class Select():
     """
     [CN]Select对象用于创建SQL select语句。 在我们执行Sqlite3Engine.select(Select(table.all))时,
-    首先会调用Select.toSQL()方法创建SQL语句, 然后执行cursor。
+    首先会调用Select.toParamSQL()方法创建带有 ? 占位符的SQL语句和参数, 然后执行cursor。
     """
     def __init__(self, columns):
         """To create a Select object, you have to name a list of Column object has to select. And
@@ -387,19 +570,26 @@ class Select():
         self.columns = columns
         self.column_names = tuple([column.column_name for column in self.columns])
         
+        self.table_name = self.columns[0].table_name
         self.select_from_clause = "SELECT %s FROM %s" % (", ".join(self.column_names), 
-                                                         self.columns[0].table_name)
+                                                         self.table_name)
         self.where_clause = None
+        self.where_params = ()
+        self.where_predicates = ()
         self.orderby_clause = None
         self.limit_clause = None
+        self.limit_params = ()
         self.offset_clause = None
+        self.offset_params = ()
         self.distinct_clause = None
         
         # Define default record converter, convert pickletype byte string back to python object
-        if len([column for column in self.columns if column.is_pickletype]) == 0: 
+        if len([column for column in self.columns if column.is_pickleobject]) == 0: 
             self.default_record_converter = self.nonpicklize_record
+            self.default_batch_converter = self.nonpicklize_batch
         else:
             self.default_record_converter = self.picklize_record
+            self.default_batch_converter = self.picklize_batch
 
     def where(self, *argv):
         """where() method is used to filter records. It takes arbitrary many comparison of 
@@ -409,19 +599,23 @@ class Select():
         example:
             where(column1 >= 3.14, column2.between(1, 100), column3.like("%pattern%"))
         """
-        self.where_clause = "WHERE %s" % " AND ".join([i.sqlcmd for i in argv])
+        self.where_clause = "WHERE %s" % " AND ".join([i.param_sqlcmd for i in argv])
+        self.where_params = _join_params(argv)
+        self.where_predicates = _join_predicates(argv)
         return self
     
     def limit(self, howmany):
         """limit clause
         """
-        self.limit_clause = "LIMIT %s" % howmany
+        self.limit_clause = "LIMIT ?"
+        self.limit_params = (howmany,)
         return self
     
     def offset(self, howmany):
         """offset clause
         """
-        self.offset_clause = "OFFSET %s" % howmany
+        self.offset_clause = "OFFSET ?"
+        self.offset_params = (howmany,)
         return self
     
     def distinct(self):
@@ -448,19 +642,24 @@ class Select():
                 new_argv.append(i)
             else:
                 new_argv.append(asc(i))
-        self.orderby_clause = "ORDER BY %s" % ", ".join([i.sqlcmd for i in new_argv])
+        self.orderby_clause = "ORDER BY %s" % ", ".join([i.param_sqlcmd for i in new_argv])
         return self
         
     def __str__(self):
-        return "\n\t".join([i for i in [self.select_from_clause,
-                                        self.where_clause,
-                                        self.orderby_clause,
-                                        self.limit_clause,
-                                        self.offset_clause] if i ])
+        return _render_sqlcmd(*self.toParamSQL())
     
     def toSQL(self):
-        """return the SELECT SQL command"""
+        """return the human readable SELECT SQL command, values are written in SQL"""
         return str(self)
+    
+    def toParamSQL(self):
+        """return the SELECT SQL command with ? placeholder, and the tuple of bound parameters"""
+        return (_compile_select(self.select_from_clause,
+                                self.where_clause,
+                                self.orderby_clause,
+                                self.limit_clause,
+                                self.offset_clause),
+                self.where_params + self.limit_params + self.offset_params)
 
     ### record converter to change the record to sqlite3 friendly tuple
     def nonpicklize_record(self, record):
@@ -473,14 +672,33 @@ class Select():
         """
         new_record = list()
         for column, item in zip(self.columns, record):
-            if column.is_pickletype:
+            if column.is_pickleobject:
                 if item: # 如果 item 不为 None, 则需要处理成bytestr
-                    new_record.append(bytestr2obj(item))
+                    new_record.append(column.codec.decode(item))
                 else: # 如果 item 为 None, 则不处理
                     new_record.append(item)
             else:
                 new_record.append(item)
         return tuple(new_record)
+    
+    ### batch converter to change a list of records at once
+    def nonpicklize_batch(self, records):
+        """把一批不含PICKLETYPE的records原样返回
+        """
+        return records
+    
+    def picklize_batch(self, records):
+        """把一批含有PICKLETYPE的records按列转置, 只对pickle对应的列进行解码, 再转置回来。
+        这样不含PICKLETYPE的列不需要逐行处理。
+        """
+        if not records:
+            return records
+        columns = list(zip(*records))
+        for i, column in enumerate(self.columns):
+            if column.is_pickleobject:
+                decode = column.codec.decode
+                columns[i] = [decode(item) if item else item for item in columns[i]]
+        return list(zip(*columns))
 
 
 ##################################################
@@ -514,6 +732,8 @@ class MetaData():
             except Exception as e:
                 pass
 #                 print(e)
+            for create_index_sqlcmd in table.create_index_sql():
+                engine.cursor.execute(create_index_sqlcmd)
     
     def drop_all(self, engine):
         """drop all table stored in this metadata
@@ -606,6 +826,12 @@ class MetaData():
                                 primary_key=is_primarykey==1, nullable=not not_null,
                                 default=default_value_mapping[column_type_name](default_value),)
                 columns.append(column)
+            # 只读取用户创建的索引, 即 PRAGMA index_list 中 origin = "c" 的索引
+            for record in list(engine.execute("PRAGMA index_list(%s)" % table_name)):
+                _, index_name, unique, origin = record[:4]
+                if origin == "c":
+                    column_names = [i[2] for i in engine.execute("PRAGMA index_info(%s)" % index_name)]
+                    columns.append(Index(index_name, *column_names, unique=unique==1))
             table = Table(table_name, self, *columns)
             
 ##################################################
@@ -723,6 +949,192 @@ class DataType():
     strlist = STRLIST()
     intlist = INTLIST()
     
+##################################################
+#                                                #
+#                 Column codec                   #
+#                                                #
+##################################################
+
+# PICKLETYPE, PYTHONLIST, PYTHONSET, PYTHONDICT, ORDEREDDICT 的值在数据库中以bytes的形式储存。
+# 默认使用pickle进行转换。对于大量储存 整数/实数/字符串 的list, set, tuple, dict, 可以为Column指定
+# codec=Codec.fast, 使用更紧凑和快速的array/struct编码, 无法用array编码的对象自动使用pickle。
+#
+# 无论用哪一种codec写入, 读取时都会根据bytes的第一个字节自动判断使用哪种方式解码。所以修改一个
+# Column的codec不会影响已经写入数据库中的数据。
+
+_FAST_CODEC_MAGIC = b"\xfa" # 不是任何pickle protocol的起始字节
+_UINT32 = "I" if array.array("I").itemsize == 4 else "L"
+
+def _little_endian(arr):
+    """数据库中的数组统一以little endian储存"""
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+class BaseCodec():
+    """所有codec的父类, encode方法由子类定义, decode方法对所有codec写入的数据都有效
+    """
+    def __repr__(self):
+        return "Codec.%s" % self.name
+    
+    def decode(self, bytestr):
+        """bytes -> python object"""
+        if bytestr[:1] == _FAST_CODEC_MAGIC:
+            return FastCodec._decode(bytestr)
+        else:
+            return bytestr2obj(bytestr)
+
+class PickleCodec(BaseCodec):
+    """use pickle to convert any python object"""
+    name = "pickle"
+    
+    def encode(self, obj):
+        """python object -> bytes"""
+        return obj2bytestr(obj)
+
+class FastCodec(BaseCodec):
+    """use array and struct to convert list, set, tuple of int/float/str and dict with int/float/str
+    keys and values. Integers are stored in the smallest possible array type. Other object fall 
+    back to pickle.
+    
+    format:
+        b"\xfa" + container_code + payload
+            container_code: b"L" list, b"S" set, b"T" tuple, b"D" dict
+            payload of list/set/tuple: element_code + elements
+            payload of dict: key element_code + value element_code + 
+                8 bytes length of keys + keys + values
+            
+        element_code: b"b", b"h", b"i", b"q" for int8, int16, int32, int64, b"d" for float,
+            b"z", b"u" for str
+        elements of int and float: little endian array
+        elements of str (b"z"): utf-8 text joined by "\x00", used when no string contains "\x00"
+        elements of str (b"u"): 8 bytes count + uint32 array of each string's length + utf-8 text
+    """
+    name = "fast"
+    
+    _container_code = {list: b"L", set: b"S", tuple: b"T"}
+    _container_type = {b"L": list, b"S": set, b"T": tuple}
+    
+    def encode(self, obj):
+        """python object -> bytes"""
+        try:
+            if type(obj) in self._container_code:
+                encoded = self._encode_elements(list(obj))
+                if encoded:
+                    return b"".join([_FAST_CODEC_MAGIC, self._container_code[type(obj)]] + encoded)
+            elif type(obj) is dict:
+                encoded_keys = self._encode_elements(list(obj.keys()))
+                encoded_values = self._encode_elements(list(obj.values()))
+                if encoded_keys and encoded_values:
+                    return b"".join([_FAST_CODEC_MAGIC, b"D", encoded_keys[0], encoded_values[0],
+                                     struct.pack("<Q", len(encoded_keys[1])),
+                                     encoded_keys[1], encoded_values[1]])
+        except (OverflowError, UnicodeEncodeError):
+            pass
+        return obj2bytestr(obj)
+    
+    @staticmethod
+    def _encode_elements(items):
+        """return [element_code, elements], or None if items are not all int, float or str
+        """
+        types = set(map(type, items))
+        if (len(types) == 0) or (types == {int}):
+            if len(items) == 0:
+                typecode = "b"
+            else:
+                lower, upper = min(items), max(items)
+                for typecode in "bhiq":
+                    bound = 2 ** (8 * array.array(typecode).itemsize - 1)
+                    if (-bound <= lower) and (upper < bound):
+                        break
+            arr = array.array(typecode, items) # raise OverflowError if out of int64
+            return [typecode.encode(), _little_endian(arr).tobytes()]
+        elif types == {float}:
+            return [b"d", _little_endian(array.array("d", items)).tobytes()]
+        elif types == {str}:
+            text = "\x00".join(items)
+            if text.count("\x00") == len(items) - 1: # 字符串中没有\x00, 可以直接用\x00分隔
+                return [b"z", text.encode("utf-8")]
+            lengths = array.array(_UINT32, map(len, items))
+            return [b"u", struct.pack("<Q", len(items)) + _little_endian(lengths).tobytes() + \
+                    "".join(items).encode("utf-8")]
+        else:
+            return None
+        
+    @staticmethod
+    def _decode_elements(element_code, payload):
+        """return an iterable of elements"""
+        if element_code == b"z":
+            return payload.decode("utf-8").split("\x00")
+        elif element_code == b"u":
+            count = struct.unpack("<Q", payload[:8])[0]
+            lengths = array.array(_UINT32)
+            lengths.frombytes(payload[8:8 + 4 * count])
+            text = payload[8 + 4 * count:].decode("utf-8")
+            offsets = [0]
+            offsets.extend(itertools.accumulate(_little_endian(lengths)))
+            return [text[i:j] for i, j in zip(offsets, offsets[1:])]
+        else:
+            arr = array.array(element_code.decode())
+            arr.frombytes(payload)
+            return _little_endian(arr)
+
+    @staticmethod
+    def _decode(bytestr):
+        container_code = bytestr[1:2]
+        if container_code == b"D":
+            key_code, value_code = bytestr[2:3], bytestr[3:4]
+            length = struct.unpack("<Q", bytestr[4:12])[0]
+            keys = FastCodec._decode_elements(key_code, bytestr[12:12 + length])
+            values = FastCodec._decode_elements(value_code, bytestr[12 + length:])
+            return dict(zip(keys, values))
+        else:
+            return FastCodec._container_type[container_code](
+                FastCodec._decode_elements(bytestr[2:3], bytestr[3:]))
+
+class PackedCodec(BaseCodec):
+    """for STRSET, INTSET, STRLIST, INTLIST column, use packed bytes (int64 array, or 
+    "\x00" joined utf-8 text) instead of "&&" joined text. Packed bytes are converted back by 
+    the registered sqlite3 converter.
+    """
+    name = "packed"
+    
+    def encode(self, obj):
+        """StrSet, IntSet, StrList, IntList -> bytes"""
+        return pack(obj)
+    
+    def decode(self, bytestr):
+        """bytes -> array.array("q") or list of str"""
+        return unpack(bytestr)
+
+class Codec():
+    """codec的容器类, 用法: Column("ids", DataType.pythonlist, codec=Codec.fast)
+    """
+    pickle = PickleCodec()
+    fast = FastCodec()
+    packed = PackedCodec()
+    
+def sql_contains(container, value):
+    """注册到sqlite3中的contains函数, 判断value是否是STRSET, INTSET, STRLIST, INTLIST列中
+    的元素。同时支持"&&"连接的字符串和packed bytes两种格式。
+    
+    用法: SELECT * FROM table WHERE contains(intset_column, 3)
+    """
+    if container is None:
+        return None
+    if isinstance(container, bytes):
+        if is_packed(container):
+            return int(value in unpack(container))
+        container = container.decode("utf-8")
+    # 只有一个元素的"&&"字符串, 如 "1", 可能因为列的NUMERIC affinity被储存为数字
+    return int(str(value) in str(container).split("&&"))
+
+def register_functions(connect):
+    """为一个sqlite3连接注册自定义的SQL函数
+    """
+    connect.create_function("contains", 2, sql_contains)
+    return connect
+
 ##################################################
 #                                                #
 #          Datatype Sqlite3 Converter            #
@@ -735,7 +1147,7 @@ def adapt_list(_LIST):
 
 def convert_list(_STRING):
     """字符串 -> 类 转换"""
-    return bytestr2obj(_STRING)
+    return Codec.pickle.decode(_STRING)
 
 def adapt_set(_SET):
     """类 -> 字符串 转换"""
@@ -743,7 +1155,7 @@ def adapt_set(_SET):
 
 def convert_set(_STRING):
     """字符串 -> 类 转换"""
-    return bytestr2obj(_STRING)
+    return Codec.pickle.decode(_STRING)
 
 def adapt_dict(_DICT):
     """类 -> 字符串 转换"""
@@ -751,7 +1163,7 @@ def adapt_dict(_DICT):
 
 def convert_dict(_STRING):
     """字符串 -> 类 转换"""
-    return bytestr2obj(_STRING)
+    return Codec.pickle.decode(_STRING)
 
 def adapt_ordereddict(_ORDEREDDICT):
     """类 -> 字符串 转换"""
@@ -759,7 +1171,7 @@ def adapt_ordereddict(_ORDEREDDICT):
 
 def convert_ordereddict(_STRING):
     """字符串 -> 类 转换"""
-    return bytestr2obj(_STRING)
+    return Codec.pickle.decode(_STRING)
 
 ##################################################
 #                                                #
@@ -770,20 +1182,42 @@ def convert_ordereddict(_STRING):
 class Column():
     """
 
+    index: 如果为True, 在MetaData.create_all时为这一列创建索引, 复合索引请使用Index
+    codec: PICKLETYPE, PYTHONLIST, PYTHONSET, PYTHONDICT, ORDEREDDICT 类型的列所使用的
+        编码器, 可选 Codec.pickle, Codec.fast。PICKLETYPE默认使用Codec.pickle; 其他类型默认为
+        None, 即交给sqlite3注册的adapter用pickle处理。
     """
-    def __init__(self, column_name, data_type, primary_key=False, nullable=True, default=None):
-        if column_name in ["table_name", "columns", "primary_key_columns", "pickletype_columns", "all"]:
+    def __init__(self, column_name, data_type, primary_key=False, nullable=True, default=None,
+                 index=False, codec=None):
+        if column_name in ["table_name", "columns", "column_names", "primary_key_columns", 
+                           "pickletype_columns", "indexes", "all"]:
             raise Exception("""column name cannot use those system reserved name:
-            "table_name", "columns", "primary_key_columns", "pickletype_columns", "all";""")
+            "table_name", "columns", "column_names", "primary_key_columns", "pickletype_columns", 
+            "indexes", "all";""")
         
         self.column_name = column_name
         self.table_name = None
         self.full_name = None
         self.data_type = data_type
-        self.is_pickletype = self.data_type.name == "PICKLETYPE"
+        # is_pickleobject: 读取时需要在python中解码, 即PICKLETYPE
+        # is_pickletype: 写入时需要在python中用codec编码
+        self.is_pickleobject = self.data_type.name == "PICKLETYPE"
+        if (codec is None) and self.is_pickleobject:
+            codec = Codec.pickle
+        if codec is Codec.packed:
+            if self.data_type.name not in ["STRSET", "INTSET", "STRLIST", "INTLIST"]:
+                raise Exception("Codec.packed only works with STRSET, INTSET, STRLIST, "
+                                "INTLIST columns")
+        elif (codec is not None) and (self.data_type.name not in 
+            ["PICKLETYPE", "PYTHONLIST", "PYTHONSET", "PYTHONDICT", "ORDEREDDICT"]):
+            raise Exception("codec only works with PICKLETYPE, PYTHONLIST, PYTHONSET, "
+                            "PYTHONDICT, ORDEREDDICT columns")
+        self.codec = codec
+        self.is_pickletype = self.codec is not None
         self.primary_key = primary_key
         self.nullable = nullable
         self.default = default
+        self.index = index
         
         # 在SQL语句中我们表示数字, 日期, 字符串, 对象都有不同的格式。例如:
         #     Default 'unknown'
@@ -808,6 +1242,33 @@ class Column():
             "INTLIST": self._sql_INTLIST,
             }
         self.__SQL__ = __SQL__method_mapping[self.data_type.name]
+        
+        # 而在参数化的SQL语句中, 值以 ? 占位, 我们需要把值转化为sqlite3可以直接绑定的类型, 
+        # 也就是 str, int, float, bytes。例如:
+        #     WHERE column_name >= ?, ('2000-01-01',)
+        
+        __PARAM__method_mapping = {
+            "TEXT": self._param_STRING_NUMBER,
+            "INTEGER": self._param_STRING_NUMBER,
+            "REAL": self._param_STRING_NUMBER,
+            "DATE": self._param_DATE,
+            "DATETIME": self._param_DATETIME,
+            "PICKLETYPE": self._param_PICKLETYPE,
+            "PYTHONLIST": self._param_PICKLETYPE,
+            "PYTHONSET": self._param_PICKLETYPE,
+            "PYTHONDICT": self._param_PICKLETYPE,
+            "ORDEREDDICT": self._param_PICKLETYPE,
+            "STRSET": StrSet.sqlite3_adaptor,
+            "INTSET": IntSet.sqlite3_adaptor,
+            "STRLIST": StrList.sqlite3_adaptor,
+            "INTLIST": IntList.sqlite3_adaptor,
+            }
+        self.__PARAM__ = __PARAM__method_mapping[self.data_type.name]
+        
+        # 使用Codec.packed的STRSET, INTSET, STRLIST, INTLIST列与PICKLETYPE一样以bytes储存
+        if self.codec is Codec.packed:
+            self.__SQL__ = self._sql_PICKLETYPE
+            self.__PARAM__ = self._param_PICKLETYPE
              
     def __str__(self):
         """return column_name
@@ -817,11 +1278,16 @@ class Column():
     def __repr__(self):
         """return the string represent the Column object that can recover the object from it
         """
-        return "Column('%s', %s, primary_key=%s, nullable=%s, default=%s)" % (self.column_name,
-                                                                              repr(self.data_type),
-                                                                              self.primary_key,
-                                                                              self.nullable,
-                                                                              repr(self.default),)
+        text = "Column('%s', %s, primary_key=%s, nullable=%s, default=%s" % (self.column_name,
+                                                                             repr(self.data_type),
+                                                                             self.primary_key,
+                                                                             self.nullable,
+                                                                             repr(self.default),)
+        if self.index:
+            text += ", index=True"
+        if self.codec not in [None, Codec.pickle]:
+            text += ", codec=%s" % repr(self.codec)
+        return text + ")"
 
     # 下面这些_sql开头的方法是用于让不同的数据类型在SQL语句中正确的显示, 比如字符串的两边在SQL中
     # 要加'', 比如byte在Sql中是以 X'0482e0891ab87' 的形式表达的。
@@ -845,7 +1311,7 @@ class Column():
     def _sql_PICKLETYPE(self, value):
         """if it is python object, in sql command we convert it to byte string, like 'gx4=fjl82d...'
         """
-        return "X'%s'" % bytestr2hexstring(obj2bytestr(value))
+        return "X'%s'" % bytestr2hexstring(self._param_PICKLETYPE(value))
 
     def _sql_STRSET(self, value):
         """if it is StrSet, in sql commend we use 'item1&&item2&&...&&itemN'
@@ -867,6 +1333,29 @@ class Column():
         """
         return repr(IntList.sqlite3_adaptor(value))
 
+    # 下面这些_param开头的方法是用于把不同数据类型的值转化为参数化SQL语句中绑定的参数。
+    # 与_sql开头的方法一一对应, 区别在于_param返回的是值本身而不是SQL中的字符串。
+    
+    def _param_STRING_NUMBER(self, value):
+        """string and number are bound as it is
+        """
+        return value
+    
+    def _param_DATE(self, value):
+        """datetime.date object is bound as '1999-01-01'
+        """
+        return str(value)
+    
+    def _param_DATETIME(self, value):
+        """datetime.datetime object is bound as '1999-01-01 06:30:00'
+        """
+        return str(value)[:19]
+    
+    def _param_PICKLETYPE(self, value):
+        """python object is bound as byte string encoded by column codec
+        """
+        return (self.codec or Codec.pickle).encode(value)
+    
     def create_table_sql(self):
         """generate the definition part of 'CREATE TABLE (...)' SQL command
         by column name, data type, constrains.
@@ -901,47 +1390,64 @@ class Column():
     """
     
     def __lt__(self, other):
-        return _Select_config("%s < %s" % (self.column_name, self.__SQL__(other) ) )
+        return _Select_config("%s < ?" % self.column_name, (self.__PARAM__(other),),
+                              ((self.column_name, "range"),) )
 
     def __le__(self, other):
-        return _Select_config("%s <= %s" % (self.column_name, self.__SQL__(other) ) )
+        return _Select_config("%s <= ?" % self.column_name, (self.__PARAM__(other),),
+                              ((self.column_name, "range"),) )
     
     def __eq__(self, other):
         if other == None: # if Column == None, means column_name is Null
-            return _Select_config("%s IS NULL" % self.column_name)
+            return _Select_config("%s IS NULL" % self.column_name, (), 
+                                  ((self.column_name, "eq"),) )
         else:
-            return _Select_config("%s = %s" % (self.column_name, self.__SQL__(other) ) )
+            return _Select_config("%s = ?" % self.column_name, (self.__PARAM__(other),),
+                                  ((self.column_name, "eq"),) )
         
     def __ne__(self, other):
         if other == None: # if Column != None, means column_name NOT Null
             return _Select_config("%s NOT NULL" % self.column_name)
         else:
-            return _Select_config("%s != %s" % (self.column_name, self.__SQL__(other) ) )
+            return _Select_config("%s != ?" % self.column_name, (self.__PARAM__(other),) )
         
     def __gt__(self, other):
-        return _Select_config("%s > %s" % (self.column_name, self.__SQL__(other) ) )
+        return _Select_config("%s > ?" % self.column_name, (self.__PARAM__(other),),
+                              ((self.column_name, "range"),) )
     
     def __ge__(self, other):
-        return _Select_config("%s >= %s" % (self.column_name, self.__SQL__(other) ) )
+        return _Select_config("%s >= ?" % self.column_name, (self.__PARAM__(other),),
+                              ((self.column_name, "range"),) )
     
     def between(self, lowerbound, upperbound):
         """WHERE...BETWEEN...AND... clause
         """
-        return _Select_config("%s BETWEEN %s AND %s" % (self.column_name,
-                                                        self.__SQL__(lowerbound),
-                                                        self.__SQL__(upperbound),))
+        return _Select_config("%s BETWEEN ? AND ?" % self.column_name,
+                              (self.__PARAM__(lowerbound), self.__PARAM__(upperbound)),
+                              ((self.column_name, "range"),) )
 
     def like(self, wildcards):
         """WHERE...LIKE... clause
         """
-        return _Select_config("%s LIKE %s" % (self.column_name, self.__SQL__(wildcards)))
+        return _Select_config("%s LIKE ?" % self.column_name, (self.__PARAM__(wildcards),),
+                              ((self.column_name, "range"),) )
 
     def in_(self, candidates):
         """WHERE...IN... clause
         """
-        return _Select_config("%s IN (%s)" % (self.column_name,
-            ", ".join([self.__SQL__(candidate) for candidate in candidates])
-            ))
+        params = tuple([self.__PARAM__(candidate) for candidate in candidates])
+        return _Select_config("%s IN (%s)" % (self.column_name, ", ".join(["?"] * len(params))),
+                              params, ((self.column_name, "eq"),) )
+    
+    def contains(self, element):
+        """WHERE element IN set_column, only for STRSET, INTSET, STRLIST, INTLIST column. 
+        element can be a value or another Column
+        """
+        if isinstance(element, Column):
+            return _Select_config("contains(%s, %s)" % (self.column_name, element.column_name))
+        else:
+            return _Select_config("contains(%s, ?)" % self.column_name, (element,))
+        
     ## for Update().values() method. example: Update.values(column_name = column_name + 100)
     """
     由于在Update API中的values()方法使用计算符对column进行设定, 所以我们定义了
@@ -956,25 +1462,25 @@ class Column():
         if isinstance(other, Column):
             return _Update_config("%s + %s" % (self.column_name, other.column_name) )
         else:
-            return _Update_config("%s + %s" % (self.column_name, self.__SQL__(other)) )
+            return _Update_config("%s + ?" % self.column_name, (self.__PARAM__(other),) )
     
     def __sub__(self, other):
         if isinstance(other, Column):
             return _Update_config("%s - %s" % (self.column_name, other.column_name) )
         else:
-            return _Update_config("%s - %s" % (self.column_name, self.__SQL__(other)) )
+            return _Update_config("%s - ?" % self.column_name, (self.__PARAM__(other),) )
     
     def __mul__(self, other):
         if isinstance(other, Column):
             return _Update_config("%s * %s" % (self.column_name, other.column_name) )
         else:
-            return _Update_config("%s * %s" % (self.column_name, self.__SQL__(other)) )
+            return _Update_config("%s * ?" % self.column_name, (self.__PARAM__(other),) )
     
     def __truediv__(self, other):
         if isinstance(other, Column):
             return _Update_config("%s / %s" % (self.column_name, other.column_name) )
         else:
-            return _Update_config("%s / %s" % (self.column_name, self.__SQL__(other)) )
+            return _Update_config("%s / ?" % self.column_name, (self.__PARAM__(other),) )
     
     def __pos__(self):
         return _Update_config("- %s" % self.column_name)
@@ -983,6 +1489,52 @@ class Column():
         return _Update_config("+ %s" % self.column_name)
     
 
+##################################################
+#                                                #
+#                  Index class                   #
+#                                                #
+##################################################
+
+class Index():
+    """Represent a (composite) index of a table. Pass it to Table just like a Column.
+    
+    e.g.::
+        mytable = Table("mytable", metadata,
+                    Column("mytable_id", INTEGER(), primary_key=True),
+                    Column("name", TEXT()),
+                    Column("date", DATE()),
+                    Index("ix_mytable_name_date", "name", "date"),
+                    )
+    
+    columns can be column name or Column object
+    """
+    def __init__(self, index_name, *columns, **kwarg):
+        self.index_name = index_name
+        self.column_names = tuple([str(column) for column in columns])
+        self.unique = kwarg.get("unique", False)
+        self.table_name = None
+    
+    def __str__(self):
+        return self.index_name
+    
+    def __repr__(self):
+        text = "Index(%s" % ", ".join([repr(i) for i in (self.index_name,) + self.column_names])
+        if self.unique:
+            text += ", unique=True"
+        return text + ")"
+    
+    def create_index_sql(self):
+        """generate the 'CREATE INDEX...' SQL command
+        
+        example output:
+        
+            CREATE INDEX IF NOT EXISTS ix_movie_title ON movie (title);
+        """
+        return "CREATE %sINDEX IF NOT EXISTS %s ON %s (%s);" % ("UNIQUE " if self.unique else "",
+                                                                self.index_name, 
+                                                                self.table_name, 
+                                                                ", ".join(self.column_names))
+
 ##################################################
 #                                                #
 #                  Table class                   #
@@ -1002,15 +1554,22 @@ class Table():
 
     e.g.::
         mytable_id = mytable.mytable_id
-
+    
+    Index can be passed in args as well, or use Column(..., index=True)
     """
     def __init__(self, table_name, metadata, *args):
         self.table_name = table_name
         self.columns = OrderedDict()
         self.primary_key_columns = list()
         self.pickletype_columns = list()
+        self.indexes = list()
+        self._compiled_inserts = dict() # {column_names: _CompiledInsert}, 参考Insert.compile
         
         for column in args:
+            if isinstance(column, Index):
+                column.table_name = self.table_name
+                self.indexes.append(column)
+                continue
             # 将column与table绑定后, column就会多出两个table_name和full_name的属性
             column.table_name = self.table_name
             column.full_name = "%s.%s" % (self.table_name, column.column_name)
@@ -1020,8 +1579,13 @@ class Table():
                 self.primary_key_columns.append(column.column_name)
             if column.is_pickletype:
                 self.pickletype_columns.append(column.column_name)
+            if column.index:
+                index = Index("ix_%s_%s" % (self.table_name, column.column_name), column)
+                index.table_name = self.table_name
+                self.indexes.append(index)
         
         self.all = list(self.columns.values() );
+        self.column_names = tuple(self.columns)
                 
         metadata.tables[self.table_name] = self
         
@@ -1066,6 +1630,11 @@ class Table():
                            cmd_DATATYPE,
                            cmd_PRIMARY_KEY,)
     
+    def create_index_sql(self):
+        """generate the 'CREATE INDEX...' SQL commands of all indexes of this table
+        """
+        return [index.create_index_sql() for index in self.indexes]
+    
     def insert(self):
         """create a Insert object
         """
@@ -1090,6 +1659,255 @@ class Table():
 #                                                #
 ##################################################
 
+# 批量导入数据时所使用的PRAGMA设置, 用于Sqlite3Engine.bulk_load
+#     fast: 最快, 但如果导入过程中断电或者系统崩溃, 数据库文件可能损坏。适用于从零开始构建的数据库
+#     safe: 使用WAL模式, 比默认设置快得多, 但不会损坏数据库
+PRAGMA_PROFILES = {
+    "fast": OrderedDict([
+        ("journal_mode", "MEMORY"),
+        ("synchronous", "OFF"),
+        ("cache_size", -262144), # 256MB, 负数的单位是KB
+        ("temp_store", "MEMORY"),
+        ("mmap_size", 268435456), # 256MB
+        ]),
+    "safe": OrderedDict([
+        ("journal_mode", "WAL"),
+        ("synchronous", "NORMAL"),
+        ("cache_size", -65536), # 64MB
+        ("temp_store", "MEMORY"),
+        ("mmap_size", 268435456),
+        ]),
+    }
+
+_comment_pattern = re.compile(r"^(\s+|--[^\n]*\n?|/\*.*?\*/)*", re.DOTALL)
+
+def _is_read_only(sqlcmd):
+    """判断一条SQL是否是只读的: SELECT, EXPLAIN, 以及不带 "=" 的PRAGMA。
+    WITH开头的语句可能是 WITH ... DELETE, 视为写操作。
+    """
+    sqlcmd = _comment_pattern.sub("", sqlcmd, count=1)
+    keyword = sqlcmd[:7].upper()
+    if keyword.startswith("SELECT") or keyword.startswith("EXPLAIN"):
+        return True
+    if keyword.startswith("PRAGMA"):
+        return "=" not in sqlcmd
+    return False
+
+def _is_row_error(e):
+    """判断异常是否只与某一行的数据有关: 数据类型无法被sqlite3接受 (InterfaceError, 
+    以及新版本python中的 "Error binding parameter" ProgrammingError), 或者整数溢出。
+    """
+    if isinstance(e, (sqlite3.InterfaceError, OverflowError)):
+        return True
+    if isinstance(e, sqlite3.ProgrammingError) and str(e).startswith("Error binding parameter"):
+        return True
+    return False
+
+class BulkInsertReport():
+    """Sqlite3Engine.insert_many_records/insert_many_rows的返回值, 记录批量插入的结果:
+        inserted: 成功插入的条数
+        skipped: 因为IntegrityError (例如primary key冲突) 而被跳过的条数
+        failed: 因为其他错误 (例如数据类型无法被sqlite3接受) 而插入失败的条数
+    """
+    def __init__(self):
+        self.inserted = 0
+        self.skipped = 0
+        self.failed = 0
+    
+    def __repr__(self):
+        return "BulkInsertReport(inserted=%s, skipped=%s, failed=%s)" % (self.inserted,
+                                                                          self.skipped,
+                                                                          self.failed,)
+
+class IndexAdvisor():
+    """索引顾问。记录通过Sqlite3Engine.select执行的查询的WHERE条件形状 (哪些列做等值比较, 
+    哪一列做范围比较), 并用 EXPLAIN QUERY PLAN 检查每一种形状是否导致全表扫描。
+    
+    用法:
+        advisor = engine.enable_index_advisor()
+        ... 执行查询 ...
+        advisor.suggest() # 返回建议创建的Index列表, 按查询次数从多到少排列
+    
+    如果auto_create=True, 发现全表扫描时会立即创建所建议的索引。
+    """
+    def __init__(self, engine, auto_create=False):
+        self.engine = engine
+        self.auto_create = auto_create
+        self.shapes = Counter() # {(table_name, 等值比较的列, 范围比较的列): 执行次数}
+        self.full_scans = set() # 导致全表扫描的形状
+        self.created = list() # 自动创建的Index
+        self._checked = set()
+    
+    @staticmethod
+    def shape_of(select_obj):
+        """返回查询的WHERE条件形状 (table_name, eq_columns, range_column), 没有WHERE条件时
+        返回None。复合索引中等值比较的列在前, 范围比较的列在最后。
+        """
+        eq_columns, range_columns = list(), list()
+        for column_name, kind in select_obj.where_predicates:
+            if kind == "eq":
+                if column_name not in eq_columns:
+                    eq_columns.append(column_name)
+            else:
+                range_columns.append(column_name)
+        range_columns = [i for i in range_columns if i not in eq_columns]
+        if not (eq_columns or range_columns):
+            return None
+        return (select_obj.table_name, tuple(eq_columns), 
+                range_columns[0] if range_columns else None)
+    
+    @staticmethod
+    def index_of(shape):
+        """根据WHERE条件形状生成建议的Index
+        """
+        table_name, eq_columns, range_column = shape
+        column_names = eq_columns + ((range_column,) if range_column else ())
+        index = Index("ix_%s_%s" % (table_name, "_".join(column_names)), *column_names)
+        index.table_name = table_name
+        return index
+    
+    def query_plan(self, select_obj):
+        """返回 EXPLAIN QUERY PLAN 的结果, 例如 ["SCAN movie"]
+        """
+        sqlcmd, params = select_obj.toParamSQL()
+        with self.engine._read_connection() as connect:
+            return [record[-1] for record in 
+                    connect.execute("EXPLAIN QUERY PLAN %s" % sqlcmd, params)]
+    
+    def is_full_scan(self, select_obj):
+        """查询是否对表进行了全表扫描, 即 "SCAN movie" 或老版本sqlite中的 "SCAN TABLE movie"
+        """
+        for detail in self.query_plan(select_obj):
+            words = detail.split()
+            if words[:1] == ["SCAN"] and select_obj.table_name in words[1:3] and \
+                    "INDEX" not in words:
+                return True
+        return False
+    
+    def record(self, select_obj):
+        """记录一次查询, 第一次遇到某种形状时检查它是否导致全表扫描
+        """
+        shape = self.shape_of(select_obj)
+        if shape is None:
+            return
+        self.shapes[shape] += 1
+        if shape not in self._checked:
+            self._checked.add(shape)
+            if self.is_full_scan(select_obj):
+                self.full_scans.add(shape)
+                if self.auto_create:
+                    self.create(shape)
+    
+    def create(self, shape):
+        """为一种WHERE条件形状创建索引
+        """
+        index = self.index_of(shape)
+        self.engine.execute(index.create_index_sql())
+        self.full_scans.discard(shape)
+        self.created.append(index)
+        return index
+    
+    def suggest(self):
+        """返回所有导致全表扫描的查询所建议的Index, 按查询次数从多到少排列
+        """
+        return [self.index_of(shape) for shape, _ in self.shapes.most_common() 
+                if shape in self.full_scans]
+
+def _sizeof(records):
+    """估计一组records所占用的内存"""
+    size = sys.getsizeof(records)
+    for record in records:
+        size += sys.getsizeof(record) + sum([sys.getsizeof(value) for value in record])
+    return size
+
+class QueryCache():
+    """查询结果缓存。以 (SQL语句, 参数) 为键缓存select的结果, 按LRU淘汰, 条数不超过maxsize, 
+    估计占用的内存不超过maxmemory (bytes)。
+    
+    每个表有一个版本号, engine对表进行写操作 (insert_*, upsert_*, update, execute, Table.drop) 
+    时版本号增加, 该表的所有缓存失效。其他连接commit修改时 (PRAGMA data_version发生变化), 
+    所有缓存失效。
+    
+    注意: 缓存命中时返回的是同一组record, PICKLETYPE等可变对象请不要原地修改。
+    
+    hits, misses, evictions 记录了命中, 未命中, 被淘汰的次数, 用于调整maxsize和maxmemory。
+    """
+    def __init__(self, maxsize=1024, maxmemory=64 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.maxmemory = maxmemory
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict() # {(table_name, key): (records, size)}
+        self._versions = Counter() # {table_name: version}
+        self._epoch = 0 # 所有缓存失效时增加
+        self._lock = threading.Lock()
+    
+    def __repr__(self):
+        return "QueryCache(hits=%s, misses=%s, evictions=%s, size=%s, memory=%s)" % (
+            self.hits, self.misses, self.evictions, len(self._entries), self.memory)
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def version(self, table_name):
+        return (self._epoch, self._versions[table_name])
+    
+    def get(self, table_name, key):
+        """返回缓存的records, 没有时返回None
+        """
+        with self._lock:
+            try:
+                records, size = self._entries.pop((table_name, key))
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries[(table_name, key)] = (records, size) # 移到最近使用的位置
+            self.hits += 1
+            return records
+    
+    def put(self, table_name, key, records, version):
+        """放入缓存。如果在执行查询期间表被修改了 (版本号不等于version), 则不放入
+        """
+        size = _sizeof(records)
+        if size > self.maxmemory:
+            return
+        with self._lock:
+            if self.version(table_name) != version:
+                return
+            old = self._entries.pop((table_name, key), None)
+            if old is not None:
+                self.memory -= old[1]
+            self._entries[(table_name, key)] = (records, size)
+            self.memory += size
+            while (len(self._entries) > self.maxsize) or (self.memory > self.maxmemory):
+                _, (_, size) = self._entries.popitem(last=False)
+                self.memory -= size
+                self.evictions += 1
+    
+    def invalidate(self, table=None):
+        """使table (或所有表) 的缓存失效
+        """
+        with self._lock:
+            if table is None:
+                self._epoch += 1
+                self._entries.clear()
+                self.memory = 0
+            else:
+                table_name = str(table)
+                self._versions[table_name] += 1
+                for key in [key for key in self._entries if key[0] == table_name]:
+                    self.memory -= self._entries.pop(key)[1]
+    
+    def clear(self):
+        """清空缓存和计数器
+        """
+        with self._lock:
+            self._entries.clear()
+            self.memory = 0
+            self.hits = self.misses = self.evictions = 0
+
 class Sqlite3Engine():
     def __init__(self, dbname, autocommit=True):
         self.dbname = dbname
@@ -1119,15 +1937,38 @@ class Sqlite3Engine():
         sqlite3.register_adapter(IntList, IntList.sqlite3_adaptor)
         sqlite3.register_converter("INTLIST", IntList.sqlite3_converter)
 
-        self.connect = sqlite3.connect(dbname, detect_types=sqlite3.PARSE_DECLTYPES)
+        self.connect = self._connect(dbname)
         self.cursor = self.connect.cursor()
         
+        self._commit_every = None # 仅在bulk_load中使用, 每写入多少条数据commit一次
+        self._uncommitted = 0
+        self.index_advisor = None
+        
+        # 行数统计的缓存 {table_name: 行数}, 由本engine的写操作维护, 参考howmany
+        self._row_counts = dict()
+        self._data_version = None
+        self.query_cache = None
+        
         if self.is_autocommit:
             self._commit = self.commit
         else:
             self._commit = self.commit_nothing
 
+    def _connect(self, dbname):
+        """open a new sqlite3 connection to dbname
+        """
+        return register_functions(sqlite3.connect(dbname, detect_types=sqlite3.PARSE_DECLTYPES))
+    
+    @contextlib.contextmanager
+    def _read_connection(self):
+        """the connection used for read-only query. Sqlite3Engine only have one connection, 
+        Sqlite3PoolEngine borrow one from the reader pool.
+        """
+        yield self.connect
+    
     def execute(self, *args, **kwarg):
+        if not _is_read_only(args[0] if args else kwarg.get("sql", "")):
+            self._table_changed() # 除了只读的SQL, 都有可能改变表的行数
         return self.cursor.execute(*args, **kwarg)
     
     def commit(self):
@@ -1150,135 +1991,314 @@ class Sqlite3Engine():
             self.is_autocommit = False
             self._commit = self.commit_nothing
             
+    ### === Bulk load ===
+    def _read_pragma(self, names):
+        """return the current {pragma_name: value} of the database. Pragma which has no value 
+        (for example, mmap_size of a :memory: database) is not included.
+        """
+        settings = OrderedDict()
+        for name in names:
+            record = self.cursor.execute("PRAGMA %s" % name).fetchone()
+            if record is not None:
+                settings[name] = record[0]
+        return settings
+    
+    def _apply_pragma(self, settings):
+        """set PRAGMA name = value for each setting. Setting cannot be applied (for example, 
+        journal_mode of a :memory: database) is ignored.
+        """
+        for name, value in settings.items():
+            try:
+                self.cursor.execute("PRAGMA %s = %s" % (name, value))
+            except sqlite3.OperationalError:
+                pass
+    
+    def _commit_periodically(self):
+        """bulk_load模式下的_commit, 每一次单条写入计为1条数据
+        """
+        self._tick(1)
+    
+    def _tick(self, n):
+        """bulk_load模式下, 记录已经写入了n条数据, 每满commit_every条commit一次。其他模式下什么都不做。
+        """
+        if self._commit_every:
+            self._uncommitted += n
+            if self._uncommitted >= self._commit_every:
+                self.commit()
+                self._uncommitted = 0
+    
+    @contextlib.contextmanager
+    def bulk_load(self, profile="fast", commit_every=100000):
+        """a context manager for loading large amount of data.
+        
+        [CN]在with语句块中:
+            1. 应用profile所指定的PRAGMA设置 (journal_mode, synchronous, cache_size, temp_store, 
+            mmap_size), 参考PRAGMA_PROFILES。profile也可以是一个 {pragma_name: value} 的字典。
+            2. 所有的insert_*, upsert_*, update都在同一个事务中进行, 每写入commit_every条数据才
+            commit一次, 而不是每一次操作都commit。
+        离开with语句块时, commit剩余的数据, 并把PRAGMA和autocommit恢复成原来的设置。如果发生异常, 
+        则rollback尚未commit的数据。
+        
+        usage:
+            with engine.bulk_load("fast", commit_every=100000):
+                engine.insert_many_records(ins, records)
+        """
+        if not isinstance(profile, dict):
+            profile = PRAGMA_PROFILES[profile]
+        
+        self.commit() # PRAGMA必须在事务之外设置
+        original_settings = self._read_pragma(profile)
+        original_autocommit = self.is_autocommit
+        self._apply_pragma(profile)
+        self._commit = self._commit_periodically
+        self._commit_every = commit_every
+        self._uncommitted = 0
+        try:
+            yield self
+            self.commit()
+        except:
+            self.connect.rollback()
+            self._table_changed()
+            raise
+        finally:
+            self._commit_every = None
+            self._uncommitted = 0
+            self.autocommit(original_autocommit)
+            self._apply_pragma(original_settings)
+    
+    @contextlib.contextmanager
+    def savepoint(self, name="savepoint"):
+        """a context manager, the writes in the with block are either all kept or all undone.
+        
+        [CN]在一个SAVEPOINT中执行with语句块中的写操作。如果发生异常, 回滚到SAVEPOINT, 使缓存的
+        行数和查询结果失效, 然后重新抛出异常。离开时只RELEASE, 不会commit外层的事务, 所以with
+        语句块中不能commit, 通常在autocommit(False)或者bulk_load(commit_every=None)中使用。
+        
+        usage:
+            with engine.bulk_load("safe", commit_every=None):
+                with engine.savepoint():
+                    engine.insert_many_records(ins, records)
+                engine.commit()
+        """
+        self._begin()
+        self.cursor.execute("SAVEPOINT %s" % name)
+        try:
+            yield self
+        except:
+            self.cursor.execute("ROLLBACK TO SAVEPOINT %s" % name)
+            self.cursor.execute("RELEASE SAVEPOINT %s" % name)
+            self._table_changed()
+            raise
+        self.cursor.execute("RELEASE SAVEPOINT %s" % name)
+    
     ### === Insert ===
     def insert_record(self, insert_obj, record):
         """插入单条记录"""
-        insert_obj.sqlcmd_from_record()
-        self.cursor.execute(insert_obj.insert_sqlcmd, insert_obj.default_record_converter(record))
+        compiled = insert_obj.compile()
+        self.cursor.execute(compiled.insert_sqlcmd, compiled.record_converter(record))
+        self._table_inserted(insert_obj.table, 1)
         self._commit()
 
-    def insert_many_records(self, insert_obj, records):
-        """插入多条记录"""
-        insert_obj.sqlcmd_from_record()
-        for record in records:
-            try:
-                self.cursor.execute(insert_obj.insert_sqlcmd, insert_obj.default_record_converter(record))
-            except:
-                pass
-        self._commit()
+    def insert_many_records(self, insert_obj, records, chunksize=5000):
+        """插入多条记录, 以chunksize为单位批量executemany。遇到IntegrityError的记录会被跳过。
+        returns a BulkInsertReport
+        """
+        compiled = insert_obj.compile()
+        report = self._bulk_insert(compiled.insert_sqlcmd, 
+                                   compiled.record_converter, 
+                                   records, chunksize)
+        self._table_inserted(insert_obj.table, report.inserted)
+        return report
         
     def insert_row(self, insert_obj, row):
         """插入单条Row object"""
-        insert_obj.sqlcmd_from_row(row)
-        self.cursor.execute(insert_obj.insert_sqlcmd, insert_obj.default_row_converter(row))
+        compiled = insert_obj.compile(row.columns)
+        self.cursor.execute(compiled.insert_sqlcmd, compiled.row_converter(row))
+        self._table_inserted(insert_obj.table, 1)
         self._commit()
     
-    def _insert_many_rows_list_mode(self, insert_obj, rows):
-        """内部函数, 以列表模式插入多条Row object"""
-        row = rows[0]
-        insert_obj.sqlcmd_from_row(row)
-        if set(row.columns).isdisjoint(set(insert_obj.table.pickletype_columns)): # 如果没有交集
-            insert_obj.current_converter = insert_obj.nonpicklize_row
-        else: # 如果有交集, 要用到picklize_row
-            insert_obj.current_converter = insert_obj.picklize_row
+    def insert_many_rows(self, insert_obj, rows, chunksize=5000):
+        """插入多条Row object, rows可以是列表也可以是生成器。所有的Row必须和第一个Row拥有相同的
+        columns。以chunksize为单位批量executemany, 遇到IntegrityError的Row会被跳过。
+        returns a BulkInsertReport
+        """
+        rows = iter(rows)
+        try:
+            row = next(rows)
+        except StopIteration:
+            return BulkInsertReport()
         
-        for row in rows:
-            try:
-                self.cursor.execute(insert_obj.insert_sqlcmd, insert_obj.current_converter(row))
-            except:
-                pass
-        self._commit()
-                
-    def _insert_many_rows_generator_mode(self, insert_obj, rows):
-        """内部函数, 以生成器模式插入多条Row object"""
-        row = next(rows)
-        insert_obj.sqlcmd_from_row(row)
-        if set(row.columns).isdisjoint(set(insert_obj.table.pickletype_columns)): # 如果没有交集
-            insert_obj.current_converter = insert_obj.nonpicklize_row
-        else: # 如果有交集, 要用到picklize_row
-            insert_obj.current_converter = insert_obj.picklize_row
+        compiled = insert_obj.compile(row.columns)
+        report = self._bulk_insert(compiled.insert_sqlcmd, 
+                                   compiled.row_converter, 
+                                   itertools.chain([row], rows), chunksize)
+        self._table_inserted(insert_obj.table, report.inserted)
+        return report
+    
+    def _begin(self):
+        """如果当前没有处于事务中, 则显式开启一个事务。这样之后的SAVEPOINT都是嵌套的, 
+        RELEASE时不会提前commit。
+        """
+        if not self.connect.in_transaction:
+            self.cursor.execute("BEGIN")
             
-        try: # manually insert the first element of the generator
-            self.cursor.execute(insert_obj.insert_sqlcmd, insert_obj.current_converter(row))
-        except:
-            pass
+    def _bulk_insert(self, sqlcmd, converter, items, chunksize):
+        """内部函数, 批量插入的内核。
         
-        for row in rows:
-            try:
-                self.cursor.execute(insert_obj.insert_sqlcmd, insert_obj.current_converter(row))
-            except:
-                pass
-        self._commit()
-
-    def insert_many_rows(self, insert_obj, rows):
-        """自动判断以生成器模式还是列表模式插入多条Row object
+        把items按照chunksize分包, 每一包在一个SAVEPOINT中用executemany一次性插入。如果某一包
+        插入失败(通常是IntegrityError), 则回滚到SAVEPOINT, 仅对这一包逐条插入:
+            IntegrityError的条目计入skipped, 其他错误的条目计入failed
+        没有问题的包则完全不需要逐条插入。参考angora_unittest/SQLITE/bulk_insert_test.md
+        
+        只有行级别的错误 (参考_is_row_error) 会被计数, 表不存在, 列名错误等与具体某一行无关的
+        错误会直接抛出。
         """
-        try:
-            self._insert_many_rows_generator_mode(insert_obj, rows)
-        except:
-            self._insert_many_rows_list_mode(insert_obj, rows)
+        report = BulkInsertReport()
+        for chunk in _chunked(items, chunksize):
+            self._begin()
+            params_list = list()
+            for item in chunk:
+                try:
+                    params_list.append(converter(item))
+                except Exception:
+                    report.failed += 1
+            
+            self.cursor.execute("SAVEPOINT bulk_insert")
+            try:
+                self.cursor.executemany(sqlcmd, params_list)
+                self.cursor.execute("RELEASE SAVEPOINT bulk_insert")
+                report.inserted += len(params_list)
+            except (sqlite3.Error, OverflowError): # 整包失败, 回滚后逐条插入
+                self.cursor.execute("ROLLBACK TO SAVEPOINT bulk_insert")
+                self.cursor.execute("RELEASE SAVEPOINT bulk_insert")
+                for params in params_list:
+                    try:
+                        self.cursor.execute(sqlcmd, params)
+                        report.inserted += 1
+                    except sqlite3.IntegrityError:
+                        report.skipped += 1
+                    except Exception as e:
+                        if not _is_row_error(e):
+                            raise
+                        report.failed += 1
+            self._tick(len(chunk))
+        if not self._commit_every: # bulk_load模式下由_tick负责commit
+            self._commit()
+        return report
     
     ### === insert and update ===
+    def upsert_many_records(self, insert_obj, records, chunksize=5000):
+        """插入多条记录, 如果primary key已经存在, 则用记录中的值更新该行。
+        整个过程只使用一条 INSERT ... ON CONFLICT DO UPDATE 语句, 以chunksize为单位批量executemany。
+        returns a BulkInsertReport, 其中inserted为插入和更新的总条数
+        """
+        compiled = insert_obj.compile()
+        self._table_changed(insert_obj.table) # 无法区分插入和更新的条数
+        return self._bulk_insert(compiled.upsert_sqlcmd, 
+                                 compiled.record_converter, 
+                                 records, chunksize)
+    
+    def upsert_many_rows(self, insert_obj, rows, chunksize=5000):
+        """插入多条Row object, 如果primary key已经存在, 则用Row中的值更新该行。
+        所有的Row必须和第一个Row拥有相同的columns。
+        returns a BulkInsertReport, 其中inserted为插入和更新的总条数
+        """
+        rows = iter(rows)
+        try:
+            row = next(rows)
+        except StopIteration:
+            return BulkInsertReport()
+        
+        compiled = insert_obj.compile(row.columns)
+        self._table_changed(insert_obj.table) # 无法区分插入和更新的条数
+        return self._bulk_insert(compiled.upsert_sqlcmd, 
+                                 compiled.row_converter, 
+                                 itertools.chain([row], rows), chunksize)
+        
     def insert_and_update_many_records(self, insert_obj, records):
-        update_obj = insert_obj.table.update()
-        insert_obj.sqlcmd_from_record()
-        
-        for record in records: # try insert one by one
-            try: # try insert
-                self.cursor.execute(insert_obj.insert_sqlcmd, 
-                                    insert_obj.default_record_converter(record))
-            except sqlite3.IntegrityError:
-                values_kwarg = dict() # update.values()'s argument
-                where_args = list() # update.values().where()'s argument
-                 
-                for column_name, column, value in zip(update_obj.table.columns,
-                                                      update_obj.table.columns.values(),
-                                                      record):
-                    values_kwarg[column_name] = value # fill in values dictionary
-                    if column.primary_key: # use primary_key value to locate the row to update
-                        where_args.append( column == value)
-                
-                # update one
-                self.update( update_obj.values(**values_kwarg).where(*where_args) )
-                
-        self._commit()
+        """try insert, if primary key conflict, then update. equivalent to upsert_many_records
+        """
+        return self.upsert_many_records(insert_obj, records)
 
     def insert_and_update_many_rows(self, insert_obj, rows):
-        update_obj = insert_obj.table.update()
-        
-        for row in rows: # try insert one by one
-            try: # try insert
-                insert_obj.sqlcmd_from_row(row)
-                self.cursor.execute(insert_obj.insert_sqlcmd, insert_obj.default_row_converter(row))
-                
-            except sqlite3.IntegrityError:
-                values_kwarg = dict() # update.values()'s argument
-                where_args = list() # update.values().where()'s argument
-                
-                for column_name, value in zip(row.columns, row.values):
-                    column = update_obj.table.columns[column_name]
-                    values_kwarg[column_name] = value # fill in values dictionary
-                    if column.primary_key:
-                        where_args.append( column == value)
-                
-                # update one
-                self.update( update_obj.values(**values_kwarg).where(*where_args) )
-                
-        self._commit()
+        """try insert, if primary key conflict, then update. equivalent to upsert_many_rows
+        """
+        return self.upsert_many_rows(insert_obj, rows)
         
     ### === Select ===
-    def select(self, select_obj):
+    def enable_index_advisor(self, auto_create=False):
+        """开始记录所有select查询的WHERE条件, 并对导致全表扫描的查询建议或自动创建索引。
+        详见IndexAdvisor
+        """
+        self.index_advisor = IndexAdvisor(self, auto_create)
+        return self.index_advisor
+    
+    def enable_query_cache(self, maxsize=1024, maxmemory=64 * 1024 * 1024):
+        """开启查询结果缓存, 详见QueryCache
+        """
+        self.query_cache = QueryCache(maxsize, maxmemory)
+        return self.query_cache
+    
+    def disable_query_cache(self):
+        self.query_cache = None
+    
+    def select(self, select_obj, arraysize=1000, batch=False):
         """以生成器形式返回行数据
+        
+        每一次查询使用单独的cursor, 所以嵌套的select互不影响。数据以fetchmany(arraysize)分批读取,
+        PICKLETYPE的解码也按批进行。
+        
+        [Args]
+        ------
+            arraysize: 每次fetchmany的条数
+            batch: 如果为True, 每次返回一批(list)行数据, 而不是一行
+        """
+        if self.index_advisor is not None:
+            self.index_advisor.record(select_obj)
+        if self.query_cache is None:
+            batches = self._select_batches(select_obj, arraysize)
+        else:
+            batches = self._cached_select_batches(select_obj, arraysize)
+        for records in batches:
+            if batch:
+                yield records
+            else:
+                for record in records:
+                    yield record
+    
+    def _select_batches(self, select_obj, arraysize):
+        """执行查询, 每次返回一批转换好的行数据
+        """
+        with self._read_connection() as connect:
+            cursor = connect.cursor()
+            cursor.execute(*select_obj.toParamSQL())
+            for records in iterbatch(cursor, arraysize):
+                yield select_obj.default_batch_converter(records)
+    
+    def _cached_select_batches(self, select_obj, arraysize):
+        """优先从查询缓存中读取结果。缓存中没有时执行查询, 并在所有结果都被读取后放入缓存
         """
-        for record in self.cursor.execute(select_obj.toSQL()):
-            yield select_obj.default_record_converter(record)
+        self._check_data_version()
+        key = select_obj.toParamSQL()
+        records = self.query_cache.get(select_obj.table_name, key)
+        if records is not None:
+            for i in range(0, len(records), arraysize):
+                yield records[i:i + arraysize]
+        else:
+            version = self.query_cache.version(select_obj.table_name)
+            records = list()
+            for batch in self._select_batches(select_obj, arraysize):
+                records.extend(batch)
+                yield batch
+            self.query_cache.put(select_obj.table_name, key, records, version)
             
     def select_row(self, select_obj):
         """以生成器形式返回封装成Row对象的行数据
         """
+        column_names = select_obj.column_names
+        index = _column_index(column_names)
         for record in self.select(select_obj):
-            row = Row(select_obj.column_names, record)
-            yield row
+            yield Row(column_names, record, index)
     
     def select_column(self, select_obj):
         """返回一个封装好的列表
@@ -1291,12 +2311,89 @@ class Sqlite3Engine():
                 dataframe[column_name].append(value)
         return dataframe
 
+    def select_array(self, select_obj, arraysize=10000, dataframe=False):
+        """以列为导向返回选择结果, 每一列是一个numpy.ndarray。比select_column更快, 更节约内存。
+
+        数据以fetchmany(arraysize)分批读取, 直接填入预先分配好的数组中, 数组容量不足时成倍增长。
+        每一列的数组类型由Column的数据类型决定:
+            INTEGER -> int64 (如果遇到NULL, 则转为float64, NULL = nan)
+            REAL -> float64 (NULL = nan)
+            DATE -> datetime64[D] (NULL = NaT)
+            DATETIME -> datetime64[us] (NULL = NaT)
+            其他 -> object
+
+        [Args]
+        ------
+            arraysize: 每次fetchmany的条数, 也是数组的初始容量
+            dataframe: 如果为True, 返回pandas.DataFrame; 否则返回 {column_name: ndarray} 的OrderedDict
+
+        requires numpy, and pandas if dataframe=True
+        """
+        import numpy as np
+
+        dtype_mapping = {"INTEGER": np.int64, "REAL": np.float64,
+                         "DATE": "datetime64[D]", "DATETIME": "datetime64[us]"}
+        dtypes = [dtype_mapping.get(column.data_type.name, object) for column in select_obj.columns]
+        # TEXT以外的object列的值可能是list, tuple等序列, 不能用切片赋值, 否则会被numpy展开
+        elementwise = [(dtype is object) and (column.data_type.name != "TEXT") \
+                       for column, dtype in zip(select_obj.columns, dtypes)]
+
+        capacity = arraysize
+        arrays = [np.empty(capacity, dtype=dtype) for dtype in dtypes]
+        size = 0
+
+        with self._read_connection() as connect:
+            cursor = connect.cursor()
+            cursor.execute(*select_obj.toParamSQL())
+            converter = select_obj.default_record_converter
+            while True:
+                records = cursor.fetchmany(arraysize)
+                if not records:
+                    break
+                if converter != select_obj.nonpicklize_record:
+                    records = [converter(record) for record in records]
+
+                n = len(records)
+                if size + n > capacity: # 容量不足, 成倍增长
+                    while size + n > capacity:
+                        capacity *= 2
+                    for i, arr in enumerate(arrays):
+                        new_arr = np.empty(capacity, dtype=arr.dtype)
+                        new_arr[:size] = arr[:size]
+                        arrays[i] = new_arr
+
+                for i, values in enumerate(zip(*records)):
+                    if elementwise[i]:
+                        arr = arrays[i]
+                        for j, value in enumerate(values, size):
+                            arr[j] = value
+                    else:
+                        try:
+                            arrays[i][size:size+n] = values
+                        except TypeError: # INTEGER列中有NULL, 转为float64
+                            arrays[i] = arrays[i].astype(np.float64)
+                            arrays[i][size:size+n] = values
+                size += n
+
+        columns = OrderedDict()
+        for column_name, arr in zip(select_obj.column_names, arrays):
+            arr.resize(size, refcheck=False)
+            columns[column_name] = arr
+
+        if dataframe:
+            import pandas as pd
+            return pd.DataFrame(columns, columns=list(select_obj.column_names))
+        else:
+            return columns
+
     ### === Update ===
     def update(self, update_obj):
         """更新数据
         """
         update_obj.sqlcmd()
-        self.cursor.execute(update_obj.update_sqlcmd)
+        self.cursor.execute(update_obj.update_sqlcmd, update_obj.update_params)
+        if self.query_cache is not None: # update不改变行数
+            self.query_cache.invalidate(update_obj.table)
         self._commit()
     
     ### === 一些简便的语法糖函数 ===
@@ -1314,17 +2411,242 @@ class Sqlite3Engine():
             counter += 1
         print("Found %s records in %s" % (counter, table.table_name))
     
-    def howmany(self, table):
+    def howmany(self, table, estimate=False):
         """返回表内的记录总数
+        
+        [CN]行数在第一次查询后被缓存, 之后本engine的insert_*会直接累加缓存, upsert_*, execute, 
+        以及bulk_load中的rollback会使缓存失效。其他连接或进程commit了修改时 (PRAGMA data_version
+        发生变化), 所有缓存失效。所以反复查询行数并不会反复扫描整个表。
+        
+        [Args]
+        ------
+            estimate: 如果为True, 则使用ANALYZE收集的统计信息 (sqlite_stat1) 估计行数, 完全不扫描表,
+            适用于非常大的表。统计信息需要先调用analyze()收集, 如果没有统计信息则返回准确行数。
         """
-        self.cursor.execute("SELECT COUNT(*) FROM (SELECT * FROM %s);" % table.table_name)
-        return self.cursor.fetchone()[0]
-    
-    def prt_howmany(self, table):
+        self._check_data_version()
+        if estimate:
+            count = self._estimate_count(table)
+            if count is not None:
+                return count
+        table_name = str(table)
+        try:
+            return self._row_counts[table_name]
+        except KeyError:
+            with self._read_connection() as connect:
+                count = connect.execute("SELECT COUNT(*) FROM %s;" % table_name).fetchone()[0]
+            self._row_counts[table_name] = count
+            return count
+    
+    def prt_howmany(self, table, estimate=False):
         """打印表内有多少条记录
         """
-        num_of_record = self.howmany(table)
+        num_of_record = self.howmany(table, estimate)
         print("Found %s records in %s" % (num_of_record, table.table_name))
+    
+    ### === Statistics ===
+    def analyze(self, table=None):
+        """执行ANALYZE, 为所有表 (或指定的表) 收集统计信息, 供howmany(estimate=True)和sqlite的
+        query planner使用
+        """
+        if table is None:
+            self.execute("ANALYZE;")
+        else:
+            self.execute("ANALYZE %s;" % table)
+        self._commit()
+    
+    def _estimate_count(self, table):
+        """从sqlite_stat1中读取ANALYZE时记录的行数, 每一行stat的第一个数字即表的行数。
+        如果没有统计信息则返回None
+        """
+        with self._read_connection() as connect:
+            try:
+                stats = connect.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = ?", 
+                                        (str(table),)).fetchall()
+            except sqlite3.OperationalError: # 从未执行过ANALYZE, 没有sqlite_stat1表
+                return None
+        if len(stats) == 0:
+            return None
+        return max([int(stat.split()[0]) for (stat,) in stats])
+    
+    def _table_inserted(self, table, n):
+        """本engine向table插入了n条数据, 累加缓存的行数, 并使table的查询缓存失效
+        """
+        table_name = str(table)
+        if table_name in self._row_counts:
+            self._row_counts[table_name] += n
+        if self.query_cache is not None:
+            self.query_cache.invalidate(table_name)
+    
+    def _table_changed(self, table=None):
+        """table (或所有表) 被修改了, 使缓存的行数和查询结果失效
+        """
+        if table is None:
+            self._row_counts.clear()
+        else:
+            self._row_counts.pop(str(table), None)
+        if self.query_cache is not None:
+            self.query_cache.invalidate(table)
+    
+    def _check_data_version(self):
+        """如果其他连接commit了修改, PRAGMA data_version会发生变化, 此时所有的缓存失效
+        """
+        data_version = self.connect.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._data_version:
+            self._data_version = data_version
+            self._table_changed()
+
+
+class Sqlite3PoolEngine(Sqlite3Engine):
+    """A Sqlite3Engine that can be shared by many threads.
+    
+    [CN]sqlite3是单写多读的数据库。Sqlite3PoolEngine打开一个写连接和pool_size个读连接, 并把数据库
+    设置为WAL模式, 使得读和写可以同时进行:
+        1. 所有的写操作 (insert_*, upsert_*, update, execute, commit) 都在写连接上进行, 并由一个锁
+        保证同一时间只有一个线程在写。
+        2. 每一个select都会从读连接池中借出一个连接, 并使用自己的cursor, 读完之后归还。所以多个线程
+        的读操作可以并行, 互不干扰。如果所有的读连接都被借出, 则最多等待pool_timeout秒; 如果当前
+        线程自己已经借了一个连接 (嵌套的select, 或者没有读完的生成器), 则不等待。这两种情况下都会
+        打开一个临时的读连接, 用完即关闭, 所以永远不会死锁。
+        3. 如果写连接上有尚未commit的事务 (autocommit=False, 或者在bulk_load中), 读连接看不到
+        这些数据。此时select, howmany等读操作在写连接上进行, 并在读的过程中持有写锁。
+    
+    API与Sqlite3Engine完全相同。由于:memory:数据库无法在多个连接之间共享, 所以必须使用数据库文件。
+    
+    usage:
+        engine = Sqlite3PoolEngine("test.db", pool_size=4)
+    """
+    def __init__(self, dbname, pool_size=4, autocommit=True, pool_timeout=5.0):
+        if dbname == ":memory:":
+            raise Exception("Sqlite3PoolEngine requires a database file, ':memory:' is not supported!")
+        self._write_lock = threading.RLock()
+        Sqlite3Engine.__init__(self, dbname, autocommit=autocommit)
+        self.cursor.execute("PRAGMA journal_mode = WAL")
+        
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self._borrowed = threading.local() # 当前线程借出的连接个数
+        self._pool = queue.Queue()
+        for _ in range(pool_size):
+            self._pool.put(self._reader())
+    
+    def _connect(self, dbname):
+        """connections in pool are used by different threads
+        """
+        return register_functions(sqlite3.connect(dbname, detect_types=sqlite3.PARSE_DECLTYPES, 
+                                                  check_same_thread=False))
+    
+    def _reader(self):
+        """open a new read-only connection
+        """
+        connect = self._connect(self.dbname)
+        connect.execute("PRAGMA query_only = ON")
+        return connect
+    
+    @contextlib.contextmanager
+    def _read_connection(self):
+        """borrow a connection from the reader pool, give it back when finished. 
+        
+        如果写连接上有尚未commit的事务, 则使用写连接。如果读连接池中没有空闲的连接, 则使用一个
+        临时的读连接。
+        """
+        if self.connect.in_transaction: # 只有写连接能看到尚未commit的数据
+            with self._write_lock:
+                yield self.connect
+            return
+        
+        borrowed = getattr(self._borrowed, "n", 0)
+        try:
+            if borrowed: # 当前线程已经借了连接, 等待只会等待自己
+                connect = self._pool.get_nowait()
+            else:
+                connect = self._pool.get(timeout=self.pool_timeout)
+        except queue.Empty:
+            connect = self._reader()
+            try:
+                yield connect
+            finally:
+                connect.close()
+            return
+        
+        self._borrowed.n = borrowed + 1
+        try:
+            yield connect
+        finally:
+            self._borrowed.n -= 1
+            self._pool.put(connect)
+    
+    def close(self):
+        """close the writer connection and all reader connections
+        """
+        with self._write_lock:
+            self.connect.close()
+        for _ in range(self.pool_size):
+            self._pool.get().close()
+    
+    ### === Write, always in the writer connection and with the write lock ===
+    def execute(self, *args, **kwarg):
+        with self._write_lock:
+            if not _is_read_only(args[0] if args else kwarg.get("sql", "")):
+                self._table_changed()
+            return self.connect.execute(*args, **kwarg)
+        
+    def commit(self):
+        with self._write_lock:
+            Sqlite3Engine.commit(self)
+    
+    def insert_record(self, insert_obj, record):
+        with self._write_lock:
+            Sqlite3Engine.insert_record(self, insert_obj, record)
+    
+    def insert_many_records(self, insert_obj, records, chunksize=5000):
+        with self._write_lock:
+            return Sqlite3Engine.insert_many_records(self, insert_obj, records, chunksize)
+    
+    def insert_row(self, insert_obj, row):
+        with self._write_lock:
+            Sqlite3Engine.insert_row(self, insert_obj, row)
+    
+    def insert_many_rows(self, insert_obj, rows, chunksize=5000):
+        with self._write_lock:
+            return Sqlite3Engine.insert_many_rows(self, insert_obj, rows, chunksize)
+    
+    def upsert_many_records(self, insert_obj, records, chunksize=5000):
+        with self._write_lock:
+            return Sqlite3Engine.upsert_many_records(self, insert_obj, records, chunksize)
+    
+    def upsert_many_rows(self, insert_obj, rows, chunksize=5000):
+        with self._write_lock:
+            return Sqlite3Engine.upsert_many_rows(self, insert_obj, rows, chunksize)
+    
+    def update(self, update_obj):
+        with self._write_lock:
+            Sqlite3Engine.update(self, update_obj)
+    
+    @contextlib.contextmanager
+    def bulk_load(self, profile="safe", commit_every=100000):
+        """hold the write lock during the whole bulk load. Use "safe" profile by default to 
+        keep WAL mode for readers.
+        """
+        with self._write_lock:
+            with Sqlite3Engine.bulk_load(self, profile, commit_every):
+                yield self
+    
+    @contextlib.contextmanager
+    def savepoint(self, name="savepoint"):
+        with self._write_lock:
+            with Sqlite3Engine.savepoint(self, name):
+                yield self
+    
+    ### === Read, in a connection borrowed from the reader pool ===
+    def _check_data_version(self):
+        """data_version要在写连接上读取。如果写连接正在被其他线程使用, 则跳过检查, 因为此时
+        缓存的行数正在被写操作维护
+        """
+        if self._write_lock.acquire(False):
+            try:
+                Sqlite3Engine._check_data_version(self)
+            finally:
+                self._write_lock.release()
 
 if __name__ == "__main__":
     import unittest
@@ -1417,6 +2739,16 @@ if __name__ == "__main__":
             self.assertEqual((test.text_type.like("%pattern%")).sqlcmd, "text_type LIKE '%pattern%'")
             self.assertEqual((test.intset_type.in_(({1,2,3}, {4,5,6}, {7,8,9}))).sqlcmd, "intset_type IN ('1&&2&&3', '4&&5&&6', '8&&9&&7')")
             
+            # 测试参数化的sqlcmd和params
+            self.assertEqual((test.date_type > date(2015, 1, 1)).param_sqlcmd, "date_type > ?")
+            self.assertTupleEqual((test.date_type > date(2015, 1, 1)).params, ("2015-01-01",))
+            self.assertEqual((test.real_type.between(0, 1)).param_sqlcmd, "real_type BETWEEN ? AND ?")
+            self.assertTupleEqual((test.real_type.between(0, 1)).params, (0, 1))
+            self.assertEqual(test.integer_type.in_([1, 2, 3]).param_sqlcmd, "integer_type IN (?, ?, ?)")
+            criterion = or_(test.integer_type == 1, and_(test.text_type.like("a%"), test.real_type < 0.5))
+            self.assertEqual(criterion.param_sqlcmd, "(integer_type = ? OR (text_type LIKE ? AND real_type < ?))")
+            self.assertTupleEqual(criterion.params, (1, "a%", 0.5))
+            
             # 测试 !=, == 和None做比较的时候, 是否能转化为SQL中的
             self.assertEqual((test.text_type == None).sqlcmd, "text_type IS NULL")
             self.assertEqual((test.text_type != None).sqlcmd, "text_type NOT NULL")
@@ -1458,6 +2790,17 @@ if __name__ == "__main__":
             self.assertListEqual(results[2][6], StrList(["a", "b", "c"]))
             self.assertSetEqual(results[3][9], IntSet({1, 2, 3}))
         
+        def test_select_batch(self):
+            """测试select的batch模式, 以及嵌套的select互不影响
+            """
+            batches = list(engine.select(Select(test.all), arraysize=4, batch=True))
+            self.assertListEqual([len(records) for records in batches], [4, 4, 2])
+            self.assertDictEqual(batches[1][0][5], {1: "a", 2: "b", 3: "c"})
+            
+            pairs = [(i, j) for (i,) in engine.select(Select([test.integer_type]), arraysize=3)
+                     for (j,) in engine.select(Select([test.integer_type]), arraysize=3)]
+            self.assertEqual(len(pairs), 100)
+        
         def test_select_row(self):
             """测试select能否返回Row对象, 即可以用Row.key或Row[key]的方法获得值
             """
@@ -1472,6 +2815,22 @@ if __name__ == "__main__":
             """
             df = engine.select_column(Select([test.integer_type]))
             self.assertListEqual(df["integer_type"], list(range(10)))
+
+        def test_select_array(self):
+            """测试select_array是否能返回以列为导向的numpy.ndarray, 并正确处理数组扩容和NULL
+            """
+            df = engine.select_array(Select([test.integer_type, test.real_type, test.date_type,
+                                             test.text_type, test.pickle_type]), arraysize=3)
+            self.assertEqual(str(df["integer_type"].dtype), "int64")
+            self.assertListEqual(df["integer_type"].tolist(), list(range(10)))
+            self.assertEqual(str(df["date_type"].dtype), "datetime64[D]")
+            self.assertEqual(len(df["text_type"][9]), 32)
+            self.assertDictEqual(df["pickle_type"][0], {1: "a", 2: "b", 3: "c"})
+
+            df = engine.select_array(Select([test.integer_type]).where(test.integer_type >= 5),
+                                     dataframe=True)
+            self.assertListEqual(list(df.columns), ["integer_type"])
+            self.assertEqual(len(df), 5)
             
         def test_where(self):
             results = list(engine.select_row(
@@ -1479,7 +2838,413 @@ if __name__ == "__main__":
                         where(test.text_type == None)
                         ))
             print(results)
+
+        # === insert_many_records, insert_many_rows ===
+        def test_insert_many(self):
+            """测试批量插入时, 冲突的记录被跳过, 其他记录全部插入, 并正确返回统计结果
+            """
+            engine = Sqlite3Engine(":memory:")
+            metadata = MetaData()
+            bulk = Table("bulk", metadata,
+                Column("_id", INTEGER(), primary_key=True),
+                Column("value", TEXT()),
+                )
+            metadata.create_all(engine)
+            ins = bulk.insert()
+
+            report = engine.insert_many_records(ins, [(i, "a") for i in range(10)], chunksize=3)
+            self.assertEqual((report.inserted, report.skipped, report.failed), (10, 0, 0))
+
+            report = engine.insert_many_records(ins, ((i, "b") for i in range(5, 15)), chunksize=3)
+            self.assertEqual((report.inserted, report.skipped, report.failed), (5, 5, 0))
+
+            report = engine.insert_many_rows(ins,
+                (Row(("_id", "value"), (i, "c")) for i in range(12, 20)), chunksize=4)
+            self.assertEqual((report.inserted, report.skipped, report.failed), (5, 3, 0))
+
+            self.assertEqual(engine.howmany(bulk), 20)
+            self.assertEqual(list(engine.select(Select([bulk.value]).where(bulk._id == 7))), [("a",)])
+
+            # 数据类型错误的行计入failed
+            report = engine.insert_many_records(ins, [(20, "d"), (21, object()), (22, 2**70)])
+            self.assertEqual((report.inserted, report.skipped, report.failed), (1, 0, 2))
+
+            # 与行无关的错误直接抛出, 而不是把每一行都计入failed
+            engine.execute("DROP TABLE bulk")
+            self.assertRaises(sqlite3.OperationalError,
+                              engine.insert_many_records, ins, [(30, "e"), (31, "f")])
+
+        # === upsert_many_records, upsert_many_rows ===
+        def test_upsert_many(self):
+            """测试upsert时, 冲突的记录被更新, 新记录被插入
+            """
+            engine = Sqlite3Engine(":memory:")
+            metadata = MetaData()
+            upsert = Table("upsert", metadata,
+                Column("_id", INTEGER(), primary_key=True),
+                Column("value", TEXT()),
+                Column("obj", PICKLETYPE()),
+                )
+            metadata.create_all(engine)
+            ins = upsert.insert()
+
+            engine.insert_many_records(ins, [(i, "a", [i]) for i in range(5)])
+            report = engine.upsert_many_records(ins, ((i, "b", {i}) for i in range(3, 8)), chunksize=2)
+            self.assertEqual((report.inserted, report.skipped, report.failed), (5, 0, 0))
+            self.assertEqual(engine.howmany(upsert), 8)
+            self.assertListEqual(list(engine.select(Select(upsert.all).where(upsert._id.in_([2, 3])))),
+                                 [(2, "a", [2]), (3, "b", {3})])
+
+            engine.upsert_many_rows(ins, [Row(("_id", "value"), (i, "c")) for i in range(7, 9)])
+            self.assertListEqual(list(engine.select(Select(upsert.all).where(upsert._id >= 7))),
+                                 [(7, "c", {7}), (8, "c", None)])
+
         # === select, where ===
+    class BulkLoadUnittest(unittest.TestCase):
+        def test_bulk_load(self):
+            """测试bulk_load中PRAGMA被应用, 数据每commit_every条commit一次, 离开后PRAGMA被恢复
+            """
+            import tempfile, os
+            engine = Sqlite3Engine(os.path.join(tempfile.mkdtemp(), "bulk_load.db"))
+            metadata = MetaData()
+            bulk_load = Table("bulk_load", metadata,
+                Column("_id", INTEGER(), primary_key=True),
+                )
+            metadata.create_all(engine)
+            ins = bulk_load.insert()
+            
+            original = engine._read_pragma(PRAGMA_PROFILES["fast"])
+            with engine.bulk_load("fast", commit_every=10):
+                self.assertEqual(engine.execute("PRAGMA synchronous").fetchone()[0], 0)
+                engine.insert_many_records(ins, [(i,) for i in range(25)], chunksize=5)
+                self.assertEqual(engine._uncommitted, 5)
+                for i in range(25, 30):
+                    engine.insert_record(ins, (i,))
+                self.assertEqual(engine._uncommitted, 0)
+                self.assertFalse(engine.connect.in_transaction)
+            self.assertEqual(engine.howmany(bulk_load), 30)
+            self.assertDictEqual(dict(engine._read_pragma(PRAGMA_PROFILES["fast"])), dict(original))
+            self.assertTrue(engine.is_autocommit)
+            
+            # :memory:数据库没有mmap_size
+            engine = Sqlite3Engine(":memory:")
+            metadata.create_all(engine)
+            with engine.bulk_load("fast"):
+                engine.insert_many_records(ins, [(i,) for i in range(10)])
+            self.assertEqual(engine.howmany(bulk_load), 10)
+        
+        def test_savepoint(self):
+            """savepoint中出错时, 只回滚savepoint中的写操作, 且不会commit外层的事务
+            """
+            engine = Sqlite3Engine(":memory:")
+            metadata = MetaData()
+            savepoint = Table("savepoint", metadata,
+                Column("_id", INTEGER(), primary_key=True),
+                )
+            metadata.create_all(engine)
+            ins = savepoint.insert()
+            
+            with engine.bulk_load("safe", commit_every=None):
+                engine.insert_many_records(ins, [(i,) for i in range(5)])
+                with engine.savepoint():
+                    engine.insert_many_records(ins, [(i,) for i in range(5, 10)])
+                self.assertTrue(engine.connect.in_transaction)
+                try:
+                    with engine.savepoint():
+                        engine.insert_many_records(ins, [(i,) for i in range(10, 15)])
+                        self.assertEqual(engine.howmany(savepoint), 15)
+                        raise ValueError
+                except ValueError:
+                    pass
+                self.assertTrue(engine.connect.in_transaction)
+                self.assertEqual(engine.howmany(savepoint), 10)
+            self.assertEqual(engine.execute("SELECT COUNT(*) FROM savepoint").fetchone()[0], 10)
+    
+    class StatisticsUnittest(unittest.TestCase):
+        def test_howmany(self):
+            """测试howmany的缓存被insert累加, 被upsert/execute/其他连接的修改失效, 以及estimate模式
+            """
+            import tempfile, os
+            dbname = os.path.join(tempfile.mkdtemp(), "statistics.db")
+            engine = Sqlite3Engine(dbname)
+            metadata = MetaData()
+            stat = Table("stat", metadata,
+                Column("_id", INTEGER(), primary_key=True),
+                Column("value", TEXT(), index=True),
+                )
+            metadata.create_all(engine)
+            ins = stat.insert()
+            
+            self.assertEqual(engine.howmany(stat), 0)
+            engine.insert_many_records(ins, [(i, str(i)) for i in range(10)])
+            engine.insert_record(ins, (10, "10"))
+            engine.insert_record(ins, (11, "11"))
+            self.assertEqual(engine._row_counts, {"stat": 12})
+            self.assertEqual(engine.howmany(stat), 12)
+            
+            engine.upsert_many_records(ins, [(11, "a"), (12, "b")])
+            self.assertNotIn("stat", engine._row_counts)
+            self.assertEqual(engine.howmany(stat), 13)
+            engine.execute("DELETE FROM stat WHERE _id = 12")
+            engine.commit()
+            self.assertEqual(engine.howmany(stat), 12)
+            
+            # 只读的SQL不会使缓存失效
+            engine.execute("SELECT * FROM stat").fetchall()
+            engine.execute("  -- comment\n pragma table_info(stat)").fetchall()
+            self.assertEqual(engine._row_counts, {"stat": 12})
+            engine.execute("/* c */ WITH t AS (SELECT 1) DELETE FROM stat WHERE _id = 100")
+            self.assertNotIn("stat", engine._row_counts)
+            self.assertEqual(engine.howmany(stat), 12)
+            
+            other = sqlite3.connect(dbname)
+            other.execute("DELETE FROM stat WHERE _id >= 10")
+            other.commit()
+            self.assertEqual(engine.howmany(stat), 10)
+            
+            self.assertEqual(engine.howmany(stat, estimate=True), 10) # 没有统计信息
+            engine.analyze()
+            engine.insert_record(ins, (10, "10"))
+            self.assertEqual(engine.howmany(stat, estimate=True), 10)
+            self.assertEqual(engine.howmany(stat), 11)
+    
+    class QueryCacheUnittest(unittest.TestCase):
+        def test_query_cache(self):
+            """测试查询缓存的命中, 写操作后失效, 以及LRU淘汰
+            """
+            engine = Sqlite3Engine(":memory:")
+            metadata = MetaData()
+            cache_test = Table("cache_test", metadata,
+                Column("_id", INTEGER(), primary_key=True),
+                Column("value", PICKLETYPE()),
+                )
+            metadata.create_all(engine)
+            ins = cache_test.insert()
+            engine.insert_many_records(ins, [(i, {i: i}) for i in range(10)])
+            
+            cache = engine.enable_query_cache(maxsize=2)
+            sel = Select(cache_test.all).where(cache_test._id < 5)
+            self.assertEqual(len(list(engine.select(sel))), 5)
+            self.assertEqual(list(engine.select(sel)), list(engine.select(sel)))
+            self.assertEqual(list(engine.select(sel, arraysize=2, batch=True))[2], [(4, {4: 4})])
+            self.assertEqual((cache.hits, cache.misses), (3, 1))
+            
+            # 写操作使缓存失效
+            engine.insert_record(ins, (-1, None))
+            self.assertEqual(len(list(engine.select(sel))), 6)
+            engine.update(cache_test.update().values(value={}).where(cache_test._id == -1))
+            self.assertEqual(list(engine.select(sel))[0], (-1, {}))
+            self.assertEqual((cache.hits, cache.misses), (3, 3))
+            
+            # 未读完的查询不放入缓存
+            next(engine.select(Select(cache_test.all)))
+            self.assertEqual(len(cache), 1)
+            
+            # LRU淘汰
+            list(engine.select(Select(cache_test.all)))
+            list(engine.select(Select([cache_test._id])))
+            self.assertEqual((len(cache), cache.evictions), (2, 1))
+    
+    class IndexUnittest(unittest.TestCase):
+        def test_create_index(self):
+            """测试Column(index=True)和Index在create_all时被创建, 并且可以被reflect
+            """
+            engine = Sqlite3Engine(":memory:")
+            metadata = MetaData()
+            movie = Table("movie", metadata,
+                Column("_id", INTEGER(), primary_key=True),
+                Column("title", TEXT(), index=True),
+                Column("year", INTEGER()),
+                Column("rate", REAL()),
+                Index("ix_movie_year_rate", "year", "rate", unique=True),
+                )
+            self.assertEqual(movie.create_index_sql(), [
+                "CREATE INDEX IF NOT EXISTS ix_movie_title ON movie (title);",
+                "CREATE UNIQUE INDEX IF NOT EXISTS ix_movie_year_rate ON movie (year, rate);"])
+            metadata.create_all(engine)
+            
+            metadata = MetaData(bind=engine)
+            self.assertEqual(
+                sorted([repr(index) for index in metadata.get_table("movie").indexes]),
+                ["Index('ix_movie_title', 'title')", 
+                 "Index('ix_movie_year_rate', 'year', 'rate', unique=True)"])
+        
+        def test_index_advisor(self):
+            """测试IndexAdvisor能发现全表扫描, 给出建议并自动创建索引
+            """
+            engine = Sqlite3Engine(":memory:")
+            metadata = MetaData()
+            movie = Table("movie", metadata,
+                Column("_id", INTEGER(), primary_key=True),
+                Column("title", TEXT(), index=True),
+                Column("year", INTEGER()),
+                Column("rate", REAL()),
+                )
+            metadata.create_all(engine)
+            
+            advisor = engine.enable_index_advisor()
+            for i in range(3):
+                list(engine.select(Select([movie.title]).where(
+                    movie.rate >= 5.0, movie.year == 2000)))
+            list(engine.select(Select([movie.rate]).where(movie.title == "Heat")))
+            list(engine.select(Select([movie.rate]).where(movie._id == 1)))
+            list(engine.select(Select([movie.rate])))
+            self.assertEqual([repr(index) for index in advisor.suggest()], 
+                             ["Index('ix_movie_year_rate', 'year', 'rate')"])
+            
+            advisor.auto_create = True
+            list(engine.select(Select([movie.title]).where(movie.year.between(1990, 2000))))
+            self.assertEqual([repr(index) for index in advisor.created], 
+                             ["Index('ix_movie_year', 'year')"])
+            self.assertFalse(advisor.is_full_scan(
+                Select([movie.title]).where(movie.year.between(1990, 2000))))
+    
+    class CodecUnittest(unittest.TestCase):
+        def test_roundtrip(self):
+            """测试fast codec对各种对象的编码解码, 以及两种codec数据的相互兼容
+            """
+            for obj in [[1, 2, 3], [-2**40, 2**40], (1.5, 2.5), {"a", "中文", ""}, 
+                        [], set(), {1: "a", 2: "b"}, {"a": 1.0}, [1, "a"], [2**70], 
+                        {"key": [1, 2]}, "string"]:
+                encoded = Codec.fast.encode(obj)
+                self.assertEqual(Codec.fast.decode(encoded), obj)
+                self.assertEqual(type(Codec.fast.decode(encoded)), type(obj))
+                self.assertEqual(Codec.fast.decode(Codec.pickle.encode(obj)), obj)
+                self.assertEqual(Codec.pickle.decode(encoded), obj)
+            self.assertEqual(Codec.fast.encode([1, 2, 3])[:3], b"\xfaLb")
+            self.assertEqual(Codec.fast.encode([1, "a"]), Codec.pickle.encode([1, "a"]))
+        
+        def test_column_codec(self):
+            """测试在Column中指定codec后的写入和读取
+            """
+            engine = Sqlite3Engine(":memory:")
+            metadata = MetaData()
+            codec_test = Table("codec_test", metadata,
+                Column("_id", INTEGER(), primary_key=True),
+                Column("pickle_type", PICKLETYPE(), codec=Codec.fast),
+                Column("list_type", PYTHONLIST(), codec=Codec.fast),
+                Column("set_type", PYTHONSET()),
+                )
+            metadata.create_all(engine)
+            self.assertEqual(codec_test.pickletype_columns, ["pickle_type", "list_type"])
+            self.assertEqual(repr(codec_test.list_type), 
+                "Column('list_type', PYTHONLIST(), primary_key=False, nullable=True, "
+                "default=None, codec=Codec.fast)")
+            
+            ins = codec_test.insert()
+            engine.insert_many_records(ins, [(1, {1: 2.0}, ["a", "b"], {1, 2}),
+                                             (2, None, None, None)])
+            self.assertEqual(list(engine.select(Select(codec_test.all))), 
+                             [(1, {1: 2.0}, ["a", "b"], {1, 2}), (2, None, None, None)])
+            sel = Select([codec_test._id]).where(codec_test.list_type == ["a", "b"])
+            self.assertEqual(list(engine.select(sel)), [(1,)])
+    
+    class PackedUnittest(unittest.TestCase):
+        def test_packed(self):
+            """测试使用Codec.packed的列的读写, 以及SQL中的contains函数
+            """
+            engine = Sqlite3Engine(":memory:")
+            metadata = MetaData()
+            packed_test = Table("packed_test", metadata,
+                Column("_id", INTEGER(), primary_key=True),
+                Column("intset_type", INTSET(), codec=Codec.packed),
+                Column("strlist_type", STRLIST(), codec=Codec.packed),
+                Column("intlist_type", INTLIST()),
+                )
+            metadata.create_all(engine)
+            
+            ins = packed_test.insert()
+            engine.insert_many_records(ins, [
+                (1, IntSet({1, 2}), StrList(["a", "b"]), IntList([1])),
+                (2, IntSet({3}), StrList(["中文"]), IntList([2, 3])),
+                ])
+            self.assertEqual(list(engine.select(Select(packed_test.all))), [
+                (1, IntSet({1, 2}), StrList(["a", "b"]), IntList([1])),
+                (2, IntSet({3}), StrList(["中文"]), IntList([2, 3])),
+                ])
+            
+            for where, expect in [(packed_test.intset_type.contains(3), [(2,)]),
+                                  (packed_test.strlist_type.contains("a"), [(1,)]),
+                                  (packed_test.intlist_type.contains(3), [(2,)]),
+                                  (packed_test.intset_type.contains(packed_test._id), [(1,)]),
+                                  (packed_test.intset_type == IntSet({3}), [(2,)]),]:
+                sel = Select([packed_test._id]).where(where)
+                self.assertEqual(list(engine.select(sel)), expect)
+    
+    class Sqlite3PoolEngineUnittest(unittest.TestCase):
+        def test_multithread(self):
+            """测试多个线程同时读写
+            """
+            import tempfile, os
+            from concurrent.futures import ThreadPoolExecutor
+            
+            dbname = os.path.join(tempfile.mkdtemp(), "pool.db")
+            engine = Sqlite3PoolEngine(dbname, pool_size=3)
+            metadata = MetaData()
+            pool = Table("pool", metadata,
+                Column("_id", INTEGER(), primary_key=True),
+                Column("value", TEXT()),
+                )
+            metadata.create_all(engine)
+            ins = pool.insert()
+            
+            def write(i):
+                engine.insert_many_records(ins, [(i * 100 + j, "v") for j in range(100)])
+            
+            def read(i):
+                return len(list(engine.select(Select([pool._id]).where(pool._id < i * 100))))
+            
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(write, range(10)))
+                results = list(executor.map(read, range(10)))
+            self.assertListEqual(results, [i * 100 for i in range(10)])
+            self.assertEqual(engine.howmany(pool), 1000)
+            self.assertEqual(engine.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+            engine.close()
+        
+        def test_nested_select(self):
+            """读连接都被借出时, 嵌套的select不会死锁
+            """
+            import tempfile, os
+            
+            dbname = os.path.join(tempfile.mkdtemp(), "pool.db")
+            engine = Sqlite3PoolEngine(dbname, pool_size=1, pool_timeout=0.1)
+            metadata = MetaData()
+            pool = Table("pool", metadata,
+                Column("_id", INTEGER(), primary_key=True),
+                )
+            metadata.create_all(engine)
+            engine.insert_many_records(pool.insert(), [(i,) for i in range(3)])
+            
+            outer = engine.select(Select([pool._id]), arraysize=1)
+            self.assertEqual(next(outer), (0,))
+            self.assertEqual(len(list(engine.select(Select([pool._id])))), 3)
+            abandoned = engine.select(Select([pool._id]), arraysize=1) # 其他的生成器没有读完
+            self.assertEqual(next(abandoned), (0,))
+            self.assertEqual(len(list(engine.select(Select([pool._id])))), 3)
+            self.assertEqual(len(list(outer)), 2)
+            engine.close()
+        
+        def test_uncommitted(self):
+            """autocommit=False时, 读操作能看到写连接上尚未commit的数据
+            """
+            import tempfile, os
+            
+            dbname = os.path.join(tempfile.mkdtemp(), "pool.db")
+            engine = Sqlite3PoolEngine(dbname, pool_size=2, autocommit=False)
+            metadata = MetaData()
+            pool = Table("pool", metadata,
+                Column("_id", INTEGER(), primary_key=True),
+                )
+            metadata.create_all(engine)
+            engine.commit()
+            engine.insert_many_records(pool.insert(), [(i,) for i in range(5)])
+            self.assertEqual(len(list(engine.select(Select([pool._id])))), 5)
+            self.assertEqual(engine.howmany(pool), 5)
+            engine.commit()
+            self.assertEqual(len(list(engine.select(Select([pool._id])))), 5)
+            engine.close()
+    
     class InsertUnittest(unittest.TestCase):
         def test_sqlcmd(self):
             """测试Insert是否能够根据不同的record, Row自动判断其中的类型, 然后生成用于插入到
@@ -1501,6 +3266,10 @@ if __name__ == "__main__":
             # test sqlcmd_from_row() method
             ins.sqlcmd_from_row(row)
             self.assertEqual(ins.insert_sqlcmd, correct_sqlcmd)
+
+            # test upsert_sqlcmd_from_row() method
+            ins.upsert_sqlcmd_from_row(Row(("integer_type", "real_type", "text_type"), (11, 1.0, "abc")))
+            self.assertEqual(ins.upsert_sqlcmd, "INSERT INTO test\n\t(integer_type, real_type, text_type)\nVALUES\n\t(?, ?, ?)\nON CONFLICT (integer_type) DO UPDATE SET\n\treal_type = excluded.real_type,\n\ttext_type = excluded.text_type;")
             
             # test picklize_record() method
             self.assertTupleEqual(ins.picklize_record(record),
@@ -1515,10 +3284,41 @@ if __name__ == "__main__":
                  b"\x80\x03]q\x00(K\x01K\x02K\x03e.", 
                  ['c', 'b', 'a'], [3, 2, 1], StrSet({'a', 'c', 'b'}), IntSet({1, 2, 3}))
                 )
+        
+        def test_compile(self):
+            """测试每一种column组合只compile一次, 以及compile后的converter
+            """
+            compiled = test.insert().compile(["integer_type", "pickle_type"])
+            self.assertIs(test.insert().compile(("integer_type", "pickle_type")), compiled)
+            self.assertIs(test.insert().compile(), test.insert().compile(test.column_names))
+            self.assertEqual(compiled.record_converter((1, [1, 2, 3])), 
+                             (1, b"\x80\x03]q\x00(K\x01K\x02K\x03e."))
+            self.assertEqual(compiled.row_converter(Row(("integer_type", "pickle_type"), (1, None))), 
+                             (1, None))
+            compiled = test.insert().compile(["integer_type", "text_type"])
+            self.assertEqual(compiled.record_converter, compiled.nonpicklize_record)
     
     class UpdateUnittest(unittest.TestCase):
         def test_sqlcmd(self):
-            pass
+            upd = test.update().values(text_type="it's", real_type=test.real_type + 1).where(
+                test.integer_type.between(0, 1))
+            upd.sqlcmd()
+            self.assertEqual(upd.update_sqlcmd, 
+                "UPDATE test\nSET\n\ttext_type = ?,\n\treal_type = real_type + ?\nWHERE\n\tinteger_type BETWEEN ? AND ?")
+            self.assertTupleEqual(upd.update_params, ("it's", 1, 0, 1))
+        
+        def test_update(self):
+            engine = Sqlite3Engine(":memory:")
+            metadata = MetaData()
+            upd_test = Table("upd_test", metadata,
+                Column("_id", INTEGER(), primary_key=True),
+                Column("value", TEXT()),
+                )
+            metadata.create_all(engine)
+            engine.insert_many_records(upd_test.insert(), [(1, "a"), (2, "b")])
+            engine.update(upd_test.update().values(value="it's").where(upd_test._id == 2))
+            self.assertListEqual(list(engine.select(Select(upd_test.all).where(upd_test.value.like("%'%")))),
+                                 [(2, "it's")])
         
     class RowUnittest(unittest.TestCase):
         def test_initiate(self):
@@ -1546,6 +3346,17 @@ if __name__ == "__main__":
             row2["integer_type"] = 2
             self.assertEqual(row2["integer_type"], 2)
             
-            # from_dict(), _create_dict_view(), _smart_create_dict_view() are implicitly tested
+            # from_dict() is implicitly tested
+        
+        def test_shared_index(self):
+            """测试拥有相同columns的Row共享同一个索引字典, 并且Row没有__dict__
+            """
+            row1 = Row(("text_type", "integer_type"), ("abc", 1))
+            row2 = Row(["text_type", "integer_type"], ["def", 2])
+            self.assertIs(row1._index, row2._index)
+            self.assertFalse(hasattr(row1, "__dict__"))
+            self.assertFalse(hasattr(row1, "not_a_column"))
+            self.assertEqual(row2.integer_type, 2)
+            self.assertNotEqual(row1, row2)
     
     unittest.main()
\ No newline at end of file
@@ -1,11 +1,16 @@
 ##encoding=UTF8
 
-def iterC(cursor, arraysize = 1000):
-    "An iterator that uses fetchmany to keep memory usage lower"
+def iterbatch(cursor, arraysize = 1000):
+    "An iterator that yields each fetchmany batch as a list"
     while True:
         results = cursor.fetchmany(arraysize)
         if not results:
             break
+        yield results
+
+def iterC(cursor, arraysize = 1000):
+    "An iterator that uses fetchmany to keep memory usage lower"
+    for results in iterbatch(cursor, arraysize):
         for result in results:
             yield result
             
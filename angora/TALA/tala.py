@@ -45,10 +45,12 @@ Import Command
 """
 
 from __future__ import print_function
-from angora.SQLITE.core import Row, Select, DataType, MetaData, Column, Table, Sqlite3Engine
-from angora.DATA.dtype import OrderedSet
-from angora.DATA.iterable import grouper
+from angora.SQLITE.core import (Row, Select, DataType, MetaData, Column, Table, Index, 
+    Sqlite3Engine)
+from angora.TALA.postings import PostingList, PostingsCodec, PostingsBuilder
+from angora.DATA.iterable import grouper, grouper_list
 from collections import OrderedDict
+from itertools import chain
 
 ##################################################
 #                                                #
@@ -57,6 +59,7 @@ from collections import OrderedDict
 ##################################################
 
 datatype = DataType()
+postings_codec = PostingsCodec()
 
 class SEARCHABLE_TYPE():
     """
@@ -295,12 +298,22 @@ class Schema():
 ##################################################
 
 class SearchEngine():
-    def __init__(self, schema):
+    """
+    [args]
+    ------
+    schema:
+        the Schema object
+    merge_threshold:
+        add_one/update_one/delete_one只往delta段和tombstone中追加记录, 当追加的记录数超过
+        merge_threshold时, 自动调用merge_segments()合并进posting list。None则不自动合并。
+    """
+    def __init__(self, schema, merge_threshold=100000):
         self.schema = schema
         self.database = schema.schema_name + ".db"
         self.engine = Sqlite3Engine(self.database)
         self.engine.autocommit(False)
         self.metadata = MetaData()
+        self.merge_threshold = merge_threshold
         self.create_all_tables()
     
     def commit(self):
@@ -317,24 +330,224 @@ class SearchEngine():
         
         self.main_table = Table(self.schema.schema_name, self.metadata, *main_table_columns)
         
+        ## create doc id table
+        # 每个文档有一个紧凑的整数doc id, 倒排索引中只储存doc id, 而不是uuid
+        docid_table_name = self.schema.schema_name + "_docid"
+        self.docid_table = Table(docid_table_name, self.metadata,
+            Column("docid", datatype.integer, primary_key = True),
+            Column("uuid", self.schema.fields[self.schema.uuid].sqlite_dtype),
+            Index("ix_%s_uuid" % docid_table_name, "uuid", unique = True),
+            )
+        
+        ## create delta segment and tombstone table
+        # 增量添加的 (field, keyword, docid) 写入delta段, 删除的写入tombstone, 查询时
+        # posting list = postings + delta - tombstone, merge_segments()把两者合并进postings
+        # tombstone中docid的索引用于_next_docid()的MAX(docid), 否则每次add_one都要扫描整个tombstone
+        for table_name, indexes in [("_delta", []), 
+                                    ("_tombstone", [Index("ix_%s_tombstone_docid" % 
+                                                          self.schema.schema_name, "docid")])]:
+            Table(self.schema.schema_name + table_name, self.metadata,
+                  Column("field", datatype.text, primary_key = True),
+                  Column("keyword", datatype.text, primary_key = True),
+                  Column("docid", datatype.integer, primary_key = True),
+                  *indexes)
+        self.delta_table = self.get_table(self.schema.schema_name + "_delta")
+        self.tombstone_table = self.get_table(self.schema.schema_name + "_tombstone")
+        
         ## create keyword table
+        # postings是压缩后的doc id列表, 参考angora.TALA.postings.PostingList; df是文档的个数
         for keyword_field in self.schema.keyword_fields:
             Table(keyword_field, self.metadata,
                   Column("keyword", datatype.text, primary_key = True),
-                  Column("uuid_set", datatype.pythonset),
+                  Column("postings", datatype.pickletype, codec = postings_codec),
+                  Column("df", datatype.integer),
                   )
         
         self.metadata.create_all(self.engine)
+        self.delta_size = sum([self.engine.cursor.execute("SELECT COUNT(*) FROM %s" % table.table_name
+                                                          ).fetchone()[0] \
+                               for table in [self.delta_table, self.tombstone_table]])
         
     def get_table(self, table_name):
         """根据table_name得到一个表对象
         """
         return self.metadata.tables[table_name]
     
+    def _next_docid(self):
+        """下一个可用的doc id。被删除的doc id在merge_segments()之前仍然在tombstone中, 不能被重用
+        """
+        return max([self.engine.cursor.execute("SELECT MAX(docid) FROM %s" % table.table_name
+                                               ).fetchone()[0] or 0 \
+                    for table in [self.docid_table, self.tombstone_table]]) + 1
+    
+    def _get_docid(self, uuid):
+        """返回uuid对应的doc id, 如果还没有, 则分配一个新的doc id
+        """
+        record = self.engine.cursor.execute(
+            "SELECT docid FROM %s WHERE uuid = ?" % self.docid_table.table_name, 
+            (uuid,)).fetchone()
+        if record is not None:
+            return record[0]
+        docid = self._next_docid()
+        self.engine.cursor.execute(
+            "INSERT INTO %s (docid, uuid) VALUES (?, ?)" % self.docid_table.table_name, 
+            (docid, uuid))
+        return docid
+    
+    def _docid_to_uuid(self, docids):
+        """将排好序的doc id列表转换为uuid列表, 保持doc id的顺序
+        """
+        uuid_list = list()
+        for chunk in grouper_list(docids, 500): # sqlite3的变量个数上限是999
+            sqlcmd = "SELECT uuid FROM %s WHERE docid IN (%s) ORDER BY docid" % (
+                self.docid_table.table_name, ", ".join("?" * len(chunk)))
+            uuid_list.extend([record[0] for record in self.engine.cursor.execute(sqlcmd, chunk)])
+        return uuid_list
+    
+    def _keyword_docids(self, keyword_lookup_list):
+        """执行对倒排索引表的查询, 对所有的posting list求交集, 返回doc id列表
+        
+        [CN]查询计划: 先只读取每个keyword的df (文档个数), 从df最小的posting list开始求交集,
+        候选doc id只会越来越少; 如果某个keyword不存在, 或者交集已经为空, 则不再读取剩下的
+        posting list。
+        """
+        plan = list()
+        for field_name, keyword in keyword_lookup_list:
+            record = self.engine.cursor.execute(
+                "SELECT df FROM %s WHERE keyword = ?" % field_name, (keyword,)).fetchone()
+            df = record[0] if record is not None else 0
+            if self.delta_size: # 加上delta段中的文档个数
+                df += self.engine.cursor.execute(
+                    "SELECT COUNT(*) FROM %s WHERE field = ? AND keyword = ?" % 
+                    self.delta_table.table_name, (field_name, keyword)).fetchone()[0]
+            if df == 0: # keyword不存在, 结果为空
+                return list()
+            plan.append((df, field_name, keyword))
+        plan.sort(key=lambda x: x[0])
+        
+        docids = None
+        for df, field_name, keyword in plan:
+            posting_list = self._read_stored_posting_list(field_name, keyword)
+            added, removed = self._read_segments(field_name, keyword)
+            # 在压缩的posting list上求交集, 再对候选doc id应用delta段和tombstone
+            if docids is None:
+                hits = posting_list.to_list()
+                if added:
+                    hits = sorted(set(hits).union(added))
+            else:
+                hits = posting_list.intersect(docids)
+                if added:
+                    added = set(added)
+                    hits = sorted(set(hits).union([docid for docid in docids if docid in added]))
+            if removed:
+                hits = [docid for docid in hits if docid not in removed]
+            docids = hits
+            if not docids:
+                break
+        return docids
+    
+    def _read_stored_posting_list(self, field_name, keyword):
+        """读取索引表中keyword的posting list, 没有则返回空的posting list
+        """
+        record = self.engine.cursor.execute(
+            "SELECT postings FROM %s WHERE keyword = ?" % field_name, (keyword,)).fetchone()
+        if record is not None:
+            return PostingList(record[0])
+        return PostingList.from_docids([])
+    
+    def _read_segments(self, field_name, keyword):
+        """读取delta段和tombstone中keyword的doc id, 返回 (added list, removed set)
+        """
+        if not self.delta_size:
+            return list(), set()
+        added = [row[0] for row in self.engine.cursor.execute(
+            "SELECT docid FROM %s WHERE field = ? AND keyword = ?" % self.delta_table.table_name,
+            (field_name, keyword))]
+        removed = set([row[0] for row in self.engine.cursor.execute(
+            "SELECT docid FROM %s WHERE field = ? AND keyword = ?" % self.tombstone_table.table_name,
+            (field_name, keyword))])
+        return added, removed
+    
+    def _read_posting_list(self, field_name, keyword):
+        """读取keyword的posting list, 并应用delta段和tombstone: postings + delta - tombstone
+        """
+        posting_list = self._read_stored_posting_list(field_name, keyword)
+        added, removed = self._read_segments(field_name, keyword)
+        if added or removed:
+            posting_list = PostingList.from_docids([docid for docid in chain(posting_list, added) \
+                                                    if docid not in removed])
+        return posting_list
+    
+    def _iter_candidates(self, sqlcmd, keyword_uuid_set, chunksize=500):
+        """依次执行主表的uuid查询, 每次取chunksize个, 只保留在keyword_uuid_set中的uuid。
+        keyword_uuid_set为None时不进行筛选。使用单独的cursor, 所以可以一边读一边取数据。
+        """
+        cursor = self.engine.connect.cursor()
+        cursor.execute(sqlcmd)
+        while 1:
+            records = cursor.fetchmany(chunksize)
+            if not records:
+                break
+            if keyword_uuid_set is None:
+                yield [record[0] for record in records]
+            else:
+                yield [record[0] for record in records if record[0] in keyword_uuid_set]
+    
+    def _iter_docid_chunks(self, docids, limit_number, chunksize=500):
+        """将doc id列表分批转换为uuid列表, 第一批只转换limit_number个, 所以top-N的查询通常
+        只需要转换一批
+        """
+        start = 0
+        size = max(min(limit_number, chunksize), 1)
+        while start < len(docids):
+            yield self._docid_to_uuid(docids[start: start + size])
+            start += size
+            size = chunksize
+    
+    def _paginate(self, candidate_chunks, offset_number, limit_number):
+        """从一批批的候选uuid中跳过前offset_number个, 取出至多limit_number个记录。
+        一旦数量足够就不再读取候选uuid。
+        """
+        skip, remain = offset_number, limit_number
+        for chunk in candidate_chunks:
+            if skip:
+                n = min(skip, len(chunk))
+                chunk, skip = chunk[n:], skip - n
+            chunk = chunk[:remain]
+            if chunk:
+                for record in self._fetch_records(chunk, len(chunk)):
+                    yield record
+                    remain -= 1
+            if remain <= 0:
+                return
+    
+    def _fetch_records(self, uuid_list, limit_number, chunksize=500):
+        """按照uuid_list的顺序, 从主表中分批取出记录。每批使用一条 WHERE uuid IN (...) 语句,
+        第一批只取limit_number条, 所以top-N的查询通常只需要一条语句。主表中没有的uuid被跳过。
+        """
+        sqlcmd_template = "SELECT * FROM %s WHERE %s IN (%%s)" % (self.schema.schema_name,
+                                                                  self.schema.uuid)
+        uuid_index = list(self.main_table.columns).index(self.schema.uuid)
+        start = 0
+        size = max(min(limit_number, chunksize), 1)
+        while start < len(uuid_list):
+            chunk = uuid_list[start: start + size]
+            records = dict()
+            for record in self.engine.cursor.execute(
+                    sqlcmd_template % ", ".join("?" * len(chunk)), chunk):
+                records[record[uuid_index]] = record
+            for uuid in chunk:
+                record = records.get(uuid)
+                if record is None: # 索引中残留的文档, 主表中已经没有了
+                    continue
+                yield record
+            start += size
+            size = chunksize
+    
     def add_one(self, document):
-        """用于往数据库中添加数据, 以增量更新的模式更新索引, 性能较低
+        """用于往数据库中添加数据, 以增量更新的模式更新索引
         1. 往主表格中填充一条文档
-        2. 更新倒排索引里的表中的索引数据
+        2. 把文档的 (field, keyword, docid) 追加到delta段中, 不读写整个posting list
         """
         # 将字典document转化为row
         columns, values = list(), list()
@@ -346,82 +559,205 @@ class SearchEngine():
         # 更新主表的数据
         ins = self.main_table.insert()
         self.engine.insert_row(ins, row)
+        docid = self._get_docid(document[self.schema.uuid])
         
-        # 对每一个field所对应的表进行更新
+        # 对每一个field所涉及的keyword, 往delta段中追加一条记录
+        records = [(keyword_field, keyword, docid) for keyword_field in self.schema.keyword_fields \
+                   for keyword in document[keyword_field]]
+        self._append_segment(self.delta_table, records)
+    
+    def delete_one(self, uuid):
+        """删除一条文档。文档的 (field, keyword, docid) 被写入tombstone, 查询时会被过滤掉, 
+        merge_segments()时才从posting list中真正删除。文档不存在时返回False。
+        """
+        select = Select([getattr(self.main_table, field) for field in self.schema.keyword_fields]
+                        ).where(getattr(self.main_table, self.schema.uuid) == uuid)
+        documents = list(self.engine.select(select))
+        if len(documents) == 0:
+            return False
+        
+        record = self.engine.cursor.execute(
+            "SELECT docid FROM %s WHERE uuid = ?" % self.docid_table.table_name, 
+            (uuid,)).fetchone()
+        self.engine.execute("DELETE FROM %s WHERE %s = ?" % (self.schema.schema_name, 
+                                                             self.schema.uuid), (uuid,))
+        if record is not None:
+            docid = record[0]
+            self.engine.execute("DELETE FROM %s WHERE docid = ?" % self.docid_table.table_name, 
+                                (docid,))
+            records = [(keyword_field, keyword, docid) \
+                       for keyword_field, keywords in zip(self.schema.keyword_fields, documents[0]) \
+                       for keyword in (keywords or list())]
+            self._append_segment(self.tombstone_table, records)
+        return True
+    
+    def update_one(self, document):
+        """更新一条文档, 相当于delete_one之后再add_one。文档会得到一个新的doc id。
+        """
+        self.delete_one(document[self.schema.uuid])
+        self.add_one(document)
+    
+    def _append_segment(self, table, records):
+        """往delta段或者tombstone中追加记录, 超过merge_threshold时自动合并
+        """
+        self.engine.insert_many_records(table.insert(), records)
+        self.delta_size += len(records)
+        if self.merge_threshold and (self.delta_size >= self.merge_threshold):
+            self.merge_segments()
+    
+    def merge_segments(self):
+        """把delta段和tombstone合并进posting list, 然后清空两者。只有被涉及到的keyword的
+        posting list会被重写。
+        """
+        if not self.delta_size:
+            return
         for keyword_field in self.schema.keyword_fields:
-            table = self.get_table(keyword_field)
-            ins = table.insert()
-            upd = table.update()
-              
-            # 对表中所涉及的keyword的行进行更新
-            for keyword in document[keyword_field]:
-                try: # 尝试插入新的, 若已经存在, 则进入更新
-                    self.engine.insert_row(ins, Row(
-                                                    ["keyword", "uuid_set"], 
-                                                    [keyword, set([document[self.schema.uuid]])]
-                                                     ) )
-                except: # 对keyword的行进行更新
-                    a = self.engine.select(Select([table.uuid_set]).where(table.keyword == keyword))
-                    
-                    new_uuid_set = list(a)[0][0]
-                    
-                    print(new_uuid_set)
-                    new_uuid_set.add(document[self.schema.uuid])
-                      
-                    self.engine.update(upd.values(uuid_set = new_uuid_set).where(table.keyword == keyword) )
-                    
-    def clone_from_data_stream(self, documents):
+            keywords = [row[0] for row in self.engine.cursor.execute(
+                "SELECT keyword FROM %s WHERE field = ? UNION SELECT keyword FROM %s WHERE field = ?" % (
+                    self.delta_table.table_name, self.tombstone_table.table_name), 
+                (keyword_field, keyword_field)).fetchall()]
+            
+            records, empty_keywords = list(), list()
+            for keyword in keywords:
+                posting_list = self._read_posting_list(keyword_field, keyword)
+                if len(posting_list):
+                    records.append((keyword, posting_list, len(posting_list)))
+                else:
+                    empty_keywords.append((keyword,))
+            self.engine.upsert_many_records(self.get_table(keyword_field).insert(), records)
+            self.engine.cursor.executemany("DELETE FROM %s WHERE keyword = ?" % keyword_field, 
+                                           empty_keywords)
+            
+        for table in [self.delta_table, self.tombstone_table]:
+            self.engine.execute("DELETE FROM %s" % table.table_name)
+        self.delta_size = 0
+        
+    def _get_docids(self, uuids):
+        """批量版本的_get_docid, 返回uuids中每一个uuid对应的doc id, 没有的则批量分配新的doc id
+        """
+        docid_table_name = self.docid_table.table_name
+        mapping = dict()
+        for chunk in grouper_list(list(set(uuids)), 500): # sqlite3的变量个数上限是999
+            sqlcmd = "SELECT uuid, docid FROM %s WHERE uuid IN (%s)" % (docid_table_name, 
+                                                                     ", ".join("?" * len(chunk)))
+            mapping.update(self.engine.cursor.execute(sqlcmd, chunk).fetchall())
+        
+        new_records = list()
+        next_docid = self._next_docid()
+        for uuid in uuids:
+            if uuid not in mapping:
+                mapping[uuid] = next_docid
+                new_records.append((next_docid, uuid))
+                next_docid += 1
+        self.engine.cursor.executemany(
+            "INSERT INTO %s (docid, uuid) VALUES (?, ?)" % docid_table_name, new_records)
+        return [mapping[uuid] for uuid in uuids]
+    
+    def _existing_uuids(self, uuids):
+        """返回uuids中在主表里已经存在的uuid的集合
+        """
+        existing = set()
+        for chunk in grouper_list(list(set(uuids)), 500): # sqlite3的变量个数上限是999
+            sqlcmd = "SELECT %s FROM %s WHERE %s IN (%s)" % (self.schema.uuid, 
+                self.schema.schema_name, self.schema.uuid, ", ".join("?" * len(chunk)))
+            existing.update([record[0] for record in self.engine.cursor.execute(sqlcmd, chunk)])
+        return existing
+    
+    def clone_from_data_stream(self, documents, batch_size=10000, max_postings=5000000, 
+                               tmpdir=None, profile=None):
         """用于从0开始, 从批量文档中生成数据库, 性能较高
-        1. 往主表格中填充一条文档
-        2. 从文档中生成倒排索引的索引字典
+        1. 每batch_size个文档为一批, 用executemany往主表格中填充, 并批量分配doc id
+        2. 从文档中生成倒排索引。每个keyword field使用一个PostingsBuilder, 内存中的doc id
+        超过max_postings个时, 排序后写入tmpdir中的临时文件, 最后归并
         3. 往所有的索引表中填充索引
-                
-        invert_index = {keyword: set_of_uuid}
+        
+        整个过程在Sqlite3Engine.bulk_load(profile)中只使用一个事务。profile为None时, 主表为空
+        则使用"fast", 中途崩溃最多只需要重新导入; 否则使用"safe", 以免崩溃时损坏已有的数据。
+        
+        和add_one不同, uuid重复的文档不会抛出IntegrityError, 而是被跳过: 主表中已经存在的uuid,
+        数据流中重复出现的uuid (保留第一个), 以及写入主表失败的文档, 都不会被写入主表和索引。
+        
+        invert_index = {keyword: PostingList of docid}
         """
         import time
-        st = time.clock()
+        st = time.time()
         print("正在往数据库 %s 中填充数据..." % self.schema.schema_name)
         
-        # 初始化all_inv_dict
-        all_inv_dict = dict()
-        for keyword_field in self.schema.keyword_fields: # initialize a empty dict for invert index
-            all_inv_dict[keyword_field] = dict()
-            
+        builders = OrderedDict([(keyword_field, PostingsBuilder(max_postings, tmpdir)) \
+                                for keyword_field in self.schema.keyword_fields])
+        columns = list(self.main_table.columns)
+        defaults = [self.schema.fields[column].default for column in columns]
         ins = self.main_table.insert()
+        uuid = self.schema.uuid
+        is_empty = self.engine.cursor.execute(
+            "SELECT 1 FROM %s LIMIT 1" % self.schema.schema_name).fetchone() is None
+        if profile is None:
+            profile = "fast" if is_empty else "safe"
+        seen = set() # 数据流中已经出现过的uuid
         counter = 0
-        for document in documents:
-            counter += 1
-            # 将字典document转化为row
-            columns, values = list(), list()
-            for k, v in document.items():
-                columns.append(k)
-                values.append(v)
-            row = Row(columns, values)
-        
-            # 更新主表的数据
-            try:
-                self.engine.insert_row(ins, row)
-            except:
-                pass
-            
-            # 计算倒排索引
-            for keyword_field in self.schema.keyword_fields:
-                uuid = document[self.schema.uuid]
-                for keyword in document[keyword_field]:
-                    if keyword in all_inv_dict[keyword_field]:
-                        all_inv_dict[keyword_field][keyword].add(uuid)
+        try:
+            with self.engine.bulk_load(profile, commit_every=None):
+                for batch in grouper(documents, batch_size):
+                    batch = [document for document in batch if document is not None]
+                    # 跳过重复的uuid
+                    if is_empty:
+                        existing = seen
                     else:
-                        all_inv_dict[keyword_field][keyword] = set([uuid,])
-        
-        # 将all_inv_dict中的数据存入索引表中
-        for keyword_field in all_inv_dict:
-            table = self.get_table(keyword_field)
-            ins = table.insert()
-            for keyword, uuid_set in all_inv_dict[keyword_field].items():
-                self.engine.insert_record(ins, (keyword, uuid_set))
+                        existing = seen.union(self._existing_uuids(
+                            [document[uuid] for document in batch]))
+                    new_batch = list()
+                    for document in batch:
+                        if document[uuid] not in existing:
+                            existing.add(document[uuid])
+                            new_batch.append(document)
+                    seen.update([document[uuid] for document in new_batch])
+                    batch = new_batch
+                    
+                    # 更新主表的数据
+                    report = self.engine.insert_many_records(ins, 
+                        [tuple([document.get(column, default) \
+                                for column, default in zip(columns, defaults)]) \
+                         for document in batch], chunksize=batch_size)
+                    if report.inserted < len(batch): # 写入失败的文档不加入索引
+                        existing = self._existing_uuids([document[uuid] for document in batch])
+                        batch = [document for document in batch if document[uuid] in existing]
+                    
+                    # 计算倒排索引
+                    docids = self._get_docids([document[uuid] for document in batch])
+                    for document, docid in zip(batch, docids):
+                        for keyword_field, builder in builders.items():
+                            for keyword in document[keyword_field]:
+                                builder.add(keyword, docid)
+                    
+                    counter += len(batch)
+                    elapsed = time.time() - st
+                    print("\t已处理 %s 条文档, %.0f 条/秒" % (counter, counter / max(elapsed, 1e-6)))
+                
+                # 将归并后的posting list存入索引表中, 如果表中已经有这个keyword, 则合并
+                for keyword_field, builder in builders.items():
+                    ins_keyword = self.get_table(keyword_field).insert()
+                    is_empty = self.engine.cursor.execute(
+                        "SELECT 1 FROM %s LIMIT 1" % keyword_field).fetchone() is None
+                    
+                    def records():
+                        for keyword, posting_list in builder.items():
+                            if not is_empty:
+                                record = self.engine.connect.execute(
+                                    "SELECT postings FROM %s WHERE keyword = ?" % keyword_field, 
+                                    (keyword,)).fetchone()
+                                if record is not None:
+                                    posting_list = PostingList.from_docids(chain(
+                                        PostingList(record[0]), posting_list))
+                            yield (keyword, posting_list, len(posting_list))
+                    
+                    self.engine.upsert_many_records(ins_keyword, records())
+        finally:
+            for builder in builders.values():
+                builder.close()
         
-        print("\t数据库准备完毕, 一共插入了 %s 条数据, 可以进行搜索了! 一共耗时 %s 秒" % (counter,
-                                                               (time.clock() - st), ) )
+        elapsed = time.time() - st
+        print("\t数据库准备完毕, 一共插入了 %s 条数据, 可以进行搜索了! 一共耗时 %.2f 秒, %.0f 条/秒" % (
+            counter, elapsed, counter / max(elapsed, 1e-6)) )
         
 
     def create_query(self):
@@ -434,46 +770,37 @@ class SearchEngine():
     def _search(self, query):
         """根据query进行单元搜索, 返回record tuple. 本方法为search()和search_document()方法的内核
         """
-        main_sqlcmd_select_uuid, main_sqlcmd_select_all, keyword_sqlcmd_list = query.create_sql()
+        main_sqlcmd_select_uuid, main_sqlcmd_select_all, keyword_lookup_list = query.create_sql()
 
         ### 情况1, 主表和倒排索引表都要被查询
-        if (len(keyword_sqlcmd_list) >= 1) and ("WHERE" in main_sqlcmd_select_uuid):
-            # 得到查询主表所筛选出的 result_uuid_set
-            result_uuid_set = OrderedSet([record[0] for record in self.engine.cursor.execute(main_sqlcmd_select_uuid)])
-
+        if (len(keyword_lookup_list) >= 1) and ("WHERE" in main_sqlcmd_select_uuid):
             # 得到使用倒排索引所筛选出的 keyword_uuid_set
-            keyword_uuid_set = OrderedSet( set.intersection(
-                *[self.engine.cursor.execute(sqlcmd).fetchone()[0] for sqlcmd in keyword_sqlcmd_list]
-                ) )
-            # 对两者求交集
-            result_uuid_set = OrderedSet.intersection(result_uuid_set, keyword_uuid_set)
-            # 根据结果中的uuid, 去主表中取数据
-            for uuid in result_uuid_set:
-                record = self.engine.cursor.execute("SELECT * FROM {0} WHERE {1} = {2}".format(self.schema.schema_name,
-                                                                                               self.schema.uuid,
-                                                                                               repr(uuid),) ).fetchone()
+            keyword_uuid_set = set(self._docid_to_uuid(self._keyword_docids(keyword_lookup_list)))
+            if not keyword_uuid_set:
+                return
+            # 依次读取主表的查询结果, 保留在keyword_uuid_set中的, 数量足够即停止
+            candidate_chunks = self._iter_candidates(main_sqlcmd_select_uuid, keyword_uuid_set)
+            for record in self._paginate(candidate_chunks, query.offset_number, query.limit_number):
                 yield record
 
         ### 情况2, 只对倒排索引表查询
-        elif (len(keyword_sqlcmd_list) >= 1) and ("WHERE" not in main_sqlcmd_select_uuid):
-            # 得到查询主表所筛选出的 result_uuid_set
-            result_uuid_set = OrderedSet([record[0] for record in self.engine.cursor.execute(main_sqlcmd_select_uuid)])
-
-            # 得到使用倒排索引所筛选出的 keyword_uuid_set
-            keyword_uuid_set = OrderedSet( set.intersection(
-                *[self.engine.cursor.execute(sqlcmd).fetchone()[0] for sqlcmd in keyword_sqlcmd_list]
-                ) )
-            # 对两者求交集
-            result_uuid_set = OrderedSet.intersection(result_uuid_set, keyword_uuid_set)
-            # 根据结果中的uuid, 去主表中取数据
-            for uuid in result_uuid_set:
-                record = self.engine.cursor.execute("SELECT * FROM {0} WHERE {1} = {2}".format(self.schema.schema_name,
-                                                                                               self.schema.uuid,
-                                                                                               repr(uuid),) ).fetchone()
+        elif (len(keyword_lookup_list) >= 1) and ("WHERE" not in main_sqlcmd_select_uuid):
+            docids = self._keyword_docids(keyword_lookup_list)
+            if not docids:
+                return
+            if query.orderby_clause: # 需要按照主表排序
+                candidate_chunks = self._iter_candidates(main_sqlcmd_select_uuid,
+                                                         set(self._docid_to_uuid(docids)))
+                offset_number = query.offset_number
+            else: # 按照doc id, 即文档插入的顺序, 分批转换需要的doc id
+                candidate_chunks = self._iter_docid_chunks(docids[query.offset_number:], 
+                                                           query.limit_number)
+                offset_number = 0
+            for record in self._paginate(candidate_chunks, offset_number, query.limit_number):
                 yield record
         
-        ### 情况3, 只对主表查询
-        elif (len(keyword_sqlcmd_list) == 0) and ("WHERE" in main_sqlcmd_select_uuid):
+        ### 情况3, 只对主表查询, LIMIT和OFFSET直接交给sqlite
+        elif (len(keyword_lookup_list) == 0) and ("WHERE" in main_sqlcmd_select_uuid):
             for record in self.engine.cursor.execute(main_sqlcmd_select_all):
                 yield record
         
@@ -731,6 +1058,7 @@ class Query():
         self.limit_clause = None
         self.limit_number = 20
         self.offset_clause = None
+        self.offset_number = 0
         
         self.query_equal = QueryEqual
         self.query_greater = QueryGreater
@@ -802,6 +1130,7 @@ class Query():
         
     def offset(self, howmany):
         self.offset_clause = "OFFSET %s" % howmany
+        self.offset_number = howmany
 
     def _split_SqlCriterions_and_KeywordCriterions(self):
         """分离对主表查询的criterion和对倒排索引表查询的criterion
@@ -832,23 +1161,364 @@ class Query():
         else:
             where_clause = ""
 
+        # 有倒排索引的条件时, LIMIT和OFFSET要在求交集之后才能使用, 由SearchEngine处理
         main_sqlcmd_select_uuid = "\n\t".join([i for i in [select_uuid_clause,
                                                            where_clause,
-                                                           self.orderby_clause,
-                                                           self.offset_clause] if i ])  
+                                                           self.orderby_clause] if i ])  
 
+        # 只有主表的条件时, LIMIT和OFFSET直接交给sqlite, sqlite要求OFFSET前必须有LIMIT
+        limit_offset_clause = "LIMIT %s OFFSET %s" % (self.limit_number, self.offset_number)
         main_sqlcmd_select_all = "\n\t".join([i for i in [select_all_clause,
                                                           where_clause,
                                                           self.orderby_clause,
-                                                          self.offset_clause] if i ])  
-        ### SQL command for the invert index table (which table_name = Engine.keyword_fields)
-        keyword_sqlcmd_list = list()
+                                                          limit_offset_clause] if i ])  
+        ### (field_name, keyword) lookup for the invert index table (which table_name = Engine.keyword_fields)
+        keyword_lookup_list = list()
         for criterion in keyword_criterions:
             for keyword in criterion.subset:
-                select_clause = "SELECT\t{0}\n".format("uuid_set")
-                from_clause = "FROM\t{0}\n".format(criterion.field_name)
-                where_clause = "WHERE\t{0} = {1}".format("keyword", repr(keyword))
-                keyword_sqlcmd_list.append(select_clause + from_clause + where_clause)
+                keyword_lookup_list.append((criterion.field_name, keyword))
+        
+        return main_sqlcmd_select_uuid, main_sqlcmd_select_all, keyword_lookup_list
+    
+
+if __name__ == "__main__":
+    import unittest
+    import tempfile
+    import shutil
+    import random
+    import os
+    from contextlib import redirect_stdout
+    from io import StringIO
+    
+    fieldtype = FieldType()
+    GENRES = ["Action", "Drama", "Comedy", "Crime", "Romance"]
+    
+    def new_schema():
+        return Schema("movie",
+            Field("movie_id", fieldtype.Searchable_UUID, primary_key=True),
+            Field("year", fieldtype.Searchable_INTEGER),
+            Field("genres", fieldtype.Searchable_KEYWORD),
+            Field("tags", fieldtype.Searchable_KEYWORD),
+            )
+    
+    def new_document(i, rand):
+        return {"movie_id": "m%06d" % i, "year": rand.randint(1950, 2020), 
+                "genres": set(rand.sample(GENRES, 2)), "tags": {"t%s" % rand.randint(0, 9)}}
+    
+    class SearchEngineTestCase(unittest.TestCase):
+        def setUp(self):
+            self.cwd = os.getcwd()
+            self.dir = tempfile.mkdtemp()
+            os.chdir(self.dir) # 数据库文件创建在当前目录下
+            self.rand = random.Random(1)
+            self.engines = list()
         
-        return main_sqlcmd_select_uuid, main_sqlcmd_select_all, keyword_sqlcmd_list
-    
\ No newline at end of file
+        def tearDown(self):
+            for engine in self.engines:
+                engine.engine.connect.close()
+            os.chdir(self.cwd)
+            shutil.rmtree(self.dir)
+        
+        def new_engine(self, n=0, **kwargs):
+            """创建一个SearchEngine, 用clone_from_data_stream导入n个文档, 返回 
+            (engine, {uuid: document})
+            """
+            engine = SearchEngine(new_schema(), **kwargs)
+            self.engines.append(engine)
+            documents = [new_document(i, self.rand) for i in range(n)]
+            with redirect_stdout(StringIO()):
+                engine.clone_from_data_stream(iter(documents), batch_size=300)
+            return engine, dict([(document["movie_id"], document) for document in documents])
+        
+        def search(self, engine, genres=(), tags=(), year=None, orderby=None, 
+                   limit=10**9, offset=0):
+            """返回搜索结果的uuid列表"""
+            query = engine.create_query()
+            if genres:
+                query.add(query.query_contains("genres", *genres))
+            if tags:
+                query.add(query.query_contains("tags", *tags))
+            if year is not None:
+                query.add(query.query_greater("year", year))
+            if orderby is not None:
+                query.order_by(*orderby)
+            query.limit(limit)
+            query.offset(offset)
+            return [record[0] for record in engine.search(query)]
+        
+        def expected(self, documents, genres=(), tags=(), year=None):
+            """暴力计算按uuid排序的结果"""
+            return sorted([uuid for uuid, document in documents.items() \
+                           if set(genres).issubset(document["genres"]) and \
+                           set(tags).issubset(document["tags"]) and \
+                           (year is None or document["year"] >= year)])
+    
+    class FetchRecordsUnittest(SearchEngineTestCase):
+        def test_batched_fetch(self):
+            """结果按uuid_list的顺序返回。第一批只取limit_number条, 之后每批chunksize条
+            """
+            engine, documents = self.new_engine(1200)
+            uuid_list = sorted(documents)
+            self.rand.shuffle(uuid_list)
+            statements = list()
+            engine.engine.connect.set_trace_callback(statements.append)
+            records = list(engine._fetch_records(uuid_list, 10, chunksize=100))
+            engine.engine.connect.set_trace_callback(None)
+            self.assertListEqual([record[0] for record in records], uuid_list)
+            self.assertEqual(records[0][2], documents[uuid_list[0]]["genres"])
+            self.assertEqual(len(statements), 1 + 12) # 10, 100 * 11, 90
+            
+            self.assertEqual(list(engine._fetch_records([], 10)), [])
+        
+        def test_more_than_chunksize(self):
+            """搜索结果多于一批 (500条) 时, 结果和暴力计算的一致
+            """
+            engine, documents = self.new_engine(3000)
+            for genres, year in [(["Drama"], None), (["Drama"], 1990), ([], 1960)]:
+                self.assertListEqual(sorted(self.search(engine, genres=genres, year=year)), 
+                                     self.expected(documents, genres=genres, year=year))
+            self.assertGreater(len(self.expected(documents, genres=["Drama"])), 500)
+        
+        def test_stale_entry(self):
+            """主表中已经没有的文档被跳过, 并且不占用limit的名额
+            """
+            engine, documents = self.new_engine(100)
+            uuid_list = self.expected(documents, genres=["Drama"])
+            engine.engine.execute("DELETE FROM movie WHERE movie_id = ?", (uuid_list[0],))
+            self.assertListEqual(list(engine._fetch_records(uuid_list[:3], 3)), 
+                                 list(engine._fetch_records(uuid_list[1:3], 2)))
+            self.assertListEqual(self.search(engine, genres=["Drama"], limit=5), uuid_list[1:6])
+            self.assertListEqual(sorted(self.search(engine, genres=["Drama"], year=1900)), 
+                                 uuid_list[1:])
+    
+    class PaginationUnittest(SearchEngineTestCase):
+        def test_pagination(self):
+            """LIMIT/OFFSET的结果和不分页的结果的对应部分一致, 分别测试 有/没有 主表条件,
+            有/没有 ORDER BY
+            """
+            engine, documents = self.new_engine(1500)
+            orderby = (["year", "movie_id"], ["DESC", "ASC"])
+            for kwargs in [dict(genres=["Drama"]), 
+                           dict(genres=["Drama"], orderby=orderby), 
+                           dict(genres=["Drama"], tags=["t1"], year=1980), 
+                           dict(genres=["Drama"], year=1980, orderby=orderby), 
+                           dict(year=1980),
+                           dict(year=1980, orderby=orderby)]:
+                full = self.search(engine, **kwargs)
+                self.assertListEqual(sorted(full), self.expected(documents, 
+                    **dict([(k, v) for k, v in kwargs.items() if k != "orderby"])))
+                if "orderby" in kwargs:
+                    years = [documents[uuid]["year"] for uuid in full]
+                    self.assertListEqual(years, sorted(years, reverse=True))
+                n = len(full)
+                for offset, limit in [(0, 1), (0, 7), (5, 7), (495, 10), (498, 600), 
+                                      (n - 3, 10), (n, 10), (n + 5, 10)]:
+                    self.assertListEqual(
+                        self.search(engine, limit=limit, offset=offset, **kwargs), 
+                        full[offset: offset + limit], (kwargs, offset, limit))
+                
+                pages = list()
+                for offset in range(0, n + 100, 100):
+                    pages.extend(self.search(engine, limit=100, offset=offset, **kwargs))
+                self.assertListEqual(pages, full)
+    
+    class CloneUnittest(SearchEngineTestCase):
+        def clone(self, engine, documents, **kwargs):
+            """导入文档, 返回所使用的bulk_load profile"""
+            profiles = list()
+            bulk_load = engine.engine.bulk_load
+            def record_profile(profile, commit_every):
+                profiles.append(profile)
+                return bulk_load(profile, commit_every)
+            engine.engine.bulk_load = record_profile
+            with redirect_stdout(StringIO()):
+                engine.clone_from_data_stream(iter(documents), batch_size=30, **kwargs)
+            del engine.engine.bulk_load
+            return profiles[0]
+        
+        def test_profile(self):
+            """只有主表为空时才默认使用"fast"
+            """
+            engine, _ = self.new_engine()
+            self.assertEqual(self.clone(engine, []), "fast")
+            self.assertEqual(self.clone(engine, [new_document(0, self.rand)]), "fast")
+            self.assertEqual(self.clone(engine, [new_document(1, self.rand)]), "safe")
+            self.assertEqual(self.clone(engine, [new_document(2, self.rand)], profile="fast"), 
+                             "fast")
+        
+        def test_duplicate(self):
+            """已经存在的uuid, 数据流中重复的uuid, 写入失败的文档都被跳过, 不加入索引
+            """
+            engine, documents = self.new_engine(100)
+            stream = [new_document(i, self.rand) for i in range(50, 150)]
+            stream.insert(80, new_document(120, self.rand)) # 同一批中重复
+            stream.append(new_document(60, self.rand)) # 不同批中重复
+            bad = new_document(150, self.rand)
+            bad["year"] = object() # sqlite3无法接受的数据类型
+            stream.insert(40, bad)
+            self.clone(engine, stream)
+            
+            for document in stream:
+                documents.setdefault(document["movie_id"], document)
+            del documents["m000150"]
+            self.assertEqual(engine.engine.cursor.execute(
+                "SELECT COUNT(*) FROM movie_docid").fetchone()[0], 150)
+            for genre in GENRES:
+                self.assertListEqual(sorted(self.search(engine, genres=[genre])), 
+                                     self.expected(documents, genres=[genre]))
+                self.assertListEqual(sorted(self.search(engine, genres=[genre], year=1990)), 
+                                     self.expected(documents, genres=[genre], year=1990))
+    
+    class IncrementalUnittest(SearchEngineTestCase):
+        def assertSearchEqual(self, engine, documents):
+            """各种查询的结果都和暴力计算的一致"""
+            for genre in GENRES:
+                for kwargs in [dict(genres=[genre]), dict(genres=[genre], tags=["t1"]), 
+                               dict(genres=[genre], year=1990), dict(tags=["t5"])]:
+                    self.assertListEqual(sorted(self.search(engine, **kwargs)), 
+                                         self.expected(documents, **kwargs), kwargs)
+            # 只有keyword条件时, 按照doc id的顺序分页
+            full = self.search(engine, genres=["Drama"])
+            self.assertListEqual(self.search(engine, genres=["Drama"], offset=3, limit=5), 
+                                 full[3:8])
+        
+        def segment_sizes(self, engine):
+            return [engine.engine.cursor.execute("SELECT COUNT(*) FROM %s" % table_name
+                                                 ).fetchone()[0] \
+                    for table_name in ["movie_delta", "movie_tombstone"]]
+        
+        def test_add_delete_update(self):
+            """add_one, delete_one, update_one之后, merge_segments之前和之后的搜索结果
+            """
+            engine, documents = self.new_engine(200, merge_threshold=None)
+            for i in range(200, 220):
+                document = new_document(i, self.rand)
+                document["genres"].add("Western") # 新的keyword只在delta段中
+                engine.add_one(document)
+                documents[document["movie_id"]] = document
+            for i in range(0, 30, 2):
+                self.assertTrue(engine.delete_one("m%06d" % i))
+                del documents["m%06d" % i]
+            for i in list(range(1, 30, 2)) + [205]:
+                document = new_document(i, self.rand)
+                engine.update_one(document)
+                documents[document["movie_id"]] = document
+            self.assertFalse(engine.delete_one("m000000"))
+            engine.commit()
+            
+            delta, tombstone = self.segment_sizes(engine)
+            self.assertGreater(delta, 0)
+            self.assertGreater(tombstone, 0)
+            self.assertEqual(engine.delta_size, delta + tombstone)
+            self.assertSearchEqual(engine, documents)
+            self.assertListEqual(sorted(self.search(engine, genres=["Western"])), 
+                                 ["m%06d" % i for i in range(200, 220) if i != 205])
+            
+            engine.merge_segments()
+            engine.commit()
+            self.assertEqual(self.segment_sizes(engine), [0, 0])
+            self.assertEqual(engine.delta_size, 0)
+            self.assertSearchEqual(engine, documents)
+            self.assertEqual(engine.engine.cursor.execute(
+                "SELECT df FROM genres WHERE keyword = 'Western'").fetchone()[0], 19)
+            
+            # 合并之后继续增量更新
+            for uuid in ["m000201", "m000203", "m000210"]:
+                engine.delete_one(uuid)
+                del documents[uuid]
+            for i in [1, 220]:
+                document = new_document(i, self.rand)
+                engine.update_one(document)
+                documents[document["movie_id"]] = document
+            self.assertSearchEqual(engine, documents)
+            
+            # 重新打开数据库, 未合并的delta段仍然有效
+            engine.commit()
+            engine.engine.connect.close()
+            self.engines.remove(engine)
+            engine = SearchEngine(new_schema(), merge_threshold=None)
+            self.engines.append(engine)
+            self.assertEqual(engine.delta_size, sum(self.segment_sizes(engine)))
+            self.assertSearchEqual(engine, documents)
+            engine.merge_segments()
+            self.assertSearchEqual(engine, documents)
+            
+            # posting list中被删除的keyword整个被移除
+            for uuid in ["m%06d" % i for i in range(200, 220)]:
+                if uuid in documents:
+                    engine.delete_one(uuid)
+                    del documents[uuid]
+            engine.merge_segments()
+            self.assertIsNone(engine.engine.cursor.execute(
+                "SELECT df FROM genres WHERE keyword = 'Western'").fetchone())
+            self.assertSearchEqual(engine, documents)
+        
+        def test_merge_threshold(self):
+            """delta段和tombstone中的记录数达到merge_threshold时自动合并
+            """
+            engine, documents = self.new_engine(50, merge_threshold=10)
+            sizes = list()
+            for i in range(50, 54): # 每个文档有 2个genres + 1个tags = 3条记录
+                document = new_document(i, self.rand)
+                engine.add_one(document)
+                documents[document["movie_id"]] = document
+                sizes.append(engine.delta_size)
+            self.assertListEqual(sizes, [3, 6, 9, 0])
+            self.assertEqual(self.segment_sizes(engine), [0, 0])
+            self.assertSearchEqual(engine, documents)
+            
+            engine.delete_one("m000000") # tombstone中的记录也被计数
+            del documents["m000000"]
+            self.assertEqual(engine.delta_size, 3)
+            document = new_document(1, self.rand)
+            engine.update_one(document) # delete + add, 3 + 3 + 3 >= 10 不成立
+            documents[document["movie_id"]] = document
+            self.assertEqual(engine.delta_size, 9)
+            engine.delete_one("m000002")
+            del documents["m000002"]
+            self.assertEqual(engine.delta_size, 0)
+            self.assertSearchEqual(engine, documents)
+        
+        def test_next_docid(self):
+            """被删除的doc id在合并之前不会被重用; tombstone中的MAX(docid)使用索引, 不扫描全表
+            """
+            engine, documents = self.new_engine(10, merge_threshold=None)
+            engine.delete_one("m000009")
+            engine.add_one(new_document(10, self.rand))
+            self.assertEqual(engine._get_docid("m000010"), 11)
+            plan = engine.engine.cursor.execute(
+                "EXPLAIN QUERY PLAN SELECT MAX(docid) FROM movie_tombstone").fetchall()
+            self.assertIn("ix_movie_tombstone_docid", plan[0][-1])
+        
+        def test_random_operations(self):
+            """随机的add_one, delete_one, update_one, 和暴力计算的结果比较
+            """
+            for merge_threshold in [None, 37]:
+                engine, documents = self.new_engine(300, merge_threshold=merge_threshold)
+                for step in range(400):
+                    r = self.rand.random()
+                    if r < 0.4:
+                        document = new_document(self.rand.randint(0, 600), self.rand)
+                        if document["movie_id"] in documents:
+                            continue
+                        engine.add_one(document)
+                        documents[document["movie_id"]] = document
+                    elif r < 0.7:
+                        uuid = self.rand.choice(sorted(documents))
+                        self.assertTrue(engine.delete_one(uuid))
+                        del documents[uuid]
+                    else:
+                        uuid = self.rand.choice(sorted(documents))
+                        document = new_document(int(uuid[1:]), self.rand)
+                        engine.update_one(document)
+                        documents[uuid] = document
+                    if step % 100 == 99:
+                        self.assertSearchEqual(engine, documents)
+                    if (step == 200) and (merge_threshold is None):
+                        engine.merge_segments()
+                self.assertSearchEqual(engine, documents)
+                engine.engine.connect.close()
+                self.engines.remove(engine)
+                os.remove("movie.db")
+    
+    unittest.main()
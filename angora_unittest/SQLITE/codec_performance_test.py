@@ -0,0 +1,69 @@
+##encoding=utf8
+
+"""
+测试Column codec在IO大型容器对象时的性能
+1. Codec.pickle, 即pickle.dumps / pickle.loads
+2. Codec.fast, 对 整数/实数/字符串 组成的list, set, tuple, dict使用array/struct编码
+
+同时比较了两者编码后的bytes大小。结论是:
+对于字符串list/set, fast codec写入速度是pickle的3-4倍, 读取速度相当, 体积小约20%;
+对于整数, fast codec选择能容纳所有元素的最小整数类型, 体积更小, 但CPython的pickle对整数
+已经非常快, 所以写入速度不及pickle。
+"""
+
+from __future__ import print_function
+from angora.GADGET.pytimer import Timer
+from angora.STRING.formatmaster import Template
+from angora.SQLITE.core import Codec
+timer = Timer()
+tplt = Template()
+
+complexity = 1000000
+python_int_list = [i for i in range(complexity)]
+python_small_int_list = [i % 100 for i in range(complexity)]
+python_float_list = [i * 0.5 for i in range(complexity)]
+python_str_list = [str(i) for i in range(complexity)]
+python_int_set = {i for i in range(complexity)}
+python_str_set = {str(i) for i in range(complexity)}
+python_int_str_dict = {i: str(i) for i in range(complexity)}
+
+def codec_test(name, obj):
+    """测试用Codec.pickle和Codec.fast在IO一个对象时的性能
+    """
+    for codec in [Codec.pickle, Codec.fast]:
+        print(tplt.straightline("%s %s" % (name, codec)))
+        timer.start()
+        res = codec.encode(obj)
+        timer.timeup()
+
+        timer.start()
+        codec.decode(res)
+        timer.timeup()
+        print("%s bytes" % len(res))
+
+def python_int_list_test():
+    codec_test("python_int_list", python_int_list)
+    codec_test("python_small_int_list", python_small_int_list)
+
+# python_int_list_test()
+
+def python_float_list_test():
+    codec_test("python_float_list", python_float_list)
+
+# python_float_list_test()
+
+def python_str_list_test():
+    codec_test("python_str_list", python_str_list)
+
+# python_str_list_test()
+
+def python_set_test():
+    codec_test("python_int_set", python_int_set)
+    codec_test("python_str_set", python_str_set)
+
+# python_set_test()
+
+def python_dict_test():
+    codec_test("python_int_str_dict", python_int_str_dict)
+
+# python_dict_test()
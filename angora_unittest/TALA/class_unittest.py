@@ -98,7 +98,7 @@ if __name__ == "__main__":
         query = engine.create_query()
         query.renew_with(query.query_between("rating", 0.0, 10.0))
         query.order_by(["year"], ["DESC"])
-        main_sqlcmd, main_sqlcmd_select_all, keyword_sqlcmd_list = query.create_sql()
+        main_sqlcmd, main_sqlcmd_select_all, keyword_lookup_list = query.create_sql()
         print(main_sqlcmd)
         
     Query_unittest()
\ No newline at end of file